@@ -0,0 +1,187 @@
+# Incremental exports after PHY curation
+#
+# Merging or splitting clusters in PHY relabels spikes in spike_clusters.npy
+# and rewrites cluster_info.tsv, but leaves spike_times.npy and the raw data
+# as they are. Each export keeps a curation snapshot, an npy store (see
+# npy_store.py) with the spike_clusters and the (cluster_id, ch) units it was
+# made from. The next export compares the snapshot with the current PHY
+# files with one vectorized comparison of the labels of every spike, and
+# only the units that were created or changed are extracted again. The
+# outputs of unchanged units are copied from the previous export.
+
+from collections import namedtuple
+from os import path
+
+import numpy as np
+
+from meappy.npy_store import METADATA_FILE, read_npy_store, write_npy_store
+
+CURATION_SUFFIX = "_curation"
+CURATION_INPUTS = ("spike_clusters", "cluster_info")  # inputs curation edits
+
+
+class CurationDiff(namedtuple("CurationDiff", ["created", "removed", "changed"])):
+    """
+    Cluster ids of the units of a curation edit, as sorted arrays:
+        created: units only in the new curation, e.g. the result of a merge
+        removed: units only in the previous curation
+        changed: units of both whose spikes or channel changed
+    """
+
+    __slots__ = ()
+
+    @property
+    def recompute(self):
+        """units whose outputs are computed again"""
+        return np.union1d(self.created, self.changed)
+
+    @property
+    def stale(self):
+        """units whose previous outputs are dropped"""
+        return np.union1d(self.removed, self.changed)
+
+    @property
+    def is_empty(self):
+        return not (len(self.created) or len(self.removed) or len(self.changed))
+
+    def __str__(self):
+        return (
+            f"{len(self.created)} created, {len(self.removed)} removed, "
+            f"{len(self.changed)} changed units"
+        )
+
+
+def _channels_of(unit_list, cluster_ids):
+    order = np.argsort(unit_list[:, 0])
+    index = np.searchsorted(unit_list[order, 0], cluster_ids)
+    return unit_list[order[index], 1]
+
+
+def curation_diff(old_spike_clusters, new_spike_clusters, old_unit_list, new_unit_list):
+    """
+    Units created, removed or changed between two curations of the same
+    sort. A unit changed if any spike joined or left it, or its channel
+    changed.
+    Params:
+        old_spike_clusters, new_spike_clusters: np.ndarray, PHY
+            spike_clusters of the previous and current curation
+        old_unit_list, new_unit_list: (num_units, 2) arrays of
+            (cluster_id, ch) of the exported units, e.g. good_clust_chan()
+    Returns:
+        CurationDiff
+    """
+    old_spike_clusters = np.asarray(old_spike_clusters).reshape(-1)
+    new_spike_clusters = np.asarray(new_spike_clusters).reshape(-1)
+    if old_spike_clusters.shape != new_spike_clusters.shape:
+        raise ValueError(
+            "The number of spikes changed, the data was sorted again "
+            "rather than curated"
+        )
+    old_unit_list = np.asarray(old_unit_list, dtype=np.int64).reshape(-1, 2)
+    new_unit_list = np.asarray(new_unit_list, dtype=np.int64).reshape(-1, 2)
+
+    moved = old_spike_clusters != new_spike_clusters
+    touched = np.union1d(old_spike_clusters[moved], new_spike_clusters[moved])
+    old_ids, new_ids = old_unit_list[:, 0], new_unit_list[:, 0]
+    kept = np.intersect1d(old_ids, new_ids)
+    moved_channel = kept[
+        _channels_of(old_unit_list, kept) != _channels_of(new_unit_list, kept)
+    ]
+    return CurationDiff(
+        created=np.setdiff1d(new_ids, old_ids),
+        removed=np.setdiff1d(old_ids, new_ids),
+        changed=np.union1d(np.intersect1d(kept, touched), moved_channel),
+    )
+
+
+def curation_snapshot_path(export_path, expt_id, exporter):
+    """
+    Returns the path of the curation snapshot of an export. Each exporter,
+    e.g. 'nwb' or 'waves', has its own snapshot, so exporters writing to the
+    same directory do not diff against the curation of each other.
+    example: (/export, 20211109_15h09m07s, nwb) ->
+        /export/20211109_15h09m07s_nwb_curation
+    """
+    return path.join(export_path, f"{expt_id}_{exporter}{CURATION_SUFFIX}")
+
+
+def write_curation_snapshot(store_dir, spike_clusters, unit_list, metadata=None):
+    """Writes the curation an export was made from, see curation_diff()"""
+    arrays = {
+        "spike_clusters": np.asarray(spike_clusters).reshape(-1),
+        "unit_list": np.asarray(unit_list, dtype=np.int64).reshape(-1, 2),
+    }
+    return write_npy_store(store_dir, arrays, metadata)
+
+
+def read_curation_snapshot(store_dir):
+    """
+    Returns the spike_clusters and unit_list of a curation snapshot, or
+    (None, None) if the export has no snapshot
+    """
+    if not path.exists(path.join(store_dir, METADATA_FILE)):
+        return None, None
+    arrays, _ = read_npy_store(store_dir, mmap_mode="r")
+    return arrays["spike_clusters"], arrays["unit_list"]
+
+
+def is_curation_edit(previous_cache, cache):
+    """
+    True if two export caches (see export_cache.py) differ only by curation:
+    same export parameters and same inputs other than spike_clusters and
+    cluster_info, so the outputs of unchanged units can be reused.
+    """
+    if not previous_cache or previous_cache.get("params") != cache["params"]:
+        return False
+    previous_inputs = previous_cache.get("inputs", {})
+    for name, signature in cache["inputs"].items():
+        if name in CURATION_INPUTS:
+            continue
+        previous = previous_inputs.get(name)
+        if (signature is None) != (previous is None):
+            return False
+        if signature is not None and signature["hash"] != previous["hash"]:
+            return False
+    return set(previous_inputs) == set(cache["inputs"])
+
+
+def patch_unit_dict(previous, recomputed, unit_ids):
+    """
+    Per unit values of unit_ids, in that order, from recomputed for the units
+    it has and from previous for the others.
+    """
+    return {
+        unit: recomputed[unit] if unit in recomputed else previous[unit]
+        for unit in unit_ids
+    }
+
+
+def _rows_of(ids, units):
+    """row of each of units in ids"""
+    ids = np.asarray(ids)
+    sort = np.argsort(ids)
+    position = np.minimum(np.searchsorted(ids[sort], units), max(len(ids) - 1, 0))
+    if len(units) and (not len(ids) or (ids[sort][position] != units).any()):
+        raise ValueError(f"Units {np.setdiff1d(units, ids)} are not in the export")
+    return sort[position] if len(ids) else np.zeros(0, dtype=int)
+
+
+def patch_unit_rows(previous, recomputed, unit_ids, row_keys, id_key="cluster_ids"):
+    """
+    Merges two dicts of arrays with one row per unit, e.g. of drift_traces(),
+    in the order of unit_ids. Units of recomputed take their rows from it,
+    the others from previous. Keys not in row_keys are taken from recomputed.
+    """
+    unit_ids = np.asarray(unit_ids)
+    from_new = np.isin(unit_ids, recomputed[id_key])
+    new_rows = _rows_of(recomputed[id_key], unit_ids[from_new])
+    old_rows = _rows_of(previous[id_key], unit_ids[~from_new])
+    patched = {key: value for key, value in recomputed.items() if key not in row_keys}
+    for key in row_keys:
+        new, old = np.asarray(recomputed[key]), np.asarray(previous[key])
+        shape = (len(unit_ids),) + new.shape[1:]
+        patched[key] = np.empty(shape, dtype=np.result_type(new, old))
+        patched[key][from_new] = new[new_rows]
+        patched[key][~from_new] = old[old_rows]
+    patched[id_key] = unit_ids
+    return patched
@@ -0,0 +1,52 @@
+# MED64 electrode grid layout
+#
+# The 64 MED64 electrodes are an 8 x 8 grid. Channel ch is at grid row
+# ch // GRID_COLS and column ch % GRID_COLS. Distances are in units of the
+# electrode pitch (inter-electrode spacing), so they hold for every probe type.
+
+import numpy as np
+
+GRID_ROWS = 8
+GRID_COLS = 8
+DEFAULT_NEIGHBOR_RADIUS = 1.5  # pitch units, 1.5 includes the diagonal electrodes
+
+
+def electrode_positions(n_rows=GRID_ROWS, n_cols=GRID_COLS):
+    """
+    Returns: np.ndarray, (n_rows * n_cols, 2) array of the (row, column)
+        grid position of each channel
+    """
+    channels = np.arange(n_rows * n_cols)
+    return np.column_stack((channels // n_cols, channels % n_cols))
+
+
+def electrode_distances(n_rows=GRID_ROWS, n_cols=GRID_COLS):
+    """Returns: np.ndarray, (nCh, nCh) euclidean distances in pitch units"""
+    positions = electrode_positions(n_rows, n_cols)
+    deltas = positions[:, None, :] - positions[None, :, :]
+    return np.sqrt((deltas**2).sum(axis=2))
+
+
+def electrode_neighbors(
+    radius=DEFAULT_NEIGHBOR_RADIUS, n_rows=GRID_ROWS, n_cols=GRID_COLS
+):
+    """
+    Precomputes the adjacency index of the electrode grid. Row ch lists the
+    channels within radius of channel ch, starting with ch itself and then by
+    distance. Electrodes at the edge of the grid have fewer neighbors, so
+    rows are padded with -1 to the length of the longest row.
+    Params:
+        radius: float, neighborhood radius in electrode pitch units,
+            1 for the 4 nearest, 1.5 for the 8 surrounding electrodes
+    Returns:
+        np.ndarray, (nCh, max_neighbors) int array of neighbor channels
+    """
+    distances = electrode_distances(n_rows, n_cols)
+    n_channels = distances.shape[0]
+    # stable sort by distance keeps ties in channel order, self is first
+    order = np.argsort(distances, axis=1, kind="stable")
+    sorted_distances = np.take_along_axis(distances, order, axis=1)
+    within = sorted_distances <= radius + 1e-9
+    max_neighbors = within.sum(axis=1).max()
+    neighbors = np.where(within, order, -1)[:, :max_neighbors]
+    return neighbors.reshape(n_channels, max_neighbors)
@@ -0,0 +1,134 @@
+# Change detection of exports
+#
+# An export cache is a JSON file written next to the exports. It records the
+# size, modification time and content hash of every input file and the
+# export parameters. Before an export the inputs are checked against the
+# cache: files with the same size and mtime keep their recorded hash without
+# being read, so an unchanged export is detected with a few stat calls.
+# Files that were touched are hashed again, and the export is still skipped
+# if their content did not change. The cache is written after an export
+# finished, so an interrupted export is never skipped.
+
+from os import path
+import hashlib
+import json
+import os
+
+EXPORT_CACHE_VERSION = 1
+HASH_BLOCK_BYTES = 2**23  # 8 MB blocks, hashing does not load whole files
+
+
+def file_hash(file_path):
+    """BLAKE2b hex digest of the content of a file, read in blocks"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, "rb") as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_BYTES), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_signature(file_path, previous=None):
+    """
+    Size, mtime and hash of a file, None if it does not exist. The hash of
+    previous is reused when the size and mtime are unchanged.
+    """
+    if file_path is None or not path.exists(file_path):
+        return None
+    stat = os.stat(file_path)
+    signature = {
+        "path": path.abspath(file_path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    if (
+        previous
+        and previous.get("size") == stat.st_size
+        and previous.get("mtime_ns") == stat.st_mtime_ns
+    ):
+        signature["hash"] = previous["hash"]
+    else:
+        signature["hash"] = file_hash(file_path)
+    return signature
+
+
+def read_export_cache(cache_path):
+    """Returns the cache dict, or None if there is no readable cache"""
+    try:
+        with open(cache_path, "r") as file:
+            cache = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if cache.get("version") != EXPORT_CACHE_VERSION:
+        return None
+    return cache
+
+
+def _content(signatures):
+    return {
+        name: None if sig is None else (sig["size"], sig["hash"])
+        for name, sig in signatures.items()
+    }
+
+
+def check_export_cache(cache_path, inputs, params, outputs=()):
+    """
+    Compares the inputs and parameters of an export with its cache.
+    Params:
+        cache_path: str, the JSON cache file
+        inputs: dict, name to path of each input file, None for an absent
+            optional input
+        params: dict, JSON serializable export parameters
+        outputs: list of paths that must exist for the export to be current
+    Returns:
+        current: bool, True if the export can be skipped
+        cache: dict, the cache of these inputs, see write_export_cache()
+    """
+    previous = read_export_cache(cache_path) or {}
+    previous_inputs = previous.get("inputs", {})
+    signatures = {
+        name: file_signature(file_path, previous_inputs.get(name))
+        for name, file_path in inputs.items()
+    }
+    cache = {
+        "version": EXPORT_CACHE_VERSION,
+        "inputs": signatures,
+        "params": json.loads(json.dumps(params)),
+        "outputs": [path.abspath(output) for output in outputs],
+        "summary": previous.get("summary"),
+    }
+    current = (
+        bool(previous)
+        and previous.get("params") == cache["params"]
+        and _content(previous_inputs) == _content(signatures)
+        and all(path.exists(output) for output in outputs)
+    )
+    if current and previous_inputs != signatures:
+        # touched but unchanged inputs, record the new mtimes so the next
+        # check does not hash them again
+        write_export_cache(cache_path, cache)
+    return current, cache
+
+
+def write_export_cache(cache_path, cache, summary=None):
+    """
+    Writes the cache returned by check_export_cache() after the export
+    finished. summary is an optional JSON serializable result of the export,
+    returned by later skipped exports.
+    """
+    if summary is not None:
+        cache = dict(cache, summary=summary)
+    temp_path = cache_path + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(cache, file, indent=2)
+    os.replace(temp_path, cache_path)
+    return cache_path
+
+
+def phy_inputs(phy_paths, med64_bin_path=None):
+    """input files of an export of a PHY sort, see check_export_cache()"""
+    return {
+        "spike_times": phy_paths.spike_times,
+        "spike_clusters": phy_paths.spk_clust,
+        "cluster_info": phy_paths.clust_info,
+        "med64_bin": med64_bin_path,
+    }
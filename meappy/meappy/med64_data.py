@@ -12,6 +12,8 @@ import seaborn as sns
 import scipy.io
 from scipy import signal, stats
 
+from meappy.spike_trains import SpikeTrains
+
 # constants
 bins_per_sec = 1000  # make 1000 for 1Hz analysis
 lag_bins = 5
@@ -164,12 +166,8 @@ def plot_expt_histo(timestamps, tx_times, bin_sec):
 def get_array_from_ts(timestamps, ts_index_max=None):
     if not ts_index_max:
         ts_index_max = int(timestamps.max() * bins_per_sec) + 1
-    ts_array = np.zeros(ts_index_max)
-    ts_event_indices = (timestamps * bins_per_sec).astype(int)
-
-    for i in ts_event_indices:
-        ts_array[i] += 1
-    return ts_array
+    ts_event_indices = (np.asarray(timestamps).reshape(-1) * bins_per_sec).astype(int)
+    return np.bincount(ts_event_indices, minlength=ts_index_max).astype(float)
 
 
 def autocorr(timestamps):
@@ -217,7 +215,7 @@ def make_grid_array(num_units):
 def hist_subplot(
     units_data, unit, tx_times, bin_sec, row, col, axs1, axs2, nrows, ncols
 ):
-    timestamps = units_data[unit]["timestamps"]
+    timestamps = SpikeTrains.from_dict(units_data)[unit]
 
     num_ts = timestamps.shape[0]
     bins = get_hist_bins(timestamps, bin_sec)
@@ -260,6 +258,8 @@ def plot_hist_grid(units_data, tx_times, bin_sec, num_units):
     grid_array = make_grid_array(num_units)
     nrows, ncols = grid_array.shape
 
+    spike_trains = SpikeTrains.from_dict(units_data)  # grouped once for all plots
+
     fig, axs1 = plt.subplots(
         *grid_array.shape, sharex="all", figsize=(ncols * 4, nrows * 3)
     )
@@ -269,7 +269,7 @@ def plot_hist_grid(units_data, tx_times, bin_sec, num_units):
         for col, unit in enumerate(cols):
             if not (unit == 0 and col != 0):
                 hist_subplot(
-                    units_data,
+                    spike_trains,
                     unit,
                     tx_times,
                     bin_sec,
@@ -295,8 +295,9 @@ def plot_autocorr_grid(units_data, num_units):
     :param num_units: optional. number of units to plot. default is all
     :return: None, displays matplotlib plot
     """
+    spike_trains = SpikeTrains.from_dict(units_data)
     if not num_units:
-        num_units = len(units_data.keys())
+        num_units = len(spike_trains)
 
     grid_array = make_grid_array(num_units)
     nrows, ncols = grid_array.shape
@@ -310,9 +311,7 @@ def plot_autocorr_grid(units_data, num_units):
     for row, cols in enumerate(grid_array):
         for col, unit in enumerate(cols):
             if not (unit == 0 and col != 0):
-                lag_bins_ms, autocorrs_units[unit] = autocorr(
-                    units_data[unit]["timestamps"]
-                )
+                lag_bins_ms, autocorrs_units[unit] = autocorr(spike_trains[unit])
                 axs[row, col].bar(lag_bins_ms, autocorrs_units[unit])
                 axs[row, col].set_title("Unit # " + str(unit))
             if row == (nrows - 1):
@@ -323,8 +322,9 @@ def plot_autocorr_grid(units_data, num_units):
 
 
 def plot_crosscorr_grid(units_data, reference_unit, num_units):
+    spike_trains = SpikeTrains.from_dict(units_data)
     if not num_units:
-        num_units = len(units_data.keys())
+        num_units = len(spike_trains)
     grid_array = make_grid_array(num_units)
     nrows, ncols = grid_array.shape
 
@@ -338,8 +338,7 @@ def plot_crosscorr_grid(units_data, reference_unit, num_units):
         for col, unit in enumerate(cols):
             if not (unit == 0 and col != 0):
                 lag_bins_ms, crosscorrs_units[unit] = crosscorr(
-                    units_data[reference_unit]["timestamps"],
-                    units_data[unit]["timestamps"],
+                    spike_trains[reference_unit], spike_trains[unit]
                 )
                 axs[row, col].bar(lag_bins_ms, crosscorrs_units[unit])
                 axs[row, col].set_title("Unit # " + str(unit))
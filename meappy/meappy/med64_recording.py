@@ -0,0 +1,274 @@
+# Memory-mapped access to raw MED64 modat.bin recordings
+
+import os
+from os import path
+from collections import namedtuple
+import numpy as np
+
+from meappy.waveform import Fs, nCh
+
+DEFAULT_CHUNK_SEC = 10  # duration of streamed blocks of raw data
+CHANNEL_MAJOR_SUFFIX = ".chmajor.bin"  # replaces .bin of the modat.bin file
+
+
+class RawChunk(namedtuple("RawChunk", ["start", "stop", "offset", "data"])):
+    """
+    A block of raw data yielded by Med64Recording.iter_chunks().
+    start and stop are the absolute sample numbers of the block proper.
+    data is a (nCh, num_samples) array that also holds the overlap samples
+    on each side, with offset being the absolute sample number of data[:, 0].
+    """
+
+    __slots__ = ()
+
+    @property
+    def core(self):
+        """Returns the view of data without the overlap samples"""
+        return self.data[:, (self.start - self.offset) : (self.stop - self.offset)]
+
+
+class Med64Recording:
+    """
+    Read-only memory map of a raw MED64 modat.bin recording.
+
+    The modat.bin file is int16 samples interleaved by channel, so sample t of
+    channel ch is stored at position (t * nCh + ch). The `data` attribute is a
+    zero-copy (nCh, n_samples) view of the file, equivalent to the matrix
+    returned by get_raw_data(), but only the samples that are indexed get paged
+    in from disk.
+
+    A channel major file (see write_channel_major()) stores all samples of
+    channel 0, then all of channel 1, etc. In that layout each channel is
+    contiguous on disk and `data` is the memory map itself.
+
+    Params:
+        bin_path: str, path to the modat.bin file
+        n_channels: int, number of recording electrode channels
+        fs: int, sample frequency Hz
+        dtype: numpy dtype of the samples in the file
+        channel_major: bool, True if the file is channel contiguous instead of
+            sample interleaved
+        source_path: str, modat.bin file the data comes from, default bin_path.
+            Names of derived files are made from it, so they are the same
+            whether the modat.bin file or its channel major file is mapped.
+    """
+
+    def __init__(
+        self,
+        bin_path,
+        n_channels=nCh,
+        fs=Fs,
+        dtype=np.int16,
+        channel_major=False,
+        source_path=None,
+    ):
+        self.bin_path = bin_path
+        self.source_path = bin_path if source_path is None else source_path
+        self.n_channels = n_channels
+        self.fs = fs
+        self.dtype = np.dtype(dtype)
+        self.channel_major = channel_major
+
+        file_size = path.getsize(bin_path)
+        frame_size = self.dtype.itemsize * n_channels
+        if file_size % frame_size:
+            raise ValueError(
+                f"File size {file_size} of {bin_path} is not a multiple of "
+                f"{n_channels} channels of {self.dtype.name} samples"
+            )
+        self.n_samples = file_size // frame_size
+
+        if channel_major:
+            shape = (n_channels, self.n_samples)
+        else:
+            shape = (self.n_samples, n_channels)
+        if self.n_samples:
+            self._memmap = np.memmap(bin_path, dtype=self.dtype, mode="r", shape=shape)
+        else:
+            self._memmap = np.zeros(shape, dtype=self.dtype)
+
+        if channel_major:
+            self.data = self._memmap
+        else:
+            # transpose of the (n_samples, nCh) C ordered map is a (nCh, n_samples)
+            # view with the same memory layout as reshape(..., order="F")
+            self.data = self._memmap.T
+
+    def __reduce__(self):
+        # re-open the memory map by path instead of pickling the samples
+        return (
+            self.__class__,
+            (
+                self.bin_path,
+                self.n_channels,
+                self.fs,
+                self.dtype,
+                self.channel_major,
+                self.source_path,
+            ),
+        )
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}('{self.bin_path}', "
+            f"n_channels={self.n_channels}, n_samples={self.n_samples})"
+        )
+
+    def __len__(self):
+        return self.n_channels
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def duration_sec(self):
+        return self.n_samples / self.fs
+
+    def channel(self, ch, start=None, stop=None):
+        """
+        Returns a zero-copy view of the samples of a single channel
+        between the sample numbers start and stop.
+        """
+        return self.data[ch, start:stop]
+
+    def get_samples(self, start=None, stop=None, channels=None):
+        """
+        Reads the samples between the sample numbers start and stop into memory.
+        Params:
+            start: int, first sample number, default beginning of the recording
+            stop: int, sample number after the last one, default end of the recording
+            channels: list of int, channels to read, default all channels
+        Returns:
+            np.ndarray, (num_channels, num_samples) array of samples
+        """
+        if channels is None:
+            channels = slice(None)
+        return np.ascontiguousarray(self.data[channels, start:stop])
+
+    def chunk_bounds(self, chunk_samples):
+        """
+        Returns a list of (start, stop) sample numbers that split the
+        recording into consecutive blocks of chunk_samples samples.
+        """
+        chunk_samples = int(chunk_samples)
+        if chunk_samples <= 0:
+            raise ValueError(f"chunk_samples must be positive, not {chunk_samples}")
+        starts = range(0, self.n_samples, chunk_samples)
+        return [(start, min(start + chunk_samples, self.n_samples)) for start in starts]
+
+    def iter_chunks(
+        self, chunk_sec=DEFAULT_CHUNK_SEC, overlap_samples=0, chunk_samples=None
+    ):
+        """
+        Generator over the recording in fixed duration blocks, read from disk
+        in one sequential pass, so memory use is bounded by the chunk size.
+        Params:
+            chunk_sec: float, duration of each block in seconds
+            overlap_samples: int, number of extra samples included on each side
+                of a block, truncated at the beginning and end of the recording
+            chunk_samples: int, optional block size in samples, overrides chunk_sec
+        Yields:
+            RawChunk, with the absolute sample numbers of the block and an
+            in-memory (nCh, num_samples) array of the samples
+        """
+        if chunk_samples is None:
+            chunk_samples = int(round(chunk_sec * self.fs))
+        overlap_samples = int(overlap_samples)
+        for start, stop in self.chunk_bounds(chunk_samples):
+            offset = max(start - overlap_samples, 0)
+            end = min(stop + overlap_samples, self.n_samples)
+            yield RawChunk(start, stop, offset, self.get_samples(offset, end))
+
+
+def iter_raw_chunks(
+    med64_bin_path, chunk_sec=DEFAULT_CHUNK_SEC, overlap_samples=0, n_channels=nCh
+):
+    """
+    Opens modat.bin raw med64 physiology file and yields it as consecutive
+    RawChunk blocks of chunk_sec seconds with overlap_samples on each side.
+    See Med64Recording.iter_chunks()
+    """
+    recording = Med64Recording(med64_bin_path, n_channels=n_channels)
+    yield from recording.iter_chunks(chunk_sec, overlap_samples)
+
+
+def channel_major_path(med64_bin_path):
+    """
+    Returns the path of the channel major companion file of a modat.bin file.
+    example: 20211109_15h09m07s.modat.bin -> 20211109_15h09m07s.modat.chmajor.bin
+    """
+    return path.splitext(med64_bin_path)[0] + CHANNEL_MAJOR_SUFFIX
+
+
+def is_channel_major_current(med64_bin_path, sidecar_path=None):
+    """
+    True if the channel major companion file exists, holds the same number of
+    bytes as the modat.bin file and was written after it was last modified.
+    """
+    if sidecar_path is None:
+        sidecar_path = channel_major_path(med64_bin_path)
+    if not path.isfile(sidecar_path):
+        return False
+    raw_stat = os.stat(med64_bin_path)
+    sidecar_stat = os.stat(sidecar_path)
+    return (sidecar_stat.st_size == raw_stat.st_size) and (
+        sidecar_stat.st_mtime >= raw_stat.st_mtime
+    )
+
+
+def write_channel_major(
+    med64_bin_path, sidecar_path=None, chunk_sec=DEFAULT_CHUNK_SEC, n_channels=nCh
+):
+    """
+    One time conversion of a sample interleaved modat.bin file into a channel
+    major companion file, so reading the trace of one channel reads 1/nCh of
+    the bytes. The raw file is read in one sequential pass of chunk_sec blocks.
+    Params:
+        med64_bin_path: str, path to the modat.bin file
+        sidecar_path: str, output path, default from channel_major_path()
+        chunk_sec: float, duration of blocks read from the raw file
+        n_channels: int, number of recording electrode channels
+    Returns:
+        sidecar_path: str, path of the written file
+    """
+    if sidecar_path is None:
+        sidecar_path = channel_major_path(med64_bin_path)
+    recording = Med64Recording(med64_bin_path, n_channels=n_channels)
+
+    # write to a temporary file so an interrupted conversion is never current
+    temp_path = sidecar_path + ".tmp"
+    if recording.n_samples:
+        out = np.memmap(
+            temp_path, dtype=recording.dtype, mode="w+", shape=recording.shape
+        )
+        for chunk in recording.iter_chunks(chunk_sec):
+            out[:, chunk.start : chunk.stop] = chunk.data
+        out.flush()
+        del out
+    else:
+        open(temp_path, "wb").close()
+    os.replace(temp_path, sidecar_path)
+    print(f"Channel major data written to {sidecar_path}")
+    return sidecar_path
+
+
+def open_recording(med64_bin_path, use_channel_major=True, n_channels=nCh, fs=Fs):
+    """
+    Opens a modat.bin file as a Med64Recording. If use_channel_major is True and
+    an up to date channel major companion file exists, that file is mapped
+    instead, which is much faster for reading single channel traces.
+    """
+    sidecar_path = channel_major_path(med64_bin_path)
+    if use_channel_major and is_channel_major_current(med64_bin_path, sidecar_path):
+        return Med64Recording(
+            sidecar_path,
+            n_channels=n_channels,
+            fs=fs,
+            channel_major=True,
+            source_path=med64_bin_path,
+        )
+    return Med64Recording(med64_bin_path, n_channels=n_channels, fs=fs)
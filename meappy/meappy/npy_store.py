@@ -0,0 +1,62 @@
+# Directory of .npy arrays plus a JSON metadata file
+#
+# Every array is a plain .npy file, so it opens with
+# np.load(path, mmap_mode="r") in python and with numpy through reticulate
+# (or any .npy reader) in R. The store is written to a temporary directory
+# that replaces the old store in one rename, so readers never see a
+# partially written store.
+
+import os
+from os import path
+import json
+import shutil
+
+import numpy as np
+
+METADATA_FILE = "metadata.json"
+
+
+def write_npy_store(store_dir, arrays, metadata=None):
+    """
+    Writes each array of a dict as <name>.npy in store_dir together with
+    metadata.json. An existing store at store_dir is replaced.
+    Params:
+        store_dir: str, directory of the store
+        arrays: dict, keys are array names, values are np.ndarray
+        metadata: dict, JSON serializable metadata
+    Returns:
+        store_dir: str
+    """
+    temp_dir = store_dir.rstrip(os.sep) + ".tmp"
+    if path.isdir(temp_dir):
+        shutil.rmtree(temp_dir)
+    os.makedirs(temp_dir)
+    for name, array in arrays.items():
+        np.save(path.join(temp_dir, name + ".npy"), np.ascontiguousarray(array))
+    with open(path.join(temp_dir, METADATA_FILE), "w") as file:
+        json.dump(metadata or {}, file, indent=4)
+
+    if path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    os.replace(temp_dir, store_dir)
+    return store_dir
+
+
+def read_npy_store(store_dir, mmap_mode="r"):
+    """
+    Opens all arrays of a store written by write_npy_store().
+    Params:
+        store_dir: str, directory of the store
+        mmap_mode: str, passed to np.load, None reads the arrays into memory
+    Returns:
+        arrays: dict, keys are array names, values are np.ndarray or np.memmap
+        metadata: dict
+    """
+    with open(path.join(store_dir, METADATA_FILE)) as file:
+        metadata = json.load(file)
+    arrays = dict()
+    for filename in sorted(os.listdir(store_dir)):
+        name, ext = path.splitext(filename)
+        if ext == ".npy":
+            arrays[name] = np.load(path.join(store_dir, filename), mmap_mode=mmap_mode)
+    return arrays, metadata
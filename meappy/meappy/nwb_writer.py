@@ -0,0 +1,472 @@
+# NWB (Neurodata Without Borders) export of sorted MED64 slices
+#
+# Writes the HDF5 layout of an NWB 2 file with h5py, without pynwb:
+#   /units                   Units table, one row per good cluster
+#       id                   PHY cluster ids
+#       spike_times          flat float64 seconds of all units, grouped by unit
+#       spike_times_index    end of each unit in spike_times (ragged column)
+#       electrodes(_index)   row of the electrodes table of each unit
+#       waveform_mean        optional (num_units, num_samples) mean waveforms
+#   /general/extracellular_ephys/electrodes   the 64 MED64 electrodes
+#   /acquisition/ElectricalSeries             optional raw data
+#
+# Spike times are chunked so a unit is one or a few chunks and each mean
+# waveform is one chunk, so reading one unit does not scan the file. The raw
+# data is either linked (an HDF5 external dataset pointing at the modat.bin
+# file, no copy) or copied into a chunked, compressed dataset whose chunks
+# hold one second of a group of channels.
+
+import os
+from os import path
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import uuid
+
+import numpy as np
+import h5py
+
+from meappy.electrode_layout import electrode_positions
+from meappy.med64_recording import DEFAULT_CHUNK_SEC, open_recording
+from meappy.spike_trains import SpikeTrains
+from meappy.waveform import Fs, nCh
+
+NWB_VERSION = "2.5.0"
+NWB_SUFFIX = ".nwb"
+RAW_MODES = ("link", "copy")
+SPIKE_TIMES_CHUNK = 4096  # spikes per chunk of the flat spike_times dataset
+RAW_CHUNK_CHANNELS = 8
+COMPRESSION = "gzip"
+COMPRESSION_LEVEL = 4
+SLICE_ID_TIME_FORMAT = "%Y%m%d_%Hh%Mm%Ss"  # e.g. 20211109_15h09m07s
+
+
+def slice_start_time(slice_id):
+    """Session start time parsed from a slice id, now if it has no time"""
+    try:
+        start = datetime.strptime(slice_id[:18], SLICE_ID_TIME_FORMAT)
+    except ValueError:
+        start = datetime.now()
+    return start.astimezone(timezone.utc).isoformat()
+
+
+def _set_type(obj, neurodata_type, namespace="core", **attrs):
+    obj.attrs["namespace"] = namespace
+    obj.attrs["neurodata_type"] = neurodata_type
+    obj.attrs["object_id"] = str(uuid.uuid4())
+    for key, value in attrs.items():
+        obj.attrs[key] = value
+    return obj
+
+
+def _vector_data(group, name, data, description, **kwargs):
+    dataset = group.create_dataset(name, data=data, **kwargs)
+    return _set_type(dataset, "VectorData", description=description)
+
+
+def _vector_index(group, name, ends, target):
+    dataset = group.create_dataset(name, data=np.asarray(ends, dtype=np.uint64))
+    return _set_type(dataset, "VectorIndex", target=target.ref)
+
+
+def _string_array(strings):
+    return np.array(strings, dtype=h5py.string_dtype())
+
+
+def _write_file_header(nwb, slice_id, description):
+    _set_type(nwb, "NWBFile", nwb_version=NWB_VERSION)
+    start_time = slice_start_time(slice_id)
+    nwb.create_dataset("identifier", data=slice_id)
+    nwb.create_dataset("session_description", data=description)
+    nwb.create_dataset("session_start_time", data=start_time)
+    nwb.create_dataset("timestamps_reference_time", data=start_time)
+    nwb.create_dataset(
+        "file_create_date",
+        data=_string_array([datetime.now(timezone.utc).isoformat()]),
+    )
+    for group in ("acquisition", "analysis", "processing", "stimulus", "general"):
+        nwb.require_group(group)
+    nwb.require_group("stimulus/presentation")
+    nwb.require_group("stimulus/templates")
+
+
+def _write_electrodes(nwb, n_channels):
+    """MED64 device, electrode group and electrodes table, returns the table"""
+    device = _set_type(nwb.create_group("general/devices/MED64"), "Device")
+    device.attrs["description"] = "MED64 8 x 8 multi-electrode array"
+    ecephys = nwb.require_group("general/extracellular_ephys")
+    electrode_group = _set_type(
+        ecephys.create_group("MED64"),
+        "ElectrodeGroup",
+        description="MED64 probe electrodes",
+        location="brain slice",
+    )
+    electrode_group["device"] = h5py.SoftLink(device.name)
+
+    positions = electrode_positions()[:n_channels].astype(float)
+    table = _set_type(
+        ecephys.create_group("electrodes"),
+        "DynamicTable",
+        description="MED64 electrodes, x and y are grid column and row in "
+        "electrode pitch units",
+        colnames=_string_array(["x", "y", "location", "group", "group_name"]),
+    )
+    ids = table.create_dataset("id", data=np.arange(n_channels, dtype=np.int64))
+    _set_type(ids, "ElementIdentifiers")
+    _vector_data(table, "x", positions[:, 1], "grid column of the electrode")
+    _vector_data(table, "y", positions[:, 0], "grid row of the electrode")
+    _vector_data(
+        table, "location", _string_array(["brain slice"] * n_channels), "location"
+    )
+    _vector_data(
+        table,
+        "group",
+        np.array([electrode_group.ref] * n_channels, dtype=h5py.ref_dtype),
+        "electrode group of the electrode",
+    )
+    _vector_data(
+        table, "group_name", _string_array(["MED64"] * n_channels), "group name"
+    )
+    return table
+
+
+def _write_units(
+    nwb,
+    spike_trains,
+    unit_channels,
+    electrodes,
+    fs,
+    mean_waves=None,
+    volts_per_count=None,
+):
+    """
+    Units table with ragged spike times, chunked so one unit is read with
+    one or a few chunks. Mean waveforms of raw samples are scaled to volts
+    with volts_per_count.
+    """
+    units = _set_type(
+        nwb.create_group("units"),
+        "Units",
+        description="good clusters of the PHY spike sorting",
+    )
+    colnames = ["spike_times", "electrodes"]
+    cluster_ids = np.asarray(spike_trains.unit_ids, dtype=np.int64)
+    ids = units.create_dataset("id", data=cluster_ids)
+    _set_type(ids, "ElementIdentifiers")
+
+    spike_times = np.asarray(spike_trains.times, dtype=np.float64) / fs
+    chunk = (int(min(max(len(spike_times), 1), SPIKE_TIMES_CHUNK)),)
+    times = _vector_data(
+        units,
+        "spike_times",
+        spike_times,
+        "spike times in seconds",
+        chunks=chunk,
+        compression=COMPRESSION,
+        compression_opts=COMPRESSION_LEVEL,
+    )
+    times.attrs["resolution"] = 1 / fs
+    _vector_index(units, "spike_times_index", spike_trains.offsets[1:], times)
+
+    region = units.create_dataset(
+        "electrodes", data=np.asarray(unit_channels, dtype=np.int64)
+    )
+    _set_type(
+        region,
+        "DynamicTableRegion",
+        description="electrode of each unit",
+        table=electrodes.ref,
+    )
+    _vector_index(units, "electrodes_index", np.arange(1, len(cluster_ids) + 1), region)
+
+    if mean_waves is not None:
+        mean_waves = np.asarray(mean_waves, dtype=np.float64) * volts_per_count
+        mean_waves = mean_waves.astype(np.float32)
+        _vector_data(
+            units,
+            "waveform_mean",
+            mean_waves,
+            "mean raw waveform of each unit on its electrode",
+            chunks=(1, mean_waves.shape[1]) if len(mean_waves) else None,
+        )
+        units["waveform_mean"].attrs["sampling_rate"] = float(fs)
+        units["waveform_mean"].attrs["unit"] = "volts"
+        colnames.append("waveform_mean")
+    units.attrs["colnames"] = _string_array(colnames)
+    return units
+
+
+def _write_raw(
+    nwb,
+    med64_bin_path,
+    electrodes,
+    fs,
+    n_channels,
+    raw_mode,
+    chunk_sec,
+    volts_per_count=None,
+):
+    series = _set_type(
+        nwb.create_group("acquisition/ElectricalSeries"),
+        "ElectricalSeries",
+        description=f"raw MED64 data of {path.basename(med64_bin_path)}",
+        comments="int16 samples, (num_samples, num_channels)",
+    )
+    num_samples = path.getsize(med64_bin_path) // (2 * n_channels)
+    shape = (num_samples, n_channels)
+    if raw_mode == "link":
+        data = series.create_dataset(
+            "data",
+            shape=shape,
+            dtype=np.int16,
+            external=[(path.abspath(med64_bin_path), 0, num_samples * n_channels * 2)],
+        )
+    else:
+        chunks = (
+            min(int(fs), max(num_samples, 1)),
+            min(RAW_CHUNK_CHANNELS, n_channels),
+        )
+        data = series.create_dataset(
+            "data",
+            shape=shape,
+            dtype=np.int16,
+            chunks=chunks if num_samples else None,
+            compression=COMPRESSION if num_samples else None,
+            compression_opts=COMPRESSION_LEVEL if num_samples else None,
+            shuffle=bool(num_samples),
+        )
+        recording = open_recording(
+            med64_bin_path, use_channel_major=False, n_channels=n_channels, fs=fs
+        )
+        for raw_chunk in recording.iter_chunks(chunk_sec):
+            data[raw_chunk.start : raw_chunk.stop] = raw_chunk.data.T
+    # NWB data in volts is data * conversion + offset
+    data.attrs["conversion"] = float(volts_per_count)
+    data.attrs["resolution"] = -1.0
+    data.attrs["offset"] = 0.0
+    data.attrs["unit"] = "volts"
+
+    starting_time = series.create_dataset("starting_time", data=0.0)
+    starting_time.attrs["rate"] = float(fs)
+    starting_time.attrs["unit"] = "seconds"
+    region = series.create_dataset(
+        "electrodes", data=np.arange(n_channels, dtype=np.int64)
+    )
+    _set_type(
+        region, "DynamicTableRegion", description="all electrodes", table=electrodes.ref
+    )
+    return series
+
+
+@contextmanager
+def _replacing_file(nwb_path):
+    """
+    HDF5 file written next to nwb_path that replaces it when complete, and
+    is removed if the writing fails
+    """
+    temp_path = nwb_path + ".tmp"
+    try:
+        with h5py.File(temp_path, "w") as nwb:
+            yield nwb
+    except BaseException:
+        if path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, nwb_path)
+
+
+def _copy_objects(source, target, skip=()):
+    """
+    Copies the objects of an HDF5 file, except the top level ones in skip,
+    into another file. Object references are not valid in the copies, they
+    are set again to the copies of the objects they referenced.
+    """
+    for key, value in source.attrs.items():
+        target.attrs[key] = value
+    for name in source:
+        if name not in skip:
+            source.copy(source[name], target, name=name)
+
+    def copy_of(ref):
+        return target[source[ref].name].ref if ref else ref
+
+    def relink(name, obj):
+        if name.split("/")[0] in skip:
+            return
+        copy = target[name]
+        for key, value in obj.attrs.items():
+            if isinstance(value, h5py.Reference):
+                copy.attrs[key] = copy_of(value)
+        if isinstance(obj, h5py.Dataset) and h5py.check_ref_dtype(obj.dtype):
+            refs = [copy_of(ref) for ref in obj[()].ravel()]
+            copy[()] = np.array(refs, dtype=h5py.ref_dtype).reshape(obj.shape)
+
+    source.visititems(relink)
+
+
+def _check_gain(volts_per_count, mean_waves=None, med64_bin_path=None):
+    """NWB voltages are in volts, raw samples need the gain of the MED64"""
+    if volts_per_count is None and (
+        mean_waves is not None or med64_bin_path is not None
+    ):
+        raise ValueError(
+            "volts_per_count, the MED64 gain, is required to write raw data "
+            "or mean waveforms"
+        )
+
+
+def _select_units(spike_trains, unit_list, mean_waves=None):
+    """spike trains, electrodes and mean waveforms of the units of unit_list"""
+    unit_list = np.asarray(unit_list, dtype=np.int64).reshape(-1, 2)
+    spike_trains = SpikeTrains.from_dict(spike_trains).select(unit_list[:, 0])
+    channel_of = dict(unit_list.tolist())
+    unit_channels = [channel_of[unit] for unit in spike_trains]
+    waves = None
+    if mean_waves is not None:
+        waves = np.array([mean_waves[unit] for unit in spike_trains])
+    return spike_trains, unit_channels, waves
+
+
+def nwb_path_of(export_path, slice_id):
+    """
+    Returns the NWB file path of a slice in an export directory.
+    example: (/export, 20211109_15h09m07s) -> /export/20211109_15h09m07s.nwb
+    """
+    return path.join(export_path, slice_id + NWB_SUFFIX)
+
+
+def write_nwb(
+    nwb_path,
+    spike_trains,
+    unit_list,
+    slice_id,
+    mean_waves=None,
+    med64_bin_path=None,
+    raw_mode="link",
+    fs=Fs,
+    n_channels=nCh,
+    description="MED64 slice recording sorted with PHY",
+    chunk_sec=DEFAULT_CHUNK_SEC,
+    volts_per_count=None,
+):
+    """
+    Writes an NWB file of the sorted units of a slice.
+    Params:
+        nwb_path: str, output .nwb path
+        spike_trains: SpikeTrains (or dict) of spike sample numbers per cluster
+        unit_list: array of (cluster_id, ch) pairs, units written to the file
+        slice_id: str, e.g. 20211109_15h09m07s, the NWB identifier
+        mean_waves: dict, optional mean waveform of each cluster, e.g. the
+            means of accumulate_unit_waveforms() (waveform_stats.py)
+        med64_bin_path: str, optional modat.bin file added as raw data
+        raw_mode: str, 'link' references the modat.bin file as an external
+            dataset, 'copy' writes a chunked, gzip compressed copy
+        fs: sample frequency in Hz
+        n_channels: number of electrodes
+        volts_per_count: float, gain of the MED64 amplifier and ADC in volts
+            per raw sample count, required with mean_waves or med64_bin_path.
+            The raw data is stored in counts with the gain as its conversion
+            and the mean waveforms are stored in volts
+    Returns:
+        nwb_path: str
+    """
+    if raw_mode not in RAW_MODES:
+        raise ValueError(f"Unknown raw_mode {raw_mode}, use one of {RAW_MODES}")
+    _check_gain(volts_per_count, mean_waves, med64_bin_path)
+    spike_trains, unit_channels, waves = _select_units(
+        spike_trains, unit_list, mean_waves
+    )
+
+    with _replacing_file(nwb_path) as nwb:
+        _write_file_header(nwb, slice_id, description)
+        electrodes = _write_electrodes(nwb, n_channels)
+        _write_units(
+            nwb, spike_trains, unit_channels, electrodes, fs, waves, volts_per_count
+        )
+        if med64_bin_path is not None:
+            _write_raw(
+                nwb,
+                med64_bin_path,
+                electrodes,
+                fs,
+                n_channels,
+                raw_mode,
+                chunk_sec,
+                volts_per_count,
+            )
+    print(f"NWB file written to {nwb_path}")
+    return nwb_path
+
+
+def patch_nwb_units(
+    nwb_path,
+    spike_trains,
+    unit_list,
+    mean_waves=None,
+    fs=Fs,
+    volts_per_count=None,
+):
+    """
+    Replaces the units table of an NWB file written by write_nwb(), e.g.
+    after a curation edit. The other objects are copied as they are into a
+    new file that replaces the old one when complete, so the raw data is not
+    read or compressed again and the file does not grow with each edit.
+    Params:
+        nwb_path: str, existing .nwb file
+        spike_trains, unit_list, mean_waves, fs, volts_per_count: see
+            write_nwb(), volts_per_count must be the one the file was
+            written with
+    Returns:
+        nwb_path: str
+    """
+    _check_gain(volts_per_count, mean_waves)
+    spike_trains, unit_channels, waves = _select_units(
+        spike_trains, unit_list, mean_waves
+    )
+
+    with h5py.File(nwb_path, "r") as source, _replacing_file(nwb_path) as nwb:
+        _copy_objects(source, nwb, skip=("units",))
+        electrodes = nwb["general/extracellular_ephys/electrodes"]
+        _write_units(
+            nwb, spike_trains, unit_channels, electrodes, fs, waves, volts_per_count
+        )
+    print(f"NWB units of {nwb_path} updated")
+    return nwb_path
+
+
+def read_nwb_unit(nwb_path, cluster_id):
+    """
+    Reads one unit of an NWB file written by write_nwb(), touching only the
+    chunks of that unit.
+    Returns:
+        dict with 'spike_times' (seconds), 'electrode' and, if present,
+        'waveform_mean'
+    """
+    with h5py.File(nwb_path, "r") as nwb:
+        units = nwb["units"]
+        rows = np.flatnonzero(units["id"][:] == cluster_id)
+        if not rows.size:
+            raise ValueError(f"Cluster {cluster_id} is not in {nwb_path}")
+        row = int(rows[0])
+        stop = int(units["spike_times_index"][row])
+        start = int(units["spike_times_index"][row - 1]) if row else 0
+        unit = {
+            "spike_times": units["spike_times"][start:stop],
+            "electrode": int(units["electrodes"][row]),
+        }
+        if "waveform_mean" in units:
+            unit["waveform_mean"] = units["waveform_mean"][row]
+    return unit
+
+
+def read_nwb_mean_waves(nwb_path):
+    """
+    Mean waveforms of an NWB file written by write_nwb(), as a dict of
+    cluster id to mean waveform, None if the file has none.
+    """
+    if not path.exists(nwb_path):
+        return None
+    with h5py.File(nwb_path, "r") as nwb:
+        units = nwb["units"]
+        if "waveform_mean" not in units:
+            return None
+        return dict(zip(units["id"][:].tolist(), units["waveform_mean"][:]))
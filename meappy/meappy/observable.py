@@ -29,6 +29,7 @@ MAX_D3_ROWS = 10000 # local constant used in num_new_points()
 
 
 from med64_data import *
+from meappy.spike_trains import SpikeTrains
 
 
 def find_better_expt_files(data_dir):
@@ -68,18 +69,15 @@ def mean_firing_rates(units_data, tx_times):
     get firing rate of a units in Hz
     depricated
     """
-    num_units = len(units_data)
+    spike_trains = SpikeTrains.from_dict(units_data)
+    num_units = len(spike_trains)
     start_time_sec = list(tx_times.values())[0]
     end_time_sec = list(tx_times.values())[-1]
     duration_s = end_time_sec - start_time_sec
     
-    mean_firing_rate_hz = dict()
-    all_unit_activity_count = 0
-    for (id, data) in units_data.items():
-        timestamps = data['timestamps']
-        activity_count = timestamps.shape[0]
-        mean_firing_rate_hz[id] = activity_count / duration_s
-        all_unit_activity_count += activity_count
+    mean_firing_rate_hz = dict(zip(spike_trains.unit_ids.tolist(),
+                                   spike_trains.counts / duration_s))
+    all_unit_activity_count = len(spike_trains.times)
         
     all_unit_mean_fr_hz = all_unit_activity_count / duration_s / num_units
     return all_unit_mean_fr_hz, mean_firing_rate_hz
@@ -92,15 +90,12 @@ def get_mean_firing_by_tx(units_data, tx_times):
     """
     tx_range = get_tx_ranges(tx_times)
     tx_mean_firing_rate_hz = dict()
-    for tx in tx_range.keys():
-        tx_mean_firing_rate_hz[tx] = {}
-    for (unit_id, data) in units_data.items():
-        for (tx, [start_time, end_time]) in tx_range.items():
-            timestamps = data['timestamps']
-            duration = end_time - start_time
-            activity_count = [ts for ts in units_data[unit_id]['timestamps'] if 
-                 (ts > start_time) and (ts < end_time)]
-            tx_mean_firing_rate_hz[tx][unit_id] = len(activity_count)/duration
+    spike_trains = SpikeTrains.from_dict(units_data)
+    unit_ids = spike_trains.unit_ids.tolist()
+    for (tx, [start_time, end_time]) in tx_range.items():
+        duration = end_time - start_time
+        activity_count = spike_trains.count_in_range(start_time, end_time)
+        tx_mean_firing_rate_hz[tx] = dict(zip(unit_ids, activity_count / duration))
     return tx_mean_firing_rate_hz
 
 
@@ -196,19 +191,11 @@ def build_df(units_data, tx_times):
     time_begin = partial(get_timestamp_begin, tx_range = tx_range)
     time_end = partial(get_timestamp_end, tx_range = tx_range)
 
-    df = None
-    # for loop over units
-    for unit_id in list(units_data.keys()):
-        timestamps = units_data[unit_id]['timestamps']
-
-        unit_df = pd.DataFrame(timestamps, columns=['timestamp'])
-        unit_df['unit'] = unit_id
-        if isinstance(df, pd.DataFrame):
-            df = df.append(unit_df, ignore_index=True)
-        else:
-            df = unit_df
+    # all units at once, spikes are grouped by unit
+    spike_trains = SpikeTrains.from_dict(units_data)
+    df = pd.DataFrame({'timestamp': spike_trains.times,
+                       'unit': spike_trains.spike_units})
     
-    # end loop over units
     df['tx'] = df['timestamp'].map(lambda x: time_tx(x))
     df['begin'] = df['timestamp'].map(lambda x: time_begin(x))
     df['end'] = df['timestamp'].map(lambda x: time_end(x))
@@ -31,6 +31,8 @@ from collections.abc import Iterable
 from med64_data import read_slice_filepaths, read_tx_file
 from phy_2_nwb import load_spiketime_clust_arr
 from meappy.parameter_yaml import USER, USER_PATHS
+from meappy.spike_trains import SpikeTrains
+from meappy.spike_store import is_spike_store_current, read_spike_store, spike_store_path
 
 from matplotlib import cm
 cmap = cm.get_cmap('tab20')
@@ -46,18 +48,15 @@ def mean_firing_rates(units_data, tx_times):
     get firing rate of a units in Hz
     depricated
     """
-    num_units = len(units_data)
+    spike_trains = SpikeTrains.from_dict(units_data)
+    num_units = len(spike_trains)
     start_time_sec = list(tx_times.values())[0]
     end_time_sec = list(tx_times.values())[-1]
     duration_s = end_time_sec - start_time_sec
     
-    mean_firing_rate_hz = dict()
-    all_unit_activity_count = 0
-    for (id, data) in units_data.items():
-        timestamps = data['timestamps']
-        activity_count = timestamps.shape[0]
-        mean_firing_rate_hz[id] = activity_count / duration_s
-        all_unit_activity_count += activity_count
+    mean_firing_rate_hz = dict(zip(spike_trains.unit_ids.tolist(),
+                                   spike_trains.counts / duration_s))
+    all_unit_activity_count = len(spike_trains.times)
         
     all_unit_mean_fr_hz = all_unit_activity_count / duration_s / num_units
     return all_unit_mean_fr_hz, mean_firing_rate_hz
@@ -71,15 +70,12 @@ def get_mean_firing_by_tx(units_data, tx_times):
     tx_range = get_tx_ranges(tx_times)
     print(f"tx_range: {tx_range},   tx_times {tx_times}")
     tx_mean_firing_rate_hz = dict()
-    for tx in tx_range.keys():
-        tx_mean_firing_rate_hz[tx] = {}
-    for (unit_id, data) in units_data.items():
-        for (tx, [start_time, end_time]) in tx_range.items():
-            timestamps = data['timestamps']
-            duration = end_time - start_time
-            activity_count = [ts for ts in units_data[unit_id]['timestamps'] if 
-                 (ts > start_time) and (ts < end_time)]
-            tx_mean_firing_rate_hz[tx][unit_id] = len(activity_count)/duration
+    spike_trains = SpikeTrains.from_dict(units_data)
+    unit_ids = spike_trains.unit_ids.tolist()
+    for (tx, [start_time, end_time]) in tx_range.items():
+        duration = end_time - start_time
+        activity_count = spike_trains.count_in_range(start_time, end_time)
+        tx_mean_firing_rate_hz[tx] = dict(zip(unit_ids, activity_count / duration))
     print(f"tx_mean_firing_rate_hz: {tx_mean_firing_rate_hz.keys()}")
     return tx_mean_firing_rate_hz
 
@@ -102,11 +98,16 @@ def get_firing_rate_df(df_d3, mean_firing_by_tx):
 def get_nwb_data(unit_filename, tx_filename):
     """
     This reads new nwb file types using load_spiketime_clust_arr 
-    from phy_2_nwb module
+    from phy_2_nwb module. When the binary spike store written next to the
+    units_ts.tsv file is up to date, it is read instead of the TSV.
     """
     print(f"get_nwb_data with file: {unit_filename}")
-    units_data = load_spiketime_clust_arr(unit_filename)
-    units_data = units_data_nwb_2_mat_format(units_data)
+    if is_spike_store_current(unit_filename):
+        units_data, _ = read_spike_store(spike_store_path(unit_filename),
+                                         return_seconds=True)
+    else:
+        spiketimes, clusts = load_spiketime_clust_arr(unit_filename)
+        units_data = SpikeTrains.from_spikes(spiketimes, clusts)
     tx_times = read_tx_file(tx_filename)
     print(f"get_nwb_data tx_times are: {tx_times}")
     return units_data, tx_times
@@ -178,16 +179,13 @@ def units_data_nwb_2_mat_format(units_data):
     """
     Many functions in this code were originally written to take .mat
     formatted data. So this converts the NWB from PHY spike time data
-    and reformats it as this code expects.
+    and reformats it as this code expects. The functions of this module
+    also take the SpikeTrains of get_nwb_data() directly.
     """
+    spike_trains = SpikeTrains.from_spikes(units_data[0], units_data[1])
     nwb_data = dict()
-    ts_array = units_data[0]
-    id_array = units_data[1]
-    for unit_id in np.unique(id_array):
-        ts_index_array = np.where(id_array == unit_id)
-        timestamps = ts_array[ts_index_array]
-        nwb_data[unit_id] = {'timestamps': "test", 'waveform': None}
-        nwb_data[unit_id]['timestamps'] = timestamps
+    for unit_id, timestamps in spike_trains.items():
+        nwb_data[unit_id] = {'timestamps': timestamps, 'waveform': None}
     return nwb_data
 
 
@@ -241,19 +239,11 @@ def build_df(units_data, tx_times):
 
 
 
-    df = None
-    # for loop over units
-    for unit_id in list(units_data.keys()):
-        timestamps = units_data[unit_id]['timestamps']
-
-        unit_df = pd.DataFrame(timestamps, columns=['timestamp'])
-        unit_df['unit'] = unit_id
-        if isinstance(df, pd.DataFrame):
-            df = df.append(unit_df, ignore_index=True)
-        else:
-            df = unit_df
+    # all units at once, spikes are grouped by unit
+    spike_trains = SpikeTrains.from_dict(units_data)
+    df = pd.DataFrame({'timestamp': spike_trains.times,
+                       'unit': spike_trains.spike_units})
     
-    # end loop over units
     df['tx'] = df['timestamp'].map(lambda x: time_tx(x))
     df['begin'] = df['timestamp'].map(lambda x: time_begin(x))
     df['end'] = df['timestamp'].map(lambda x: time_end(x))
@@ -2,6 +2,16 @@ import os, shutil, csv
 import numpy as np
 from scipy.io import savemat
 
+from meappy.curation_diff import (curation_diff, curation_snapshot_path,
+                                  is_curation_edit, patch_unit_dict,
+                                  read_curation_snapshot, write_curation_snapshot)
+from meappy.export_cache import (check_export_cache, phy_inputs, read_export_cache,
+                                 write_export_cache)
+from meappy.nwb_writer import (nwb_path_of, patch_nwb_units, read_nwb_mean_waves,
+                               write_nwb)
+from meappy.spike_store import patch_spike_store, spike_store_path, write_spike_store
+from meappy.waveform_stats import accumulate_unit_waveforms
+
 try:
     from waveform import (Fs, PhyPaths, PhyData, get_raw_data, 
                           get_phy_spikes_list, get_raw_phy_spike_waves)
@@ -13,6 +23,10 @@ except:
                            f'get_raw_data, get_phy_spikes_list, get_raw_phy_spike_waves)')
     exec(waveform_import_str)
         
+NWB_WAVE_WIDTH = 121  # samples of the mean waveforms written to the NWB file
+NWB_WAVE_PRE_SAMPLES = 30
+EXPORT_CACHE_FILE = 'phy_2_nwb_cache.json'  # change detection, see export_cache.py
+
 
 def write_int_array_to_tsv(filepath, data_array):
     """ Writes to a TSV file a two dimensional array as integers
@@ -53,7 +67,7 @@ def filter_good_clusters(phy_spike_data, phy_spk_clust_data, good_clust_ids, ret
         samples_to_seconds = 1 / Fs  # 20kHz sampling Frequency
         phy_spike_data = phy_spike_data * samples_to_seconds
         
-    good_clust_index = np.in1d(phy_spk_clust_data, good_clust_ids)
+    good_clust_index = np.isin(phy_spk_clust_data, good_clust_ids)
     
     good_spiketimess = phy_spike_data[good_clust_index].reshape(-1, 1)
     good_clusts = phy_spk_clust_data[good_clust_index].reshape(-1, 1)
@@ -113,12 +127,11 @@ def read_tx_file(tx_filename):
     return tx_times
 
 
-def extract_phy_data(phy_dir):
-    phy_paths = PhyPaths(phy_dir)
-    phy_data = PhyData(phy_paths)
+def extract_phy_data(phy_dir, phy_data=None):
+    if phy_data is None:
+        phy_data = PhyData(PhyPaths(phy_dir))
     
-    good_clust = phy_data.clust_info['group'] == 'good'  # not contain !='noise' 'NaN'
-    clust_chan = phy_data.clust_info[good_clust][['cluster_id', 'ch']].to_numpy()  
+    clust_chan = phy_data.good_clust_chan()  # group == 'good', not 'noise' or NaN
     
     good_clust_ids = clust_chan[:,0]
     spiketime_clust = filter_good_clusters(phy_data.spike_times, phy_data.spk_clust, 
@@ -126,37 +139,124 @@ def extract_phy_data(phy_dir):
     return spiketime_clust, clust_chan
 
 
-def main(phy_dir, med64_bin_path=None, export_path=None):
+def main(phy_dir, med64_bin_path=None, export_path=None, raw_mode='link',
+         slice_id=None, force=False, volts_per_count=None):
     """
-    Using data transformed from PHY to TSV tab seperated values formatted data.
+    Using data transformed from PHY to TSV tab seperated values formatted data
+    and to an NWB file.
     Takes one, two or three positional arguments.
     Params:
         phy_dir: str, The directory path of the PHY formatted spike sorter output
-        med64_bin_path: str, Path with filename of raw med64 modat data
+        med64_bin_path: str, Path with filename of raw med64 modat data, adds
+            mean waveforms and the raw data to the NWB file
         export_filename: str, filename used to export to tsv files into phy_dir
+        raw_mode: str, 'link' or 'copy' the raw data into the NWB file
+        slice_id: str, default the PHY directory name up to the first '.'
+        force: bool, export even if the PHY files, raw data and parameters
+            did not change since the last export, and export all units
+            after a curation edit
+        volts_per_count: float, MED64 gain in volts per raw sample count,
+            required with med64_bin_path, see nwb_writer.write_nwb()
+    Returns:
+        dict, summary of the export: slice_id, n_spikes, n_good_clusters,
+        nwb_path and cached, True if the export was skipped
     """
+    if med64_bin_path is not None and volts_per_count is None:
+        raise ValueError('volts_per_count, the MED64 gain, is required with the '
+                         'raw data')
     # set filepaths
     print(f'PHY data directory name is \n\t{phy_dir}')
     phy_paths = PhyPaths(phy_dir)
     phy_data = PhyData(phy_paths)
     
-    if med64_bin_path is not None:
-        print("Waveform export not yet implimented for TSV format")
-    
     if export_path is None:
-        export_path = phy_data
+        export_path = phy_dir
     print(f'Files exported to directory: \n\t{export_path}')
-        
-    # get and format data
-    spiketime_clust, clust_chan = extract_phy_data(phy_dir)
+    if slice_id is None:
+        slice_id = os.path.basename(os.path.normpath(phy_dir)).split('.')[0]
 
     # write array  unit_electrode units_ts
     clust_chan_filepath = os.path.join(export_path, "unit_electrode.tsv")
     spiketime_clust_filepath = os.path.join(export_path, "units_ts.tsv")
-    
+    nwb_path = nwb_path_of(export_path, slice_id)
+
+    # skip the export if nothing changed since the last one
+    cache_path = os.path.join(export_path, EXPORT_CACHE_FILE)
+    params = {'slice_id': slice_id, 'Fs': Fs, 'raw_mode': raw_mode,
+              'nwb_wave_width': NWB_WAVE_WIDTH,
+              'nwb_wave_pre_samples': NWB_WAVE_PRE_SAMPLES,
+              'volts_per_count': volts_per_count}
+    outputs = [clust_chan_filepath, spiketime_clust_filepath, nwb_path,
+               spike_store_path(spiketime_clust_filepath)]
+    previous_cache = read_export_cache(cache_path)
+    is_current, cache = check_export_cache(
+        cache_path, phy_inputs(phy_paths, med64_bin_path), params, outputs)
+    if is_current and not force and cache['summary'] is not None:
+        print('PHY data unchanged since the last export, skipped')
+        return dict(cache['summary'], cached=True)
+
+    # get and format data
+    spiketime_clust, clust_chan = extract_phy_data(phy_dir, phy_data)
+
+    # after a curation edit only the created and changed units are exported,
+    # the others are copied from the last export, see curation_diff.py
+    diff = None
+    snapshot_path = curation_snapshot_path(export_path, slice_id, 'nwb')
+    old_spike_clusters, old_unit_list = read_curation_snapshot(snapshot_path)
+    if (not force and old_unit_list is not None and os.path.exists(nwb_path)
+            and is_curation_edit(previous_cache, cache)):
+        diff = curation_diff(old_spike_clusters, phy_data.spk_clust,
+                             old_unit_list, clust_chan)
+        print(f'Curation edit since the last export: {diff}')
+
     write_int_array_to_tsv(clust_chan_filepath, clust_chan)
     write_float_int_array_to_tsv(spiketime_clust_filepath, spiketime_clust)
 
+    # exact sample numbers of the same spikes, memory mappable
+    good_spikes = np.isin(phy_data.spk_clust, clust_chan[:, 0])
+    spike_store_dir = spike_store_path(spiketime_clust_filepath)
+    spike_store_metadata = {'slice_id': slice_id, 'phy_dir': phy_dir}
+    if diff is not None and os.path.exists(spike_store_dir):
+        patch_spike_store(spike_store_dir, phy_data.spike_times,
+                          phy_data.spk_clust, diff, spike_store_metadata)
+    else:
+        write_spike_store(spike_store_dir, phy_data.spike_times[good_spikes],
+                          phy_data.spk_clust[good_spikes],
+                          metadata=spike_store_metadata, fs=Fs)
+
+    # NWB file, with mean waveforms and raw data when the recording is given
+    mean_waves = None
+    if med64_bin_path is not None:
+        previous_waves = dict()
+        wave_units = clust_chan
+        if diff is not None:
+            # the NWB mean waveforms are in volts, the new ones in counts
+            previous_waves = {
+                unit: wave.astype(np.float64) / volts_per_count
+                for unit, wave in (read_nwb_mean_waves(nwb_path) or dict()).items()}
+            wave_units = clust_chan[np.isin(clust_chan[:, 0], diff.recompute) |
+                                    ~np.isin(clust_chan[:, 0], list(previous_waves))]
+        accumulators = accumulate_unit_waveforms(
+            get_raw_data(med64_bin_path, mmap=True), phy_data.spike_trains,
+            wave_units, NWB_WAVE_WIDTH, NWB_WAVE_PRE_SAMPLES)
+        mean_waves = patch_unit_dict(
+            previous_waves, {unit: acc.mean for unit, acc in accumulators.items()},
+            clust_chan[:, 0])
+    if diff is not None:
+        # only the units table changed, the raw data is not written again
+        patch_nwb_units(nwb_path, phy_data.spike_trains, clust_chan,
+                        mean_waves=mean_waves, fs=Fs, volts_per_count=volts_per_count)
+    else:
+        write_nwb(nwb_path, phy_data.spike_trains, clust_chan, slice_id,
+                  mean_waves=mean_waves, med64_bin_path=med64_bin_path,
+                  raw_mode=raw_mode, fs=Fs, volts_per_count=volts_per_count)
+    summary = {'slice_id': slice_id, 'n_spikes': int(good_spikes.sum()),
+               'n_good_clusters': len(clust_chan), 'nwb_path': nwb_path}
+    write_curation_snapshot(snapshot_path, phy_data.spk_clust, clust_chan,
+                            metadata={'slice_id': slice_id})
+    write_export_cache(cache_path, cache, summary)
+    return dict(summary, cached=False)
+
     
 if __name__ == '__main__':
     """
@@ -167,21 +267,29 @@ if __name__ == '__main__':
         Arg 1: str, PHY data directory path
         Arg 2: str, optional, Raw modat.bin data file path
         Arg 3: str, optional, Export file path. Default is PHY dir path
+        --force: optional flag, export even if nothing changed
+        --volts_per_count <gain>: MED64 gain in volts per raw sample count,
+            required with the raw data file
     """
     import sys, argparse
 
-    user_paths = USER_PATHS[USER]
-    export_path = user_paths['phy_export']
-    
+    force = '--force' in sys.argv
+    sys.argv = [arg for arg in sys.argv if arg != '--force']
+    volts_per_count = None
+    if '--volts_per_count' in sys.argv:
+        gain_index = sys.argv.index('--volts_per_count')
+        volts_per_count = float(sys.argv[gain_index + 1])
+        del sys.argv[gain_index:gain_index + 2]
+
     if len(sys.argv) < 2:
         raise ValueError('Missing PHY data directory path required first parameter')
     phy_dir = sys.argv[1]
-    if len(sys.argv) >= 3:
-        med64_bin_path = sys.argv[2]
-    if len(sys.argv) == 3:
-        main(phy_dir, med64_bin_path=med64_bin_path)
     if len(sys.argv) >= 4:
-        export_path = sys.argv[3]
-        main(phy_dir, med64_bin_path=med64_bin_path, export_path=export_path)
+        main(phy_dir, med64_bin_path=sys.argv[2], export_path=sys.argv[3],
+             force=force, volts_per_count=volts_per_count)
+    elif len(sys.argv) == 3:
+        main(phy_dir, med64_bin_path=sys.argv[2], force=force,
+             volts_per_count=volts_per_count)
     else:
-        main(phy_dir, export_path=export_path)
+        user_paths = USER_PATHS[USER]
+        main(phy_dir, export_path=user_paths['phy_export'], force=force)
@@ -0,0 +1,244 @@
+# Batch conversion of the PHY sorts of a whole protocol
+#
+# Every slice of a protocol directory has a slice_parameters.yaml file (see
+# parameter_yaml.py). Slices with a PHY directory (*.GUI) next to their
+# slice_parameters.yaml, or in its PHY subdirectory, are converted with
+# phy_2_nwb.main() in a pool of worker processes, one slice per task. A
+# slice that fails is recorded in the manifest with its error and does not
+# stop the other slices.
+#
+# usage:
+# python phy_batch.py --workers 4 /path/to/experiment/VTA_NMDA
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from glob import glob
+from os import path
+import argparse
+import os
+import time
+import traceback
+
+import pandas as pd
+import yaml
+
+from meappy.phy_2_nwb import main as phy_2_nwb_main
+
+SLICE_PARAMS_FILE = "slice_parameters.yaml"
+PHY_DIR_PATTERN = "*.GUI"
+PHY_SUBDIR = "PHY"  # <slice>/PHY/<id>.modat.GUI, see the waveform export --phy_dir
+RAW_FILE_PATTERN = "*.modat.bin"
+MANIFEST_FILE = "phy_2_nwb_manifest.tsv"
+MANIFEST_COLUMNS = [
+    "slice_id",
+    "status",
+    "n_spikes",
+    "n_good_clusters",
+    "elapsed_sec",
+    "nwb_path",
+    "phy_dir",
+    "error",
+]
+
+SliceJob = namedtuple(
+    "SliceJob", ["slice_id", "slice_dir", "phy_dir", "med64_bin_path"]
+)
+
+
+def _first_match(slice_dir, pattern, slice_id):
+    """first file matching pattern, preferring names starting with slice_id"""
+    matches = sorted(glob(path.join(slice_dir, pattern)))
+    preferred = [m for m in matches if path.basename(m).startswith(slice_id)]
+    return (preferred or matches or [None])[0]
+
+
+def find_protocol_slices(protocol_dir):
+    """
+    Finds the slices of a protocol directory from their slice_parameters.yaml
+    files, searched recursively. The PHY directory of a slice is searched
+    next to the file, then in its PHY subdirectory.
+    Returns:
+        list of SliceJob, sorted by slice directory. phy_dir is None for a
+        slice that is not sorted yet, med64_bin_path is None without raw data
+    """
+    params_files = glob(
+        path.join(protocol_dir, "**", SLICE_PARAMS_FILE), recursive=True
+    )
+    jobs = []
+    for params_file in sorted(params_files):
+        slice_dir = path.dirname(params_file)
+        with open(params_file, "r") as file:
+            slice_params = yaml.safe_load(file) or {}
+        slice_id = str((slice_params.get("paths") or {}).get("slice") or "").strip("/")
+        if not slice_id:
+            slice_id = path.basename(path.normpath(slice_dir))
+        jobs.append(
+            SliceJob(
+                slice_id,
+                slice_dir,
+                _first_match(slice_dir, PHY_DIR_PATTERN, slice_id)
+                or _first_match(
+                    path.join(slice_dir, PHY_SUBDIR), PHY_DIR_PATTERN, slice_id
+                ),
+                _first_match(slice_dir, RAW_FILE_PATTERN, slice_id),
+            )
+        )
+    return jobs
+
+
+def convert_slice(
+    job,
+    export_root=None,
+    include_raw=False,
+    raw_mode="link",
+    force=False,
+    volts_per_count=None,
+):
+    """
+    Converts one slice with phy_2_nwb.main(), run in a worker process.
+    Errors are caught and returned, so one slice cannot stop a batch.
+    Params:
+        job: SliceJob
+        export_root: str, exports go to export_root/<slice_id>, default the
+            PHY directory
+        include_raw: bool, add mean waveforms and the raw data to the NWB file
+        raw_mode: str, 'link' or 'copy', see nwb_writer.write_nwb()
+        force: bool, export slices that did not change since their last export
+        volts_per_count: float, MED64 gain, see nwb_writer.write_nwb()
+    Returns:
+        dict, one manifest row, status 'cached' if the export was skipped
+    """
+    row = {"slice_id": job.slice_id, "phy_dir": job.phy_dir, "status": "ok"}
+    start = time.perf_counter()
+    try:
+        export_path = None
+        if export_root is not None:
+            export_path = path.join(export_root, job.slice_id)
+            os.makedirs(export_path, exist_ok=True)
+        med64_bin_path = job.med64_bin_path if include_raw else None
+        row.update(
+            phy_2_nwb_main(
+                job.phy_dir,
+                med64_bin_path=med64_bin_path,
+                export_path=export_path,
+                raw_mode=raw_mode,
+                slice_id=job.slice_id,
+                force=force,
+                volts_per_count=volts_per_count,
+            )
+        )
+        if row.pop("cached"):
+            row["status"] = "cached"
+    except Exception as error:
+        traceback.print_exc()
+        row["status"] = "error"
+        row["error"] = f"{type(error).__name__}: {error}"
+    row["elapsed_sec"] = round(time.perf_counter() - start, 3)
+    return row
+
+
+def run_protocol(
+    protocol_dir,
+    workers=None,
+    export_root=None,
+    include_raw=False,
+    raw_mode="link",
+    manifest_path=None,
+    force=False,
+    volts_per_count=None,
+):
+    """
+    Converts every sorted slice of a protocol in parallel and writes a
+    manifest of the conversion of each slice.
+    Params:
+        protocol_dir: str, directory searched for slice_parameters.yaml files
+        workers: int, number of worker processes, default the number of CPUs.
+            With 1 the slices are converted in this process
+        export_root, include_raw, raw_mode, force, volts_per_count: see
+            convert_slice()
+        manifest_path: str, default protocol_dir/phy_2_nwb_manifest.tsv
+    Returns:
+        pd.DataFrame, the manifest, one row per slice
+    """
+    jobs = find_protocol_slices(protocol_dir)
+    rows = [
+        {"slice_id": job.slice_id, "status": "unsorted"}
+        for job in jobs
+        if job.phy_dir is None
+    ]
+    sorted_jobs = [job for job in jobs if job.phy_dir is not None]
+    print(f"{len(sorted_jobs)} of {len(jobs)} slices sorted in {protocol_dir}")
+    options = (export_root, include_raw, raw_mode, force, volts_per_count)
+
+    if workers == 1:
+        rows += [convert_slice(job, *options) for job in sorted_jobs]
+    elif sorted_jobs:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(convert_slice, job, *options): job for job in sorted_jobs
+            }
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    row = future.result()
+                except Exception as error:  # e.g. a worker process was killed
+                    row = {
+                        "slice_id": job.slice_id,
+                        "phy_dir": job.phy_dir,
+                        "status": "error",
+                        "error": f"{type(error).__name__}: {error}",
+                    }
+                print(f"{row['slice_id']}: {row['status']}")
+                rows.append(row)
+
+    manifest = pd.DataFrame(rows, columns=MANIFEST_COLUMNS)
+    manifest = manifest.sort_values("slice_id", ignore_index=True)
+    if manifest_path is None:
+        manifest_path = path.join(protocol_dir, MANIFEST_FILE)
+    manifest.to_csv(manifest_path, sep="\t", index=False)
+    n_errors = (manifest["status"] == "error").sum()
+    print(f"Manifest written to {manifest_path}, {n_errors} slices failed")
+    return manifest
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PHY to NWB conversion of a protocol")
+    parser.add_argument(dest="protocol_dir", action="store")
+    parser.add_argument(
+        "--workers", action="store", dest="workers", type=int, default=None
+    )
+    parser.add_argument("--export_root", action="store", dest="export_root")
+    parser.add_argument(
+        "--raw",
+        action="store_true",
+        dest="include_raw",
+        help="add mean waveforms and the modat.bin raw data to the NWB files",
+    )
+    parser.add_argument("--raw_mode", action="store", dest="raw_mode", default="link")
+    parser.add_argument("--manifest", action="store", dest="manifest_path")
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        dest="force",
+        help="convert slices whose PHY files did not change since their last export",
+    )
+    parser.add_argument(
+        "--volts_per_count",
+        action="store",
+        dest="volts_per_count",
+        type=float,
+        default=None,
+        help="MED64 gain in volts per raw sample count, required with --raw",
+    )
+    args = parser.parse_args()
+
+    run_protocol(
+        args.protocol_dir,
+        workers=args.workers,
+        export_root=args.export_root,
+        include_raw=args.include_raw,
+        raw_mode=args.raw_mode,
+        manifest_path=args.manifest_path,
+        force=args.force,
+        volts_per_count=args.volts_per_count,
+    )
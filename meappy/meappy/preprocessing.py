@@ -0,0 +1,289 @@
+# Streaming preprocessing of raw MED64 recordings
+#
+# Stages read the recording in chunks (see Med64Recording.iter_chunks()) and
+# write float32 output with the same sample interleaved layout as modat.bin,
+# so the output opens as a Med64Recording and can be used anywhere the
+# get_raw_data() matrix is used.
+
+import os
+from os import path
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import signal
+
+from meappy.waveform import Fs, nCh
+from meappy.med64_recording import DEFAULT_CHUNK_SEC, Med64Recording, open_recording
+
+FILTERED_SUFFIX = ".filtered.bin"  # replaces .bin of the modat.bin file
+# replace .bin of the modat.bin file, common median (CMR) or average (CAR) reference
+REFERENCED_SUFFIXES = {"median": ".cmr.bin", "mean": ".car.bin"}
+REFERENCE_METHODS = tuple(REFERENCED_SUFFIXES)
+FILTERED_DTYPE = np.float32
+
+# band pass defaults, Spyking Circus uses a 300 Hz high pass butterworth filter
+BANDPASS_LOW_HZ = 300
+BANDPASS_HIGH_HZ = 6000
+BANDPASS_ORDER = 3
+ZERO_PHASE_PAD_SEC = 0.1  # overlap on each side of a chunk for zero phase filtering
+
+
+def filtered_path(med64_bin_path, suffix=FILTERED_SUFFIX):
+    """
+    Returns the default path of the filtered output of a modat.bin file.
+    example: 20211109_15h09m07s.modat.bin -> 20211109_15h09m07s.modat.filtered.bin
+    """
+    return path.splitext(med64_bin_path)[0] + suffix
+
+
+def open_filtered_recording(filtered_bin_path, n_channels=nCh, fs=Fs):
+    """Opens the float32 output of a preprocessing stage as a Med64Recording"""
+    return Med64Recording(
+        filtered_bin_path, n_channels=n_channels, fs=fs, dtype=FILTERED_DTYPE
+    )
+
+
+def common_reference(block, method="median", bad_channels=None, out=None):
+    """
+    Subtracts the per sample median or mean across channels from every channel
+    of a (nCh, num_samples) block. Channels in bad_channels are not used to
+    compute the reference, but the reference is still subtracted from them.
+    Params:
+        block: np.ndarray, (nCh, num_samples) samples
+        method: str, 'median' (common median reference) or 'mean' (common
+            average reference)
+        bad_channels: list of int, channels excluded from the reference
+        out: np.ndarray, optional float32 or float64 array for the result
+    Returns:
+        np.ndarray, the re-referenced block
+    """
+    if method not in REFERENCE_METHODS:
+        raise ValueError(f"Unknown reference {method}, use one of {REFERENCE_METHODS}")
+    good = np.ones(block.shape[0], dtype=bool)
+    if bad_channels is not None:
+        good[list(bad_channels)] = False
+    if not good.any():
+        raise ValueError("All channels are excluded from the reference")
+
+    reference_channels = block[good] if not good.all() else block
+    if method == "median":
+        reference = np.median(reference_channels, axis=0)
+    else:
+        reference = np.mean(reference_channels, axis=0, dtype=np.float64)
+    if out is None:
+        out = np.empty(block.shape, dtype=np.result_type(block.dtype, np.float32))
+    np.subtract(block, reference[None, :], out=out, casting="unsafe")
+    return out
+
+
+def rereference_recording(
+    recording,
+    out_path=None,
+    method="median",
+    bad_channels=None,
+    chunk_sec=DEFAULT_CHUNK_SEC,
+):
+    """
+    Common median or common average re-referencing of a recording in one
+    sequential pass of chunks. Only one float32 chunk is held in memory at a
+    time and the result is written to a memory mapped file.
+    Params:
+        recording: Med64Recording (raw or filtered) or str path of a modat.bin file
+        out_path: str, output path, default from filtered_path() of the
+            recording's source_path with the REFERENCED_SUFFIXES suffix of the
+            method, .cmr.bin or .car.bin
+        method: str, 'median' or 'mean', see common_reference()
+        bad_channels: list of int, channels excluded from the reference
+        chunk_sec: float, duration of the chunks read from disk
+    Returns:
+        Med64Recording, read-only map of the re-referenced output file
+    """
+    if method not in REFERENCE_METHODS:
+        raise ValueError(f"Unknown reference {method}, use one of {REFERENCE_METHODS}")
+    recording = _as_recording(recording)
+    if out_path is None:
+        out_path = filtered_path(recording.source_path, REFERENCED_SUFFIXES[method])
+
+    temp_path = out_path + ".tmp"
+    out = np.memmap(
+        temp_path,
+        dtype=FILTERED_DTYPE,
+        mode="w+",
+        shape=(max(recording.n_samples, 1), recording.n_channels),
+    )
+    for chunk in recording.iter_chunks(chunk_sec):
+        referenced = common_reference(chunk.data, method, bad_channels)
+        out[chunk.start : chunk.stop] = referenced.T
+    out.flush()
+    del out
+    if not recording.n_samples:
+        open(temp_path, "wb").close()
+    os.replace(temp_path, out_path)
+    print(f"Re-referenced data written to {out_path}")
+    return open_filtered_recording(out_path, recording.n_channels, recording.fs)
+
+
+def design_bandpass(
+    low_hz=BANDPASS_LOW_HZ, high_hz=BANDPASS_HIGH_HZ, order=BANDPASS_ORDER, fs=Fs
+):
+    """
+    Returns the second order sections of a butterworth band pass filter.
+    If high_hz is None, the filter is a high pass filter at low_hz.
+    """
+    if high_hz is None:
+        return signal.butter(order, low_hz, btype="highpass", fs=fs, output="sos")
+    return signal.butter(
+        order, [low_hz, high_hz], btype="bandpass", fs=fs, output="sos"
+    )
+
+
+def _as_recording(recording):
+    if isinstance(recording, str):
+        return open_recording(recording)
+    return recording
+
+
+def _channel_groups(n_channels, n_threads):
+    return [g for g in np.array_split(np.arange(n_channels), n_threads) if g.size]
+
+
+def _sosfilt_channels(sos, block, zi, channels):
+    """Causal filter of a group of channels, returns (filtered, final state)"""
+    return signal.sosfilt(sos, block[channels], axis=-1, zi=zi[:, channels])
+
+
+def _sosfiltfilt_channels(sos, block, channels):
+    """Zero phase filter of a group of channels"""
+    # default scipy padding, shortened for the last chunk of a recording
+    padlen = min(3 * (2 * len(sos) + 1), block.shape[-1] - 1)
+    return signal.sosfiltfilt(sos, block[channels], axis=-1, padlen=padlen)
+
+
+class StreamingFilter:
+    """
+    Causal IIR filter of (nCh, num_samples) blocks that carries the filter
+    state of every channel from one block to the next, so filtering a
+    recording block by block gives the same result as filtering it at once.
+    Channels are split into groups filtered in a thread pool.
+
+    Params:
+        sos: np.ndarray, second order sections, see design_bandpass()
+        n_channels: int, number of channels in each block
+        n_threads: int, number of threads, default number of CPUs
+    """
+
+    def __init__(self, sos, n_channels=nCh, n_threads=None):
+        self.sos = sos
+        self.n_channels = n_channels
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self.groups = _channel_groups(n_channels, self.n_threads)
+        self.zi = None
+
+    def reset(self, first_samples):
+        """
+        Sets the filter state to the steady state of each channel's first
+        sample, which avoids the startup transient of the int16 DC offset.
+        """
+        zi = signal.sosfilt_zi(self.sos)  # (n_sections, 2)
+        self.zi = zi[:, None, :] * np.asarray(first_samples, float)[None, :, None]
+
+    def filter(self, block, executor=None):
+        """Filters the next block, returns the float64 filtered block"""
+        block = np.asarray(block, dtype=np.float64)
+        if self.zi is None:
+            self.reset(block[:, 0])
+        if executor is None:
+            results = [
+                _sosfilt_channels(self.sos, block, self.zi, channels)
+                for channels in self.groups
+            ]
+        else:
+            futures = [
+                executor.submit(_sosfilt_channels, self.sos, block, self.zi, channels)
+                for channels in self.groups
+            ]
+            results = [future.result() for future in futures]
+        out = np.empty_like(block)
+        zf = np.empty_like(self.zi)
+        for channels, (filtered, group_zf) in zip(self.groups, results):
+            out[channels] = filtered
+            zf[:, channels] = group_zf
+        self.zi = zf
+        return out
+
+
+def bandpass_filter_recording(
+    recording,
+    out_path=None,
+    low_hz=BANDPASS_LOW_HZ,
+    high_hz=BANDPASS_HIGH_HZ,
+    order=BANDPASS_ORDER,
+    zero_phase=False,
+    chunk_sec=DEFAULT_CHUNK_SEC,
+    pad_sec=ZERO_PHASE_PAD_SEC,
+    n_threads=None,
+    reference=None,
+    bad_channels=None,
+):
+    """
+    Band pass filters a recording in one sequential pass of chunks and writes
+    the float32 result to a memory mapped file.
+
+    The default causal filter carries the filter state across chunks, so the
+    output has no discontinuities at chunk boundaries. With zero_phase True
+    each chunk is filtered forward and backward with pad_sec of overlap on
+    each side, which is discarded, so the phase distortion of the causal
+    filter is removed and the chunk boundary error decays below the noise.
+    Params:
+        recording: Med64Recording or str path of a modat.bin file
+        out_path: str, output path, default from filtered_path() of the
+            recording's source_path
+        low_hz, high_hz, order: band pass parameters, see design_bandpass()
+        zero_phase: bool, use forward-backward filtering
+        chunk_sec: float, duration of the chunks read from disk
+        pad_sec: float, zero phase overlap on each side of a chunk
+        n_threads: int, threads used to filter channels in parallel
+        reference: str, optional 'median' or 'mean' common reference applied to
+            the filtered chunks in the same pass, see common_reference()
+        bad_channels: list of int, channels excluded from the reference
+    Returns:
+        Med64Recording, read-only map of the filtered output file
+    """
+    recording = _as_recording(recording)
+    if out_path is None:
+        out_path = filtered_path(recording.source_path)
+    sos = design_bandpass(low_hz, high_hz, order, recording.fs)
+    streaming_filter = StreamingFilter(sos, recording.n_channels, n_threads)
+    pad_samples = int(round(pad_sec * recording.fs)) if zero_phase else 0
+
+    temp_path = out_path + ".tmp"
+    out = np.memmap(
+        temp_path,
+        dtype=FILTERED_DTYPE,
+        mode="w+",
+        shape=(max(recording.n_samples, 1), recording.n_channels),
+    )
+    with ThreadPoolExecutor(max_workers=streaming_filter.n_threads) as executor:
+        for chunk in recording.iter_chunks(chunk_sec, overlap_samples=pad_samples):
+            if zero_phase:
+                futures = [
+                    executor.submit(_sosfiltfilt_channels, sos, chunk.data, channels)
+                    for channels in streaming_filter.groups
+                ]
+                filtered = np.empty(chunk.data.shape)
+                for channels, future in zip(streaming_filter.groups, futures):
+                    filtered[channels] = future.result()
+                core = slice(chunk.start - chunk.offset, chunk.stop - chunk.offset)
+                filtered = filtered[:, core]
+            else:
+                filtered = streaming_filter.filter(chunk.data, executor)
+            if reference is not None:
+                filtered = common_reference(filtered, reference, bad_channels)
+            out[chunk.start : chunk.stop] = filtered.T
+    out.flush()
+    del out
+    if not recording.n_samples:
+        open(temp_path, "wb").close()
+    os.replace(temp_path, out_path)
+    print(f"Filtered data written to {out_path}")
+    return open_filtered_recording(out_path, recording.n_channels, recording.fs)
@@ -0,0 +1,344 @@
+## usage example, compress a raw recording and benchmark it against the raw file:
+# python raw_archive.py --benchmark True /path/to/20211109_15h09m07s.modat.bin
+#
+# Lossless compressed archive of raw MED64 modat.bin data.
+#
+# Archive file layout:
+#   ARCHIVE_MAGIC
+#   compressed blocks, one after another
+#   index, int64 byte offsets of each block plus the end of the last block
+#   metadata, utf-8 JSON
+#   footer, uint64 index offset, uint64 metadata length, ARCHIVE_MAGIC
+#
+# Each block holds block_samples samples of all channels, stored channel major.
+# Samples are delta encoded along time per channel with int16 wrap around
+# arithmetic, so decoding with a wrapping cumulative sum is bit exact.
+
+import os
+from os import path
+import json
+import lzma
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from meappy.waveform import Fs, nCh
+from meappy.med64_recording import Med64Recording
+
+ARCHIVE_MAGIC = b"MED64ARC"
+ARCHIVE_VERSION = 1
+ARCHIVE_SUFFIX = ".archive"  # replaces .bin of the modat.bin file
+CODECS = ("zlib", "lzma")
+DEFAULT_BLOCK_SEC = 1.0
+DEFAULT_CACHE_BLOCKS = 8  # decoded blocks kept in memory by Med64Archive
+
+_FOOTER_DTYPE = np.dtype([("index_offset", "<u8"), ("meta_length", "<u8")])
+
+
+def archive_path_for(med64_bin_path):
+    """
+    Returns the default archive path of a modat.bin file.
+    example: 20211109_15h09m07s.modat.bin -> 20211109_15h09m07s.modat.archive
+    """
+    return path.splitext(med64_bin_path)[0] + ARCHIVE_SUFFIX
+
+
+def delta_encode(block):
+    """
+    Per channel delta encoding of a (nCh, num_samples) int16 block.
+    The first sample of each channel is kept, the rest are differences
+    from the previous sample, wrapping around on int16 overflow.
+    """
+    encoded = np.empty_like(block)
+    encoded[:, :1] = block[:, :1]
+    np.subtract(block[:, 1:], block[:, :-1], out=encoded[:, 1:])
+    return encoded
+
+
+def delta_decode(encoded):
+    """Inverse of delta_encode(), exact for int16 data"""
+    return np.cumsum(encoded, axis=1, dtype=encoded.dtype)
+
+
+def _compress(raw_bytes, codec, level):
+    if codec == "zlib":
+        return zlib.compress(raw_bytes, 6 if level is None else level)
+    if codec == "lzma":
+        return lzma.compress(raw_bytes, preset=(1 if level is None else level))
+    raise ValueError(f"Unknown codec {codec}, use one of {CODECS}")
+
+
+def _decompress(compressed_bytes, codec):
+    if codec == "zlib":
+        return zlib.decompress(compressed_bytes)
+    if codec == "lzma":
+        return lzma.decompress(compressed_bytes)
+    raise ValueError(f"Unknown codec {codec}, use one of {CODECS}")
+
+
+def write_raw_archive(
+    med64_bin_path,
+    archive_path=None,
+    block_sec=DEFAULT_BLOCK_SEC,
+    codec="zlib",
+    level=None,
+    n_channels=nCh,
+    fs=Fs,
+):
+    """
+    Compresses a modat.bin file into a block indexed archive in one
+    sequential pass over the raw data.
+    Params:
+        med64_bin_path: str, path to the modat.bin file
+        archive_path: str, output path, default from archive_path_for()
+        block_sec: float, duration of each compressed block. Smaller blocks
+            make random access cheaper, larger blocks compress better.
+        codec: str, 'zlib' or 'lzma'
+        level: int, compression level (zlib) or preset (lzma)
+    Returns:
+        archive_path: str, path of the written archive
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec}, use one of {CODECS}")
+    if archive_path is None:
+        archive_path = archive_path_for(med64_bin_path)
+    recording = Med64Recording(med64_bin_path, n_channels=n_channels, fs=fs)
+    block_samples = max(int(round(block_sec * fs)), 1)
+
+    offsets = []
+    temp_path = archive_path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(ARCHIVE_MAGIC)
+        for chunk in recording.iter_chunks(chunk_samples=block_samples):
+            offsets.append(file.tell())
+            encoded = delta_encode(chunk.data)
+            file.write(_compress(encoded.tobytes(), codec, level))
+        offsets.append(file.tell())
+
+        index_offset = file.tell()
+        file.write(np.asarray(offsets, dtype="<i8").tobytes())
+        meta = {
+            "version": ARCHIVE_VERSION,
+            "codec": codec,
+            "dtype": recording.dtype.str,
+            "n_channels": n_channels,
+            "n_samples": int(recording.n_samples),
+            "fs": fs,
+            "block_samples": block_samples,
+            "source": path.basename(med64_bin_path),
+        }
+        meta_bytes = json.dumps(meta).encode("utf-8")
+        file.write(meta_bytes)
+        footer = np.array([(index_offset, len(meta_bytes))], dtype=_FOOTER_DTYPE)
+        file.write(footer.tobytes())
+        file.write(ARCHIVE_MAGIC)
+    os.replace(temp_path, archive_path)
+    print(f"Raw data archive written to {archive_path}")
+    return archive_path
+
+
+class Med64Archive:
+    """
+    Random access reader of a compressed modat.bin archive with the same
+    slicing methods as Med64Recording. Only the blocks touched by a query
+    are decompressed, and the most recently decoded blocks are cached.
+
+    Params:
+        archive_path: str, path to an archive written by write_raw_archive()
+        cache_blocks: int, number of decoded blocks kept in memory
+    """
+
+    def __init__(self, archive_path, cache_blocks=DEFAULT_CACHE_BLOCKS):
+        self.archive_path = archive_path
+        self.cache_blocks = cache_blocks
+        self._cache = OrderedDict()
+
+        footer_size = _FOOTER_DTYPE.itemsize + len(ARCHIVE_MAGIC)
+        with open(archive_path, "rb") as file:
+            if file.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+                raise ValueError(f"{archive_path} is not a MED64 raw data archive")
+            file.seek(-footer_size, os.SEEK_END)
+            footer_bytes = file.read(footer_size)
+            if footer_bytes[-len(ARCHIVE_MAGIC) :] != ARCHIVE_MAGIC:
+                raise ValueError(f"{archive_path} is truncated or corrupted")
+            footer = np.frombuffer(
+                footer_bytes[: _FOOTER_DTYPE.itemsize], _FOOTER_DTYPE
+            )
+            index_offset = int(footer["index_offset"][0])
+            meta_length = int(footer["meta_length"][0])
+            meta_offset = path.getsize(archive_path) - footer_size - meta_length
+            file.seek(index_offset)
+            index_bytes = file.read(meta_offset - index_offset)
+            self.meta = json.loads(file.read(meta_length).decode("utf-8"))
+
+        self.offsets = np.frombuffer(index_bytes, dtype="<i8")
+        self.codec = self.meta["codec"]
+        self.dtype = np.dtype(self.meta["dtype"])
+        self.n_channels = self.meta["n_channels"]
+        self.n_samples = self.meta["n_samples"]
+        self.fs = self.meta["fs"]
+        self.block_samples = self.meta["block_samples"]
+        self.n_blocks = len(self.offsets) - 1
+
+    def __repr__(self):
+        return (
+            f"{self.__class__.__name__}('{self.archive_path}', "
+            f"n_channels={self.n_channels}, n_samples={self.n_samples})"
+        )
+
+    def __len__(self):
+        return self.n_channels
+
+    @property
+    def shape(self):
+        return (self.n_channels, self.n_samples)
+
+    @property
+    def duration_sec(self):
+        return self.n_samples / self.fs
+
+    def read_block(self, block_num):
+        """Returns the decoded (nCh, block_samples) array of one block"""
+        if block_num in self._cache:
+            self._cache.move_to_end(block_num)
+            return self._cache[block_num]
+        begin, end = self.offsets[block_num], self.offsets[block_num + 1]
+        with open(self.archive_path, "rb") as file:
+            file.seek(begin)
+            compressed_bytes = file.read(end - begin)
+        encoded = np.frombuffer(_decompress(compressed_bytes, self.codec), self.dtype)
+        block = delta_decode(encoded.reshape(self.n_channels, -1))
+        self._cache[block_num] = block
+        while len(self._cache) > self.cache_blocks:
+            self._cache.popitem(last=False)
+        return block
+
+    def get_samples(self, start=None, stop=None, channels=None):
+        """
+        Decompresses the samples between the sample numbers start and stop.
+        Params:
+            start: int, first sample number, default beginning of the recording
+            stop: int, sample number after the last one, default end of the recording
+            channels: list of int, channels to read, default all channels
+        Returns:
+            np.ndarray, (num_channels, num_samples) array of samples
+        """
+        start, stop, _ = slice(start, stop).indices(self.n_samples)
+        if channels is None:
+            channels = slice(None)
+        num_channels = len(np.arange(self.n_channels)[channels])
+        if stop <= start:
+            return np.empty((num_channels, 0), dtype=self.dtype)
+
+        first_block = start // self.block_samples
+        last_block = (stop - 1) // self.block_samples
+        samples = np.empty((num_channels, stop - start), dtype=self.dtype)
+        for block_num in range(first_block, last_block + 1):
+            block_start = block_num * self.block_samples
+            lo = max(start, block_start)
+            hi = min(stop, block_start + self.block_samples)
+            block = self.read_block(block_num)
+            samples[:, (lo - start) : (hi - start)] = block[
+                channels, (lo - block_start) : (hi - block_start)
+            ]
+        return samples
+
+    def channel(self, ch, start=None, stop=None):
+        """Returns the samples of a single channel between start and stop"""
+        return self.get_samples(start, stop, channels=[ch])[0]
+
+    def __getitem__(self, key):
+        """
+        Supports the same indexing as the get_raw_data() matrix, for example
+        archive[ch, start:stop] or archive[:, start:stop]. archive[ch]
+        decodes the entire channel.
+        """
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        ch_key, sample_key = key
+        if isinstance(sample_key, slice):
+            start, stop, step = sample_key.indices(self.n_samples)
+            return self.get_samples(start, stop)[ch_key, ::step]
+        sample = range(self.n_samples)[sample_key]
+        return self.get_samples(sample, sample + 1)[ch_key, 0]
+
+
+def extract_raw_archive(archive_path, med64_bin_path):
+    """
+    Restores the modat.bin file from an archive, block by block.
+    The restored file is byte identical to the original.
+    """
+    archive = Med64Archive(archive_path)
+    with open(med64_bin_path, "wb") as file:
+        for block_num in range(archive.n_blocks):
+            # modat.bin is sample interleaved, write the transpose of each block
+            file.write(np.ascontiguousarray(archive.read_block(block_num).T).tobytes())
+    print(f"Raw data restored to {med64_bin_path}")
+    return med64_bin_path
+
+
+def benchmark_archive(
+    med64_bin_path, archive_path=None, block_sec=DEFAULT_BLOCK_SEC, codec="zlib"
+):
+    """
+    Compresses a modat.bin file and times compression, full decompression
+    and a direct read of the raw file with np.fromfile.
+    Returns: dict, sizes in bytes, compression ratio and throughputs in MB/s
+        of uncompressed data
+    """
+    raw_bytes = path.getsize(med64_bin_path)
+    raw_mb = raw_bytes / 1e6
+
+    begin = time.perf_counter()
+    with open(med64_bin_path, "rb") as file:
+        bin_data = np.fromfile(file, dtype=np.int16)
+    raw_read_sec = time.perf_counter() - begin
+    del bin_data
+
+    begin = time.perf_counter()
+    archive_path = write_raw_archive(med64_bin_path, archive_path, block_sec, codec)
+    compress_sec = time.perf_counter() - begin
+
+    archive = Med64Archive(archive_path, cache_blocks=0)
+    begin = time.perf_counter()
+    for block_num in range(archive.n_blocks):
+        archive.read_block(block_num)
+    decompress_sec = time.perf_counter() - begin
+
+    archive_bytes = path.getsize(archive_path)
+    return {
+        "codec": codec,
+        "raw_bytes": raw_bytes,
+        "archive_bytes": archive_bytes,
+        "compression_ratio": raw_bytes / archive_bytes,
+        "raw_read_mb_per_sec": raw_mb / raw_read_sec,
+        "compress_mb_per_sec": raw_mb / compress_sec,
+        "decompress_mb_per_sec": raw_mb / decompress_sec,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="modat.bin archive compression")
+    parser.add_argument(dest="med64_bin_path", action="store")
+    parser.add_argument("--archive_path", action="store", dest="archive_path")
+    parser.add_argument("--codec", action="store", dest="codec", default="zlib")
+    parser.add_argument(
+        "--block_sec", action="store", dest="block_sec", type=float, default=1.0
+    )
+    parser.add_argument("--benchmark", action="store", dest="benchmark", default=False)
+    args = parser.parse_args()
+
+    if args.benchmark == "True":
+        results = benchmark_archive(
+            args.med64_bin_path, args.archive_path, args.block_sec, args.codec
+        )
+        for name, value in results.items():
+            print(f"{name}: {value}")
+    else:
+        write_raw_archive(
+            args.med64_bin_path, args.archive_path, args.block_sec, args.codec
+        )
@@ -0,0 +1,113 @@
+# Sub-sample alignment of spike waveforms
+#
+# Phy spike times are whole samples (50 us at 20 kHz), so the waveforms of a
+# unit jitter by up to a sample around the spike time, which smears the mean
+# waveform and its features. All waveforms of a unit are upsampled at once
+# with the FFT, the trough of each is found at the upsampled resolution and
+# refined with a parabola, and every waveform is shifted so its trough falls
+# on the unit's median trough position. The shifts give refined fractional
+# spike times.
+
+import numpy as np
+from scipy import signal
+
+DEFAULT_UPSAMPLE_FACTOR = 8
+DEFAULT_SEARCH_SAMPLES = 10  # trough search, samples on each side of the spike time
+
+
+def upsample_waves(waves, factor=DEFAULT_UPSAMPLE_FACTOR):
+    """
+    FFT upsampling of a (num_spikes, width) array of waveforms. The straight
+    line between the first and last sample of each waveform is removed
+    before the FFT and added back after, so the implied periodic extension
+    of the window has no step at its ends.
+    Returns:
+        (num_spikes, width * factor) array, sample k of the input is at
+        index k * factor of the output
+    """
+    waves = np.atleast_2d(np.asarray(waves, dtype=float))
+    width = waves.shape[1]
+    ramp = np.linspace(0, 1, width)
+    trend = waves[:, :1] + (waves[:, -1:] - waves[:, :1]) * ramp
+    upsampled = signal.resample(waves - trend, width * factor, axis=1)
+    up_ramp = np.arange(width * factor) / (factor * (width - 1))
+    return upsampled + waves[:, :1] + (waves[:, -1:] - waves[:, :1]) * up_ramp
+
+
+def find_troughs(
+    waves,
+    pre_samples,
+    factor=DEFAULT_UPSAMPLE_FACTOR,
+    search_samples=DEFAULT_SEARCH_SAMPLES,
+):
+    """
+    Fractional sample position of the trough of each waveform, searched
+    within search_samples of pre_samples (the spike time).
+    Returns:
+        troughs: np.ndarray, (num_spikes,) trough positions in samples
+        upsampled: np.ndarray, the upsampled waveforms, see upsample_waves()
+    """
+    upsampled = upsample_waves(waves, factor)
+    n_up = upsampled.shape[1]
+    first = max((pre_samples - search_samples) * factor, 1)
+    last = min((pre_samples + search_samples) * factor + 1, n_up - 1)
+    index = first + upsampled[:, first:last].argmin(axis=1)
+
+    # parabola through the minimum and its two neighbors
+    rows = np.arange(len(upsampled))
+    left, center, right = (upsampled[rows, index + d] for d in (-1, 0, 1))
+    curvature = left - 2 * center + right
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vertex = np.where(curvature > 0, 0.5 * (left - right) / curvature, 0.0)
+    return (index + np.clip(vertex, -0.5, 0.5)) / factor, upsampled
+
+
+def shift_upsampled(upsampled, shifts, width, factor=DEFAULT_UPSAMPLE_FACTOR):
+    """
+    Waveforms of width samples read from upsampled waveforms starting at the
+    fractional sample shifts, with linear interpolation between upsampled
+    samples. Positions past the window repeat the edge sample.
+    """
+    positions = (np.arange(width)[None, :] + np.asarray(shifts)[:, None]) * factor
+    positions = np.clip(positions, 0, upsampled.shape[1] - 1)
+    lower = np.floor(positions).astype(int)
+    upper = np.minimum(lower + 1, upsampled.shape[1] - 1)
+    frac = positions - lower
+    rows = np.arange(len(upsampled))[:, None]
+    return (1 - frac) * upsampled[rows, lower] + frac * upsampled[rows, upper]
+
+
+def align_spike_waves(
+    waves,
+    spike_times,
+    pre_samples,
+    factor=DEFAULT_UPSAMPLE_FACTOR,
+    search_samples=DEFAULT_SEARCH_SAMPLES,
+    target=None,
+):
+    """
+    Aligns the waveforms of one unit on their troughs at sub-sample resolution.
+    Params:
+        waves: np.ndarray, (num_spikes, width) waveforms of one unit
+        spike_times: np.ndarray, (num_spikes,) spike times in samples
+        pre_samples: int, samples before the spike time in each waveform
+        factor: int, upsampling factor, the alignment resolution is 1 / factor
+        search_samples: int, trough search half width in samples
+        target: float, trough position of the aligned waveforms, default the
+            median trough position of the unit
+    Returns:
+        aligned: np.ndarray, (num_spikes, width) re-centered waveforms
+        refined_times: np.ndarray, (num_spikes,) float spike times, shifted by
+            the trough offset of each spike from the target
+        target: float, the trough position used
+    """
+    waves = np.atleast_2d(np.asarray(waves, dtype=float))
+    spike_times = np.asarray(spike_times, dtype=float).reshape(-1)
+    if not len(waves):
+        return waves, spike_times, target
+    troughs, upsampled = find_troughs(waves, pre_samples, factor, search_samples)
+    if target is None:
+        target = float(np.median(troughs))
+    shifts = troughs - target
+    aligned = shift_upsampled(upsampled, shifts, waves.shape[1], factor)
+    return aligned, spike_times + shifts, target
@@ -0,0 +1,250 @@
+# Threshold spike detection on raw or filtered MED64 recordings
+#
+# A fast activity screen that does not need a spike sorter: noise of each
+# channel is estimated with the median absolute deviation (MAD), and spikes
+# are the negative going crossings of -threshold * noise, with a dead time
+# after each spike. Chunks of the recording are processed in a process pool,
+# each worker opening the same read-only memory map of the file, and the dead
+# time is applied to the crossings of all chunks at once.
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from meappy.med64_recording import DEFAULT_CHUNK_SEC, open_recording
+from meappy.spike_trains import SpikeTrains
+
+MAD_TO_STD = 1.4826  # MAD of normally distributed noise * MAD_TO_STD = std
+DEFAULT_THRESHOLD = 5.0  # in units of the MAD noise estimate
+DEFAULT_DEAD_TIME_MS = 1.0
+NOISE_CHUNKS = 10  # number of chunks sampled to estimate the noise
+NOISE_CHUNK_SEC = 1.0
+
+
+def _as_recording(recording):
+    if isinstance(recording, str):
+        return open_recording(recording)
+    return recording
+
+
+def _center(block):
+    """Removes the median of each channel, i.e. the DC offset of raw data"""
+    block = block.astype(np.float32)
+    block -= np.median(block, axis=1, keepdims=True)
+    return block
+
+
+def estimate_noise_mad(
+    recording, n_chunks=NOISE_CHUNKS, chunk_sec=NOISE_CHUNK_SEC, channels=None
+):
+    """
+    Estimates the noise of each channel as the scaled median absolute
+    deviation of n_chunks evenly spaced chunks of the recording.
+    Params:
+        recording: Med64Recording or str path of a modat.bin file
+        n_chunks: int, number of chunks read from the recording
+        chunk_sec: float, duration of each chunk
+        channels: list of int, default all channels
+    Returns:
+        np.ndarray, noise standard deviation estimate of each channel
+    """
+    recording = _as_recording(recording)
+    chunk_samples = min(int(round(chunk_sec * recording.fs)), recording.n_samples)
+    last_start = recording.n_samples - chunk_samples
+    starts = np.unique(np.linspace(0, last_start, num=n_chunks).astype(int))
+    blocks = [
+        _center(recording.get_samples(start, start + chunk_samples, channels))
+        for start in starts
+    ]
+    samples = np.hstack(blocks)
+    return MAD_TO_STD * np.median(np.abs(samples), axis=1)
+
+
+def _onsets(block, thresholds):
+    """(samples, channels) of all negative threshold crossings, by channel"""
+    below = block < -np.asarray(thresholds)[:, None]
+    onsets = below[:, 1:] & ~below[:, :-1]
+    channels, samples = np.nonzero(onsets)
+    return samples + 1, channels
+
+
+def apply_dead_time(samples, channels, dead_samples, last_spikes=None):
+    """
+    Keeps a crossing only if it is more than dead_samples after the last
+    kept spike of its channel. Crossings in a chain closer than dead_samples
+    to each other are not merged into the first one, the next spike is kept
+    once the dead time of the last kept spike has passed.
+    A crossing more than dead_samples after the previous crossing is always
+    kept, and one closer to a kept crossing is always dropped, so only
+    chains of three or more close crossings are resolved one by one.
+    Params:
+        samples: np.ndarray, sample of each crossing
+        channels: np.ndarray, channel of each crossing, ordered by channel,
+            then by sample
+        dead_samples: int, refractory dead time in samples
+        last_spikes: dict, optional channel to last kept sample before these
+            crossings, updated in place so it can be carried to the next block
+    Returns:
+        samples, channels of the kept crossings
+    """
+    if last_spikes is None:
+        last_spikes = dict()
+    samples, channels = np.asarray(samples), np.asarray(channels)
+    n = len(samples)
+    if not n:
+        return samples, channels
+    first = np.ones(n, dtype=bool)
+    first[1:] = channels[1:] != channels[:-1]
+    # previous crossing of each crossing, the first crossing of a channel is
+    # compared with the last spike kept before these crossings
+    previous = np.empty(n, dtype=np.int64)
+    previous[1:] = samples[:-1]
+    previous[first] = [
+        last_spikes.get(channel, sample - dead_samples - 1)
+        for channel, sample in zip(channels[first].tolist(), samples[first].tolist())
+    ]
+    close = samples - previous <= dead_samples
+    keep = ~close
+
+    # a close crossing after a dropped one is kept if the last kept spike is
+    # more than dead_samples before it, found by walking the chain
+    after_close = np.zeros(n, dtype=bool)
+    after_close[1:] = close[:-1]
+    chain_starts = close & (first | ~after_close)
+    chained = np.zeros(n, dtype=bool)
+    chained[:-1] = close[1:] & ~first[1:]
+    for start in np.flatnonzero(chain_starts & chained).tolist():
+        last = previous[start]
+        i = start
+        while i < n and close[i] and (i == start or not first[i]):
+            if samples[i] - last > dead_samples:
+                keep[i] = True
+                last = samples[i]
+            i += 1
+
+    samples, channels = samples[keep], channels[keep]
+    last_of_channel = np.ones(len(channels), dtype=bool)
+    last_of_channel[:-1] = channels[1:] != channels[:-1]
+    last_spikes.update(
+        zip(channels[last_of_channel].tolist(), samples[last_of_channel].tolist())
+    )
+    return samples, channels
+
+
+def threshold_crossings(block, thresholds, dead_samples, last_spikes=None):
+    """
+    Finds negative threshold crossings in a (nCh, num_samples) block, with a
+    dead time after each kept spike, see apply_dead_time().
+    Params:
+        block: np.ndarray, (nCh, num_samples) centered samples
+        thresholds: np.ndarray, positive threshold of each channel
+        dead_samples: int, refractory dead time in samples
+        last_spikes: dict, optional last kept sample of each channel, in
+            block sample numbers, see apply_dead_time()
+    Returns:
+        samples: np.ndarray, sample index in the block of each crossing
+        channels: np.ndarray, channel of each crossing
+        Both are ordered by channel, then by sample.
+    """
+    samples, channels = _onsets(block, thresholds)
+    return apply_dead_time(samples, channels, dead_samples, last_spikes)
+
+
+def _detect_chunk(recording, start, stop, thresholds):
+    """
+    Finds all threshold crossings between the sample numbers start and stop,
+    before the dead time is applied. The block read starts one sample
+    earlier, so a crossing at start is found. Returns absolute sample numbers.
+    """
+    offset = max(start - 1, 0)
+    block = _center(recording.get_samples(offset, stop))
+    samples, channels = _onsets(block, thresholds)
+    samples = samples + offset
+    in_chunk = samples >= start
+    return samples[in_chunk], channels[in_chunk]
+
+
+def detect_spikes(
+    recording,
+    threshold=DEFAULT_THRESHOLD,
+    dead_time_ms=DEFAULT_DEAD_TIME_MS,
+    chunk_sec=DEFAULT_CHUNK_SEC,
+    noise=None,
+    n_workers=None,
+):
+    """
+    Threshold spike detection on all channels of a recording.
+    Params:
+        recording: Med64Recording or str path of a modat.bin file. A filtered
+            recording (see preprocessing.py) gives cleaner detection.
+        threshold: float, detection threshold in units of the channel noise
+        dead_time_ms: float, refractory dead time after a spike
+        chunk_sec: float, duration of chunks processed by each worker task
+        noise: np.ndarray, optional per channel noise, default estimate_noise_mad()
+        n_workers: int, number of worker processes, 1 runs in this process
+    Returns:
+        spike_samples: np.ndarray, int64 sample number of each spike
+        spike_channels: np.ndarray, int16 channel of each spike
+        Both are sorted by sample number.
+    """
+    recording = _as_recording(recording)
+    if noise is None:
+        noise = estimate_noise_mad(recording)
+    thresholds = threshold * np.asarray(noise, dtype=np.float32)
+    dead_samples = int(round(dead_time_ms * recording.fs / 1000))
+    chunk_samples = int(round(chunk_sec * recording.fs))
+    bounds = recording.chunk_bounds(chunk_samples) if recording.n_samples else []
+    n_workers = n_workers or os.cpu_count() or 1
+
+    if n_workers == 1 or len(bounds) <= 1:
+        results = [
+            _detect_chunk(recording, start, stop, thresholds) for start, stop in bounds
+        ]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [
+                executor.submit(_detect_chunk, recording, start, stop, thresholds)
+                for start, stop in bounds
+            ]
+            results = [future.result() for future in futures]
+
+    if not results:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int16)
+    spike_samples = np.concatenate([r[0] for r in results]).astype(np.int64)
+    spike_channels = np.concatenate([r[1] for r in results]).astype(np.int16)
+    # the dead time is applied to the crossings of all chunks in one pass, so
+    # the last kept spike of each channel carries across chunk boundaries
+    order = np.lexsort((spike_samples, spike_channels))
+    spike_samples, spike_channels = apply_dead_time(
+        spike_samples[order], spike_channels[order], dead_samples
+    )
+    order = np.argsort(spike_samples, kind="stable")
+    return spike_samples[order], spike_channels[order]
+
+
+def channel_firing_rates(spike_channels, duration_sec, n_channels=None):
+    """
+    Returns the mean detected firing rate in Hz of each channel, a quick
+    screen of which electrodes are active before spike sorting.
+    """
+    if n_channels is None:
+        n_channels = int(spike_channels.max()) + 1 if spike_channels.size else 0
+    counts = np.bincount(spike_channels, minlength=n_channels)
+    return counts / duration_sec
+
+
+def detected_unit_spike_times(spike_samples, spike_channels):
+    """
+    Groups detected spikes by channel, in the format of get_phy_spikes_list()
+    with each channel treated as one unit, so the waveform extraction code
+    can be used without a Phy sort.
+    Returns:
+        unit_spike_times: SpikeTrains, keys are channels, values are spike
+            sample numbers
+        unit_list: np.ndarray, (num_channels, 2) array of (unit, channel) pairs
+    """
+    unit_spike_times = SpikeTrains.from_spikes(spike_samples, spike_channels)
+    channels = unit_spike_times.unit_ids
+    unit_list = np.column_stack((channels, channels)).astype(int)
+    return unit_spike_times, unit_list
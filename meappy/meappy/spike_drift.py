@@ -0,0 +1,216 @@
+# Per-spike amplitudes and drift of units over a recording
+#
+# For every spike of every unit the peak to peak amplitude on its channel and
+# the neighboring electrodes is read with one footprint gather per batch of
+# spikes (see extract_spike_footprints()). The amplitude weighted center of
+# the footprint gives the position of each spike on the 8 x 8 grid. Binning
+# amplitudes and positions over time gives a drift trace of each unit, from
+# which units that drift during long drug-wash protocols are flagged.
+
+import numpy as np
+import pandas as pd
+
+from meappy.electrode_layout import (
+    DEFAULT_NEIGHBOR_RADIUS,
+    electrode_neighbors,
+    electrode_positions,
+)
+from meappy.npy_store import write_npy_store
+from meappy.waveform import Fs, extract_spike_footprints
+
+AMPLITUDE_WINDOW_SAMPLES = 31  # 1.5 ms window around the spike time
+AMPLITUDE_PRE_SAMPLES = 10
+DEFAULT_DRIFT_BIN_SEC = 60.0
+DEFAULT_BATCH_SPIKES = 8192
+DRIFT_AMPLITUDE_THRESHOLD = 0.3  # fraction of the median amplitude
+DRIFT_POSITION_THRESHOLD = 0.5  # electrode pitch units
+MIN_SPIKES_PER_BIN = 10
+DRIFT_SUFFIX = "_drift"
+
+
+def spike_amplitudes(
+    matrix_data,
+    unit_spike_times,
+    unit_list,
+    radius=DEFAULT_NEIGHBOR_RADIUS,
+    width=AMPLITUDE_WINDOW_SAMPLES,
+    pre_samples=AMPLITUDE_PRE_SAMPLES,
+    batch_spikes=DEFAULT_BATCH_SPIKES,
+):
+    """
+    Peak to peak amplitude of every spike on its unit's channel and neighbors.
+    Params:
+        matrix_data: (nCh, N) samples, raw get_raw_data(path, mmap=True) or a
+            filtered Med64Recording .data (see preprocessing.py)
+        unit_spike_times: dict, spike sample numbers of each unit
+        unit_list: array of (cluster_id, ch) pairs
+        radius: float, neighbor radius in electrode pitch units
+        width: int, samples of the window the amplitude is measured in
+        pre_samples: int, samples of the window before the spike time
+        batch_spikes: int, spikes gathered at a time
+    Returns:
+        dict of arrays, with one row per spike grouped by unit in the order
+        of unit_list:
+            'cluster_ids', 'spike_times': (num_spikes,)
+            'unit_index': (num_spikes,) row of the spike's unit in unit_ids
+            'amplitudes': (num_spikes,) amplitude on the unit's channel
+            'footprint_amplitudes': (num_spikes, num_neighbors), NaN padded
+            'positions': (num_spikes, 2) amplitude weighted (row, column)
+        and one row per unit:
+            'unit_ids': (num_units,)
+            'footprint_channels': (num_units, num_neighbors), channels of the
+                footprint columns of the unit's spikes, -1 padded
+    """
+    neighbors = electrode_neighbors(radius)
+    grid = electrode_positions().astype(float)
+    n_neighbors = neighbors.shape[1]
+    columns = {
+        name: []
+        for name in (
+            "cluster_ids",
+            "spike_times",
+            "footprint_amplitudes",
+            "positions",
+        )
+    }
+    unit_ids = np.array([unit for unit, _ in unit_list], dtype=np.int64)
+    footprint_channels = np.empty((len(unit_ids), n_neighbors), dtype=np.int64)
+    for row, (unit, ch) in enumerate(unit_list):
+        spike_times = np.asarray(unit_spike_times[unit]).reshape(-1)
+        channels = neighbors[ch]
+        for start in range(0, len(spike_times), batch_spikes):
+            batch = spike_times[start : start + batch_spikes]
+            footprints, channels, _ = extract_spike_footprints(
+                matrix_data, ch, batch, width, pre_samples, neighbors
+            )
+            footprint_amplitudes = footprints.max(axis=2) - footprints.min(axis=2)
+            weights = np.nan_to_num(footprint_amplitudes)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                positions = (weights @ grid[np.maximum(channels, 0)]) / weights.sum(
+                    axis=1, keepdims=True
+                )
+            columns["footprint_amplitudes"].append(footprint_amplitudes)
+            columns["positions"].append(positions)
+        columns["cluster_ids"].append(np.full(len(spike_times), int(unit)))
+        columns["spike_times"].append(spike_times)
+        footprint_channels[row] = channels
+
+    cluster_ids = _concatenate(columns["cluster_ids"], (0,), np.int64)
+    footprint_amplitudes = _concatenate(
+        columns["footprint_amplitudes"], (0, n_neighbors)
+    )
+    return {
+        "cluster_ids": cluster_ids,
+        "spike_times": _concatenate(columns["spike_times"], (0,), np.int64),
+        "unit_index": np.repeat(
+            np.arange(len(unit_ids)), [len(c) for c in columns["cluster_ids"]]
+        ),
+        "amplitudes": footprint_amplitudes[:, 0],
+        "footprint_amplitudes": footprint_amplitudes,
+        "positions": _concatenate(columns["positions"], (0, 2)),
+        "unit_ids": unit_ids,
+        "footprint_channels": footprint_channels,
+    }
+
+
+def _concatenate(arrays, empty_shape, dtype=float):
+    return np.concatenate(arrays) if arrays else np.empty(empty_shape, dtype=dtype)
+
+
+def drift_traces(amplitudes, bin_sec=DEFAULT_DRIFT_BIN_SEC, duration_sec=None, fs=Fs):
+    """
+    Time binned mean amplitude and position of every unit, all units at once
+    with bincount over a (unit, time bin) index.
+    Params:
+        amplitudes: dict returned by spike_amplitudes()
+        bin_sec: float, duration of each time bin
+        duration_sec: float, recording duration, default the last spike time
+        fs: sample frequency in Hz
+    Returns:
+        dict with keys:
+            'cluster_ids': (num_units,)
+            'bin_starts_sec': (num_bins,) start time of each bin
+            'counts': (num_units, num_bins) spikes in each bin
+            'amplitude': (num_units, num_bins) mean amplitude, NaN if empty
+            'position': (num_units, num_bins, 2) mean (row, column), NaN if empty
+    """
+    cluster_ids, unit_index = np.unique(amplitudes["cluster_ids"], return_inverse=True)
+    times_sec = np.asarray(amplitudes["spike_times"], dtype=float) / fs
+    if duration_sec is None:
+        duration_sec = times_sec.max() if times_sec.size else 0
+    n_bins = max(int(np.ceil(duration_sec / bin_sec)), 1)
+    time_bin = np.minimum((times_sec // bin_sec).astype(int), n_bins - 1)
+    flat = unit_index * n_bins + time_bin
+    size = len(cluster_ids) * n_bins
+    shape = (len(cluster_ids), n_bins)
+
+    counts = np.bincount(flat, minlength=size)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        amplitude = np.bincount(flat, amplitudes["amplitudes"], size) / counts
+        position = np.stack(
+            [
+                np.bincount(flat, np.nan_to_num(amplitudes["positions"][:, k]), size)
+                / counts
+                for k in range(2)
+            ],
+            axis=-1,
+        )
+    return {
+        "cluster_ids": cluster_ids,
+        "bin_starts_sec": np.arange(n_bins) * bin_sec,
+        "counts": counts.reshape(shape),
+        "amplitude": amplitude.reshape(shape),
+        "position": position.reshape(shape + (2,)),
+    }
+
+
+def unit_drift_table(
+    traces,
+    amplitude_threshold=DRIFT_AMPLITUDE_THRESHOLD,
+    position_threshold=DRIFT_POSITION_THRESHOLD,
+    min_spikes_per_bin=MIN_SPIKES_PER_BIN,
+):
+    """
+    Summarizes the drift traces of each unit and flags drifting units.
+    Only bins with at least min_spikes_per_bin spikes are used.
+        amplitude_change: (max - min) of the binned amplitude / its median
+        position_shift: largest distance of a binned position from the
+            median position, in electrode pitch units
+        drifting: amplitude_change > amplitude_threshold or
+            position_shift > position_threshold
+    Returns:
+        pd.DataFrame, one row per unit
+    """
+    valid = traces["counts"] >= min_spikes_per_bin
+    amplitude = np.where(valid, traces["amplitude"], np.nan)
+    position = np.where(valid[:, :, None], traces["position"], np.nan)
+    has_bins = valid.any(axis=1)
+
+    amplitude_change = np.full(len(valid), np.nan)
+    position_shift = np.full(len(valid), np.nan)
+    if has_bins.any():
+        amp = amplitude[has_bins]
+        amplitude_change[has_bins] = (
+            np.nanmax(amp, axis=1) - np.nanmin(amp, axis=1)
+        ) / np.nanmedian(amp, axis=1)
+        pos = position[has_bins]
+        center = np.nanmedian(pos, axis=1, keepdims=True)
+        position_shift[has_bins] = np.nanmax(
+            np.sqrt(((pos - center) ** 2).sum(axis=2)), axis=1
+        )
+    return pd.DataFrame(
+        {
+            "cluster_id": traces["cluster_ids"],
+            "n_spikes": traces["counts"].sum(axis=1),
+            "n_bins": valid.sum(axis=1),
+            "amplitude_change": amplitude_change,
+            "position_shift": position_shift,
+            "drifting": (amplitude_change > amplitude_threshold)
+            | (position_shift > position_threshold),
+        }
+    )
+
+
+def write_drift_traces(store_dir, traces, metadata=None):
+    """Writes the drift traces as an npy store, see npy_store.py"""
+    return write_npy_store(store_dir, traces, metadata)
@@ -0,0 +1,135 @@
+# Binary spike store of sorted units
+#
+# Columnar, memory mappable counterpart of units_ts.tsv written by
+# phy_2_nwb.py. The store is an npy store (see npy_store.py) next to the TSV,
+# units_ts.tsv -> units_ts.spikes/, with:
+#   spike_samples.npy  (num_spikes,) int64 spike sample numbers, exact
+#   cluster_ids.npy    (num_spikes,) int32 cluster of each spike, sorted
+#   unit_ids.npy       (num_clusters,) int32 cluster ids
+#   offsets.npy        (num_clusters + 1,) int64 first spike of each cluster
+#   metadata.json      Fs, slice id, source PHY directory
+# Spikes are sorted by cluster, and by time within a cluster, so the spike
+# times of a cluster are one contiguous slice (the SpikeTrains layout).
+
+from os import path
+
+import numpy as np
+
+from meappy.npy_store import METADATA_FILE, read_npy_store, write_npy_store
+from meappy.spike_trains import SpikeTrains
+from meappy.waveform import Fs
+
+SPIKE_STORE_SUFFIX = ".spikes"
+SPIKE_STORE_VERSION = 1
+
+
+def spike_store_path(units_ts_path):
+    """
+    Returns the store path next to a units_ts.tsv file.
+    example: /export/units_ts.tsv -> /export/units_ts.spikes
+    """
+    return path.splitext(units_ts_path)[0] + SPIKE_STORE_SUFFIX
+
+
+def write_spike_store(store_dir, spike_samples, spike_clusters, metadata=None, fs=Fs):
+    """
+    Writes spikes as a binary spike store.
+    Params:
+        store_dir: str, directory of the store, see spike_store_path()
+        spike_samples: np.ndarray, spike times as sample numbers
+        spike_clusters: np.ndarray, cluster id of each spike
+        metadata: dict, e.g. slice_id and phy_dir
+        fs: sample frequency in Hz
+    Returns:
+        store_dir: str
+    """
+    spike_samples = np.asarray(spike_samples).astype(np.int64).reshape(-1)
+    spike_clusters = np.asarray(spike_clusters).reshape(-1)
+    if np.any(np.diff(spike_samples) < 0):
+        # PHY spike times are in time order, patched stores are not
+        order = np.lexsort((spike_samples, spike_clusters))
+        spike_samples, spike_clusters = spike_samples[order], spike_clusters[order]
+    spike_trains = SpikeTrains.from_spikes(spike_samples, spike_clusters)
+    arrays = {
+        "spike_samples": spike_trains.times,
+        "cluster_ids": spike_trains.spike_units.astype(np.int32),
+        "unit_ids": spike_trains.unit_ids.astype(np.int32),
+        "offsets": spike_trains.offsets,
+    }
+    store_metadata = dict(metadata or {})
+    store_metadata.update(
+        {
+            "format": "meappy spike store",
+            "version": SPIKE_STORE_VERSION,
+            "Fs": fs,
+            "num_spikes": int(len(spike_trains.times)),
+            "num_clusters": len(spike_trains),
+        }
+    )
+    write_npy_store(store_dir, arrays, store_metadata)
+    print(f"Spike store written to {store_dir}")
+    return store_dir
+
+
+def read_spike_store(store_dir, return_seconds=False, mmap_mode="r"):
+    """
+    Opens a spike store.
+    Params:
+        store_dir: str, directory of the store
+        return_seconds: bool, convert the sample numbers to seconds with the
+            store's Fs, otherwise the spike times are memory mapped samples
+        mmap_mode: str, passed to np.load
+    Returns:
+        spike_trains: SpikeTrains of the spike times of each cluster
+        metadata: dict
+    """
+    arrays, metadata = read_npy_store(store_dir, mmap_mode)
+    spike_trains = SpikeTrains(
+        arrays["spike_samples"], arrays["unit_ids"], arrays["offsets"]
+    )
+    if return_seconds:
+        spike_trains = spike_trains.scaled(1 / metadata["Fs"])
+    return spike_trains, metadata
+
+
+def is_spike_store_current(units_ts_path):
+    """
+    True if the spike store of a units_ts.tsv file exists and was written
+    after the TSV, so the two hold the same spikes.
+    """
+    metadata_path = path.join(spike_store_path(units_ts_path), METADATA_FILE)
+    if not path.exists(metadata_path):
+        return False
+    if not path.exists(units_ts_path):
+        return True
+    return path.getmtime(metadata_path) >= path.getmtime(units_ts_path)
+
+
+def patch_spike_store(store_dir, spike_samples, spike_clusters, diff, metadata=None):
+    """
+    Patches a spike store after a curation edit, see curation_diff.py. The
+    spikes of the units of diff.stale are dropped and those of diff.recompute
+    are read from spike_samples and spike_clusters. The other units are
+    copied from the store.
+    Params:
+        store_dir: str, directory of an existing store
+        spike_samples: np.ndarray, spike times as sample numbers
+        spike_clusters: np.ndarray, cluster id of each spike after the edit
+        diff: CurationDiff
+        metadata: dict, replaces the metadata of the store
+    Returns:
+        store_dir: str
+    """
+    previous, store_metadata = read_spike_store(store_dir, mmap_mode=None)
+    kept = previous.select(np.setdiff1d(previous.unit_ids, diff.stale))
+    recomputed = np.isin(spike_clusters, diff.recompute)
+    samples = np.concatenate(
+        (kept.times, np.asarray(spike_samples)[recomputed].astype(np.int64))
+    )
+    clusters = np.concatenate(
+        (kept.spike_units, np.asarray(spike_clusters)[recomputed])
+    )
+    store_metadata.update(metadata or {})
+    return write_spike_store(
+        store_dir, samples, clusters, store_metadata, store_metadata["Fs"]
+    )
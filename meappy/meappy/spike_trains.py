@@ -0,0 +1,138 @@
+# Compact spike trains of all units of a recording
+#
+# SpikeTrains holds the spike times of all units in one array sorted by unit
+# (CSR layout): times of unit_ids[i] are times[offsets[i]:offsets[i + 1]].
+# It is built with one stable argsort, so spikes of each unit keep their
+# time order, and the spike times of a unit are zero-copy views. It is a
+# read-only Mapping of unit id to spike times, so it can be used wherever the
+# dict returned by the former get_phy_spikes_list() was used.
+
+from collections.abc import Mapping
+
+import numpy as np
+
+
+class SpikeTrains(Mapping):
+    """
+    Spike times grouped by unit.
+
+    Params:
+        times: np.ndarray, spike times sorted by unit, in time order per unit
+        unit_ids: np.ndarray, sorted unique unit ids
+        offsets: np.ndarray, len(unit_ids) + 1 start of each unit in times
+    """
+
+    def __init__(self, times, unit_ids, offsets):
+        self.times = np.asanyarray(times)  # keeps a memory map a memory map
+        self.unit_ids = np.asarray(unit_ids)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        if len(self.offsets) != len(self.unit_ids) + 1:
+            raise ValueError("offsets must have one more element than unit_ids")
+        self._index = {unit: i for i, unit in enumerate(self.unit_ids.tolist())}
+
+    @classmethod
+    def from_spikes(cls, spike_times, spike_units):
+        """
+        Groups spikes by unit with one stable argsort. 10 million PHY spikes
+        are grouped in a fraction of a second.
+        Params:
+            spike_times: np.ndarray, 1D time of each spike, e.g. PHY spike_times
+            spike_units: np.ndarray, 1D unit of each spike, e.g. PHY spike_clusters
+        """
+        spike_times = np.asarray(spike_times).reshape(-1)
+        spike_units = np.asarray(spike_units).reshape(-1)
+        if spike_times.shape != spike_units.shape:
+            raise ValueError("spike_times and spike_units must have the same length")
+        if not spike_units.size:
+            return cls(spike_times, spike_units, [0])
+        low, high = spike_units.min(), spike_units.max()
+        if spike_units.dtype.kind in "iu" and high - low < 2**16:
+            # cluster ids span a small range: the stable sort of 16 bit keys
+            # is a radix sort, and bincount gives the offsets
+            keys = (spike_units - low).astype(np.uint16)
+            order = np.argsort(keys, kind="stable")
+            counts = np.bincount(keys)
+            present = np.flatnonzero(counts)
+            unit_ids = (present + low).astype(spike_units.dtype)
+            offsets = np.append(0, np.cumsum(counts[present]))
+        else:
+            order = np.argsort(spike_units, kind="stable")
+            sorted_units = spike_units[order]
+            starts = np.flatnonzero(np.diff(sorted_units, prepend=sorted_units[0]))
+            starts = np.append(0, starts)
+            unit_ids = sorted_units[starts]
+            offsets = np.append(starts, len(sorted_units))
+        return cls(spike_times[order], unit_ids, offsets)
+
+    @classmethod
+    def from_dict(cls, unit_spike_times):
+        """
+        SpikeTrains of a dict of unit to spike times, or of the .mat format
+        dict of unit to {'timestamps': times}. A SpikeTrains is returned as is.
+        """
+        if isinstance(unit_spike_times, SpikeTrains):
+            return unit_spike_times
+        units = sorted(unit_spike_times.keys())
+        trains = []
+        for unit in units:
+            train = unit_spike_times[unit]
+            if isinstance(train, dict):
+                train = train["timestamps"]
+            trains.append(np.asarray(train).reshape(-1))
+        counts = [len(train) for train in trains]
+        times = np.concatenate(trains) if trains else np.empty(0)
+        return cls(times, np.array(units), np.concatenate(([0], np.cumsum(counts))))
+
+    def __getitem__(self, unit):
+        i = self._index[unit]
+        return self.times[self.offsets[i] : self.offsets[i + 1]]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self.unit_ids)
+
+    def __contains__(self, unit):
+        return unit in self._index
+
+    def __repr__(self):
+        return f"SpikeTrains({len(self)} units, {len(self.times)} spikes)"
+
+    @property
+    def counts(self):
+        """number of spikes of each unit, in the order of unit_ids"""
+        return np.diff(self.offsets)
+
+    @property
+    def spike_units(self):
+        """unit of each spike of times"""
+        return np.repeat(self.unit_ids, self.counts)
+
+    def scaled(self, factor):
+        """
+        New SpikeTrains with times multiplied by factor, e.g. 1 / Fs to
+        convert sample numbers to seconds
+        """
+        return SpikeTrains(self.times * factor, self.unit_ids, self.offsets)
+
+    def select(self, units):
+        """New SpikeTrains with only the given units, in the order of unit_ids"""
+        keep = np.isin(self.unit_ids, units)
+        starts, stops = self.offsets[:-1][keep], self.offsets[1:][keep]
+        counts = stops - starts
+        # index of every kept spike, without a loop over units
+        index = np.repeat(starts - np.cumsum(np.append(0, counts[:-1])), counts)
+        index += np.arange(counts.sum())
+        return SpikeTrains(
+            self.times[index], self.unit_ids[keep], np.append(0, np.cumsum(counts))
+        )
+
+    def count_in_range(self, start, stop):
+        """
+        Number of spikes of each unit with start < time < stop, in the order
+        of unit_ids, counted for all units at once
+        """
+        in_range = (self.times > start) & (self.times < stop)
+        unit_index = np.repeat(np.arange(len(self)), self.counts)
+        return np.bincount(unit_index[in_range], minlength=len(self))
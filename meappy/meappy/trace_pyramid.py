@@ -0,0 +1,207 @@
+# Multi-resolution min/max decimation pyramid of raw MED64 traces
+#
+# Level 0 holds the min and max of every base_bin samples of each channel,
+# each following level holds the min and max of `factor` bins of the level
+# below. A trace viewer asks for a time window and a pixel width and gets the
+# coarsest level that still has at least one bin per pixel, so drawing any
+# window of an hour long recording reads about width_px values per channel.
+#
+# Pyramid directory layout:
+#   pyramid.json              metadata, see build_minmax_pyramid()
+#   level_<k>_min.npy         (nCh, n_bins) per level, memory mapped on read
+#   level_<k>_max.npy
+
+import os
+from os import path
+import json
+import shutil
+
+import numpy as np
+
+from meappy.med64_recording import DEFAULT_CHUNK_SEC, open_recording
+
+PYRAMID_SUFFIX = ".pyramid"  # replaces .bin of the modat.bin file
+PYRAMID_META_FILE = "pyramid.json"
+DEFAULT_BASE_BIN = 16  # samples per bin of level 0, 0.8 ms at 20 kHz
+DEFAULT_FACTOR = 4  # bins of a level merged into one bin of the next level
+DEFAULT_MIN_BINS = 1024  # stop adding levels once a level has fewer bins
+
+
+def pyramid_path(med64_bin_path):
+    """
+    Returns the default pyramid directory of a modat.bin file.
+    example: 20211109_15h09m07s.modat.bin -> 20211109_15h09m07s.modat.pyramid
+    """
+    return path.splitext(med64_bin_path)[0] + PYRAMID_SUFFIX
+
+
+def _level_paths(pyramid_dir, level):
+    return (
+        path.join(pyramid_dir, f"level_{level}_min.npy"),
+        path.join(pyramid_dir, f"level_{level}_max.npy"),
+    )
+
+
+def _bin_min_max(data, bin_size):
+    """
+    Min and max of consecutive bins of bin_size samples of a (nCh, N) array.
+    A last partial bin is reduced over the samples it has.
+    """
+    n_channels, num_samples = data.shape
+    n_full = num_samples // bin_size
+    full = data[:, : n_full * bin_size].reshape(n_channels, n_full, bin_size)
+    mins, maxs = full.min(axis=2), full.max(axis=2)
+    if num_samples % bin_size:
+        tail = data[:, n_full * bin_size :]
+        mins = np.hstack((mins, tail.min(axis=1, keepdims=True)))
+        maxs = np.hstack((maxs, tail.max(axis=1, keepdims=True)))
+    return mins, maxs
+
+
+def build_minmax_pyramid(
+    recording,
+    pyramid_dir=None,
+    base_bin=DEFAULT_BASE_BIN,
+    factor=DEFAULT_FACTOR,
+    min_bins=DEFAULT_MIN_BINS,
+    chunk_sec=DEFAULT_CHUNK_SEC,
+):
+    """
+    Builds the min/max pyramid of every channel of a recording in one
+    sequential pass over the data and stores it on disk.
+    Params:
+        recording: Med64Recording or str path of a modat.bin file
+        pyramid_dir: str, output directory, default from pyramid_path()
+        base_bin: int, samples per bin of level 0
+        factor: int, bins merged into one bin of the next level
+        min_bins: int, a level with fewer bins than this is the last level
+        chunk_sec: float, duration of the chunks read from disk
+    Returns:
+        MinMaxPyramid, reader of the written pyramid
+    """
+    if isinstance(recording, str):
+        recording = open_recording(recording)
+    if pyramid_dir is None:
+        pyramid_dir = pyramid_path(recording.source_path)
+    temp_dir = pyramid_dir + ".tmp"
+    if path.isdir(temp_dir):
+        shutil.rmtree(temp_dir)
+    os.makedirs(temp_dir)
+
+    # chunks are a whole number of base bins, so only the last bin is partial
+    chunk_samples = max(int(round(chunk_sec * recording.fs)) // base_bin, 1) * base_bin
+    n_bins = -(-recording.n_samples // base_bin)
+    min_path, max_path = _level_paths(temp_dir, 0)
+    shape = (recording.n_channels, n_bins)
+    level_min = np.lib.format.open_memmap(min_path, "w+", recording.dtype, shape)
+    level_max = np.lib.format.open_memmap(max_path, "w+", recording.dtype, shape)
+    for chunk in recording.iter_chunks(chunk_samples=chunk_samples):
+        first_bin = chunk.start // base_bin
+        mins, maxs = _bin_min_max(chunk.data, base_bin)
+        level_min[:, first_bin : first_bin + mins.shape[1]] = mins
+        level_max[:, first_bin : first_bin + maxs.shape[1]] = maxs
+
+    level_min.flush()
+    level_max.flush()
+
+    bin_sizes = [base_bin]
+    while n_bins > min_bins:
+        mins, _ = _bin_min_max(level_min, factor)
+        _, maxs = _bin_min_max(level_max, factor)
+        level = len(bin_sizes)
+        min_path, max_path = _level_paths(temp_dir, level)
+        np.save(min_path, mins)
+        np.save(max_path, maxs)
+        level_min, level_max = mins, maxs
+        n_bins = mins.shape[1]
+        bin_sizes.append(bin_sizes[-1] * factor)
+    del level_min, level_max
+
+    meta = {
+        "source": path.basename(recording.source_path),
+        "fs": recording.fs,
+        "n_channels": recording.n_channels,
+        "n_samples": int(recording.n_samples),
+        "bin_sizes": bin_sizes,
+    }
+    with open(path.join(temp_dir, PYRAMID_META_FILE), "w") as file:
+        json.dump(meta, file, indent=4)
+    if path.isdir(pyramid_dir):
+        shutil.rmtree(pyramid_dir)
+    os.replace(temp_dir, pyramid_dir)
+    print(f"Min/max pyramid with {len(bin_sizes)} levels written to {pyramid_dir}")
+    return MinMaxPyramid(pyramid_dir, recording)
+
+
+class MinMaxPyramid:
+    """
+    Reader of a min/max pyramid written by build_minmax_pyramid(). The levels
+    are memory mapped, so a window only reads and allocates the bins it returns.
+
+    Params:
+        pyramid_dir: str, pyramid directory
+        recording: optional Med64Recording of the source data, used for
+            windows zoomed in further than level 0
+    """
+
+    def __init__(self, pyramid_dir, recording=None):
+        self.pyramid_dir = pyramid_dir
+        self.recording = recording
+        with open(path.join(pyramid_dir, PYRAMID_META_FILE)) as file:
+            self.meta = json.load(file)
+        self.fs = self.meta["fs"]
+        self.n_channels = self.meta["n_channels"]
+        self.n_samples = self.meta["n_samples"]
+        self.bin_sizes = self.meta["bin_sizes"]
+        self.levels = []
+        for level in range(len(self.bin_sizes)):
+            min_path, max_path = _level_paths(pyramid_dir, level)
+            self.levels.append(
+                (np.load(min_path, mmap_mode="r"), np.load(max_path, mmap_mode="r"))
+            )
+
+    def select_level(self, num_samples, width_px):
+        """
+        Returns the index of the coarsest level with at least width_px bins
+        in num_samples samples, or None if the raw samples are needed.
+        """
+        samples_per_px = num_samples / max(width_px, 1)
+        fitting = [i for i, size in enumerate(self.bin_sizes) if size <= samples_per_px]
+        if not fitting:
+            return None
+        return fitting[-1]
+
+    def window(self, start_sec, stop_sec, width_px, channels=None):
+        """
+        Min/max envelope of a time window for drawing width_px pixels.
+        Params:
+            start_sec: float, beginning of the window in seconds
+            stop_sec: float, end of the window in seconds
+            width_px: int, width of the plot in pixels
+            channels: list of int, default all channels
+        Returns:
+            time: np.ndarray, start time of each bin in seconds
+            mins: np.ndarray, (num_channels, num_bins) min of each bin
+            maxs: np.ndarray, (num_channels, num_bins) max of each bin
+        """
+        start = min(max(int(np.floor(start_sec * self.fs)), 0), self.n_samples)
+        stop = min(max(int(np.ceil(stop_sec * self.fs)), start), self.n_samples)
+        if channels is None:
+            channels = slice(None)
+        level = self.select_level(stop - start, width_px)
+
+        if level is None and self.recording is not None:
+            samples = self.recording.get_samples(start, stop, channels)
+            time = np.arange(start, stop) / self.fs
+            return time, samples, samples
+        if level is None:
+            level = 0
+
+        bin_size = self.bin_sizes[level]
+        first_bin = start // bin_size
+        last_bin = -(-stop // bin_size)
+        level_min, level_max = self.levels[level]
+        mins = np.array(level_min[channels, first_bin:last_bin])
+        maxs = np.array(level_max[channels, first_bin:last_bin])
+        time = np.arange(first_bin, last_bin) * (bin_size / self.fs)
+        return time, mins, maxs
@@ -1,10 +1,13 @@
 # This module copies and modifies code from bokeh_waveform.waveform_visualizer module
 
 from os import path
+from functools import cached_property
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from meappy.spike_trains import SpikeTrains
+
 
 Fs = 20000  # sample frequency Hz
 nCh = 64  # number of recording electrode channels
@@ -36,20 +39,103 @@ class PhyPaths:
         self.spk_clust = path.join(phy_dir, "spike_clusters.npy")
         self.clust_info = path.join(phy_dir, "cluster_info.tsv")
 
+        # optional PHY files, not every export has them
+        self.amplitudes = path.join(phy_dir, "amplitudes.npy")
+        self.templates = path.join(phy_dir, "templates.npy")
+        self.pc_features = path.join(phy_dir, "pc_features.npy")
+        self.phy_dir = phy_dir
+
 
 class PhyData:
-    def __init__(self, phy_paths):
-        self.spike_times = np.load(phy_paths.spike_times)
-        self.spk_clust = np.load(phy_paths.spk_clust)
-        self.clust_info = pd.read_csv(phy_paths.clust_info, sep="\t")
+    """
+    Lazy access to the PHY files of a sorted slice. The npy arrays are opened
+    as read-only memory maps on first access, cluster_info.tsv is parsed on
+    first access, and the good cluster tables are cached per min_spikes, so
+    repeated analyses of a slice only read what they use, once.
 
+    Params:
+        phy_paths: PhyPaths or str path of the PHY directory
+    """
 
-def get_raw_data(med64_bin_path):
+    def __init__(self, phy_paths):
+        if isinstance(phy_paths, str):
+            phy_paths = PhyPaths(phy_paths)
+        self.paths = phy_paths
+        self._good_clusters = dict()
+
+    def _load_npy(self, npy_path, required=True):
+        if not required and not path.exists(npy_path):
+            return None
+        return np.load(npy_path, mmap_mode="r")
+
+    @cached_property
+    def spike_times(self):
+        """spike sample numbers, memory mapped"""
+        return self._load_npy(self.paths.spike_times)
+
+    @cached_property
+    def spk_clust(self):
+        """cluster id of each spike, memory mapped"""
+        return self._load_npy(self.paths.spk_clust)
+
+    @cached_property
+    def clust_info(self):
+        return pd.read_csv(self.paths.clust_info, sep="\t")
+
+    @cached_property
+    def amplitudes(self):
+        """template amplitude of each spike, None without amplitudes.npy"""
+        return self._load_npy(self.paths.amplitudes, required=False)
+
+    @cached_property
+    def templates(self):
+        """(n_templates, n_samples, n_channels), None without templates.npy"""
+        return self._load_npy(self.paths.templates, required=False)
+
+    @cached_property
+    def pc_features(self):
+        """(n_spikes, n_pcs, n_channels), None without pc_features.npy"""
+        return self._load_npy(self.paths.pc_features, required=False)
+
+    def good_clusters(self, min_spikes=0):
+        """
+        Rows of cluster_info for clusters labeled 'good' with at least
+        min_spikes spikes. The table is cached for each min_spikes.
+        """
+        if min_spikes not in self._good_clusters:
+            clust_info = self.clust_info
+            good = (clust_info["group"] == "good") & (
+                clust_info["n_spikes"] >= min_spikes
+            )
+            self._good_clusters[min_spikes] = clust_info[good]
+        return self._good_clusters[min_spikes]
+
+    def good_clust_chan(self, min_spikes=0):
+        """(num_clusters, 2) array of (cluster_id, ch) of the good clusters"""
+        return self.good_clusters(min_spikes)[["cluster_id", "ch"]].to_numpy()
+
+    @cached_property
+    def spike_trains(self):
+        """SpikeTrains of spike sample numbers of every cluster"""
+        return get_phy_spikes_list(self.spike_times, self.spk_clust, False)
+
+
+def get_raw_data(med64_bin_path, mmap=False):
     """
     Opens modat.bin raw med64 physiology file. Returns a numpy matrix
     64 x N dimensions. Where 64 is the channels 0 to 63 and N is the
     int16 amplitude of each channel in 20 kHz samples
+    If mmap is True, the matrix is a read-only memory mapped view of the
+    file (see med64_recording.Med64Recording) instead of a full copy in memory.
+    The channel major companion file is used instead when it is up to date.
     """
+    if mmap:
+        from meappy.med64_recording import open_recording
+
+        recording = open_recording(med64_bin_path, n_channels=nCh, fs=Fs)
+        print(f"Data duration {round(recording.duration_sec / 60, 1)} minutes")
+        return recording.data
+
     with open(med64_bin_path, "rb") as file:
         bin_data = np.fromfile(file, dtype=np.int16)
 
@@ -60,6 +146,18 @@ def get_raw_data(med64_bin_path):
     return np.reshape(bin_data, (nCh, -1), order="F")
 
 
+def iter_raw_data(med64_bin_path, chunk_sec=10, overlap_samples=0):
+    """
+    Streaming version of get_raw_data(). Yields the modat.bin file as
+    RawChunk blocks of chunk_sec seconds by 64 channels, with overlap_samples
+    extra samples on each side. Each block carries its absolute sample
+    numbers (start, stop, offset), so spike times can be computed exactly.
+    """
+    from meappy.med64_recording import iter_raw_chunks
+
+    yield from iter_raw_chunks(med64_bin_path, chunk_sec, overlap_samples, nCh)
+
+
 def get_window(midpoint, width):
     """takes the midpoint sample of a desired window width and
     returns the start and end samples for that window.
@@ -91,9 +189,12 @@ def get_source_dict(matrix_data, width_samples, midpoint_sample, active_chan):
 
     num_samples = matrix_data.shape[1]
     max_time = num_samples / Fs
-    times = np.linspace(0, max_time, num=num_samples)
+    # same times as np.linspace(0, max_time, num=num_samples) but only for the window
+    time_step = max_time / max(num_samples - 1, 1)
+    window_samples = np.arange(min_sample, min(max_sample, num_samples))
+    times = window_samples * time_step
 
-    source_dict = dict(time=times[min_sample:max_sample])
+    source_dict = dict(time=times)
 
     # NOTE: dict key 'amplitude' is only used for basic plot example. may be deleted otherwise.
     if not active_chan == None:
@@ -126,20 +227,178 @@ def get_phy_spikes_list(phy_spike_data, phy_spk_clust_data, return_seconds=True)
             number to time in seconds. Set to True to return the sample number instead.
     
     Returns:
-        unit_spike_times: dict, keys are cluster number, values are list of spike
-            times in seconds or as sample number (seconds * sampling_rate)
+        unit_spike_times: SpikeTrains, mapping of cluster number to an array of
+            spike times in seconds or as sample number (seconds * sampling_rate)
     """
     if return_seconds:
         samples_to_seconds = 1 / Fs  # 20kHz sampling Frequency
         phy_spike_data = phy_spike_data * samples_to_seconds
     
-    unit_spike_times = dict()
-    for time, unit in zip(phy_spike_data, phy_spk_clust_data):
-        if unit in unit_spike_times:
-            unit_spike_times[unit].append(time)
-        else:
-            unit_spike_times[unit] = list([time])
-    return unit_spike_times
+    return SpikeTrains.from_spikes(phy_spike_data, phy_spk_clust_data)
+
+
+def get_window_offsets(width, pre_samples=None):
+    """
+    Vectorized counterpart of get_window(). Returns the sample offsets of a
+    window of width samples relative to the spike sample. With pre_samples
+    None the spike is at the center of the window, otherwise the window
+    starts pre_samples before the spike.
+    """
+    if pre_samples is None:
+        pre_samples = int(width / 2)
+    return np.arange(int(width)) - int(pre_samples)
+
+
+def extract_spike_waves(
+    channel_data, spike_times, width, pre_samples=None, fill_value=None
+):
+    """
+    Gathers the waveforms of all spikes of one channel in one vectorized
+    indexing operation, using an index matrix of spike sample times plus
+    window offsets.
+
+    Spikes whose window reaches past the beginning or end of the recording
+    are flagged in the returned mask. By default their out of range samples
+    repeat the first or last sample of the recording; if fill_value is
+    given, they are set to fill_value instead (e.g. np.nan).
+    Params:
+        channel_data: np.ndarray, 1D samples of one channel, e.g. matrix_data[ch]
+            of get_raw_data() or a Med64Recording channel
+        spike_times: np.ndarray, 1D spike times as sample numbers
+        width: int, number of samples of each waveform
+        pre_samples: int, samples before the spike, default half the width
+        fill_value: float, optional value of samples outside the recording
+    Returns:
+        waves: np.ndarray, (num_spikes, width) float64 waveforms
+        in_bounds: np.ndarray, bool, True for spikes with a complete window
+    """
+    spike_times = np.asarray(spike_times).astype(np.int64).reshape(-1)
+    offsets = get_window_offsets(width, pre_samples)
+    num_samples = channel_data.shape[0]
+
+    in_bounds = _windows_in_bounds(spike_times, offsets, num_samples)
+    index = spike_times[:, None] + offsets[None, :]
+    if fill_value is not None:
+        outside = (index < 0) | (index >= num_samples)
+    np.clip(index, 0, num_samples - 1, out=index)
+    waves = np.asarray(channel_data[index], dtype=np.float64)
+    if fill_value is not None:
+        waves[outside] = fill_value
+    return waves, in_bounds
+
+
+def _windows_in_bounds(spike_times, offsets, num_samples):
+    """True for spikes whose window lies inside the recording, O(num_spikes)"""
+    return (spike_times + offsets[0] >= 0) & (spike_times + offsets[-1] < num_samples)
+
+
+def extract_spike_waves_sequential(
+    recording,
+    spike_times,
+    spike_channels,
+    width,
+    pre_samples=None,
+    chunk_sec=10,
+    fill_value=None,
+):
+    """
+    Gathers the waveforms of spikes on any channels in one sequential pass
+    over the recording, for files larger than memory. Spikes are sorted by
+    sample time and each chunk of the recording fills the waveforms of the
+    spikes that fall in it, with one vectorized gather per chunk.
+    Params:
+        recording: Med64Recording or str path of a modat.bin file
+        spike_times: np.ndarray, 1D spike times as sample numbers
+        spike_channels: np.ndarray, channel of each spike
+        width, pre_samples, fill_value: see extract_spike_waves()
+        chunk_sec: float, duration of the chunks read from disk
+    Returns:
+        waves: np.ndarray, (num_spikes, width) float64 waveforms in the order
+            of spike_times
+        in_bounds: np.ndarray, bool, True for spikes with a complete window
+    """
+    if isinstance(recording, str):
+        from meappy.med64_recording import open_recording
+
+        recording = open_recording(recording)
+    spike_times = np.asarray(spike_times).astype(np.int64).reshape(-1)
+    spike_channels = np.asarray(spike_channels).astype(np.intp).reshape(-1)
+    offsets = get_window_offsets(width, pre_samples)
+    num_samples = recording.n_samples
+
+    # only the output is allocated for all spikes, index arrays are per chunk
+    waves = np.empty((spike_times.size, offsets.size), dtype=np.float64)
+    in_bounds = _windows_in_bounds(spike_times, offsets, num_samples)
+
+    order = np.argsort(spike_times, kind="stable")
+    # spikes before the first or after the last sample are cut from the edge chunks
+    chunk_times = np.clip(spike_times[order], 0, max(num_samples - 1, 0))
+    overlap = max(-offsets[0], offsets[-1], 0)
+    for chunk in recording.iter_chunks(chunk_sec, overlap_samples=overlap):
+        first, last = np.searchsorted(chunk_times, [chunk.start, chunk.stop])
+        if first == last:
+            continue
+        spikes = order[first:last]
+        index = spike_times[spikes, None] + offsets[None, :]
+        if fill_value is not None:
+            outside = (index < 0) | (index >= num_samples)
+        np.clip(index, 0, num_samples - 1, out=index)
+        index -= chunk.offset
+        chunk_waves = chunk.data[spike_channels[spikes, None], index]
+        if fill_value is not None:
+            chunk_waves = chunk_waves.astype(np.float64)
+            chunk_waves[outside] = fill_value
+        waves[spikes] = chunk_waves
+    return waves, in_bounds
+
+
+def extract_spike_footprints(
+    matrix_data,
+    ch,
+    spike_times,
+    width,
+    pre_samples=None,
+    neighbors=None,
+    fill_value=np.nan,
+):
+    """
+    Multi-electrode version of extract_spike_waves(). Gathers the waveforms
+    of all spikes of a unit on its channel and the surrounding electrodes of
+    the MED64 grid in one vectorized indexing operation.
+    Params:
+        matrix_data: (nCh, N) samples, see get_raw_data() or Med64Recording
+        ch: int, channel of the unit, first channel of the footprint
+        spike_times: np.ndarray, 1D spike times as sample numbers
+        width, pre_samples: see extract_spike_waves()
+        neighbors: np.ndarray, adjacency index from
+            electrode_layout.electrode_neighbors(), default its default radius
+        fill_value: float, value of the padding neighbors of edge electrodes
+    Returns:
+        footprints: np.ndarray, (num_spikes, num_neighbors, width) float64
+        channels: np.ndarray, channel of each neighbor, -1 for padding
+        in_bounds: np.ndarray, bool, True for spikes with a complete window
+    """
+    if neighbors is None:
+        from meappy.electrode_layout import electrode_neighbors
+
+        neighbors = electrode_neighbors()
+    channels = np.asarray(neighbors[ch])
+    padding = channels < 0
+    gather_channels = np.where(padding, ch, channels)
+
+    spike_times = np.asarray(spike_times).astype(np.int64).reshape(-1)
+    offsets = get_window_offsets(width, pre_samples)
+    num_samples = matrix_data.shape[1]
+    in_bounds = _windows_in_bounds(spike_times, offsets, num_samples)
+    index = spike_times[:, None] + offsets[None, :]
+    np.clip(index, 0, num_samples - 1, out=index)
+
+    footprints = np.asarray(
+        matrix_data[gather_channels[None, :, None], index[:, None, :]],
+        dtype=np.float64,
+    )
+    footprints[:, padding] = fill_value
+    return footprints, channels, in_bounds
 
 
 def get_raw_phy_spike_waves(
@@ -149,6 +408,8 @@ def get_raw_phy_spike_waves(
     unit_list is list of units
     return dict of channels. value of each item is numpy array with dims
     (num_spikes, raw_wave_sample_size)
+    Waveforms of spikes near the beginning or end of the recording are
+    padded with the first or last sample, see extract_spike_waves().
     """
     # clust_info_data has clust, chan
     # unit_spike_times replaces amp_spikes_map
@@ -156,21 +417,14 @@ def get_raw_phy_spike_waves(
     ## todo: change `unit` to `chan`
     raw_waves = dict()
     for unit, ch in unit_list:
-        spike_num = len(unit_spike_times[unit])
-        raw_waves[unit] = np.ndarray((spike_num, sample_window_width))
-
-    for unit, ch in unit_list:
-        spike_times = unit_spike_times[unit]
-        for i, time in enumerate(spike_times):
-            min_point, max_point = get_window(time, sample_window_width)
-            try:
-                raw_spike_waveform = matrix_data[ch][min_point : (max_point + 1)]
-            except IndexError:
-                print(
-                    f"matrix_data Index Out of Range for channel: {ch}, \
-                      range:({min_point}, {max_point})"
-                )
-            raw_waves[unit][i] = raw_spike_waveform
+        raw_waves[unit], in_bounds = extract_spike_waves(
+            matrix_data[ch], unit_spike_times[unit], sample_window_width
+        )
+        if not in_bounds.all():
+            print(
+                f"{np.sum(~in_bounds)} spikes of unit {unit} on channel {ch} "
+                f"padded at the edge of the recording"
+            )
     return raw_waves
 
 
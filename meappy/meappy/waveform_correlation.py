@@ -0,0 +1,127 @@
+# Correlation matrix of the mean waveforms of all units
+#
+# The Pearson correlation of every pair of units is one matrix product of
+# the z-scored mean waveforms. The lag tolerant version correlates the
+# center of each waveform with the waveforms of all units shifted by up to
+# max_lag samples, as one batched matrix product over lags, and keeps the
+# best lag of each pair. The matrix is written as an npy store, which
+# meapr::plot_waveform_correlation_matrix() reads directly.
+#
+# usage:
+# python waveform_correlation.py --max_lag 3 /path/to/20190809_11h22m58s_waves.tsv
+
+from os import path
+import argparse
+
+import numpy as np
+
+from meappy.npy_store import read_npy_store, write_npy_store
+from meappy.waveform_stats import read_mean_waveforms_tsv
+
+CORRELATION_SUFFIX = "_waves_corr"
+
+
+def _zscore_rows(waves):
+    """Centers each row and scales it to unit norm, zero rows stay zero"""
+    centered = waves - waves.mean(axis=-1, keepdims=True)
+    norm = np.linalg.norm(centered, axis=-1, keepdims=True)
+    return np.divide(centered, norm, out=np.zeros_like(centered), where=norm > 0)
+
+
+def waveform_correlation_matrix(mean_waves, max_lag=0):
+    """
+    Correlation of the mean waveforms of all pairs of units.
+    Params:
+        mean_waves: np.ndarray, (num_units, window) mean waveforms
+        max_lag: int, largest shift in samples tried for each pair. With 0
+            this is the Pearson correlation matrix.
+    Returns:
+        correlation: np.ndarray, (num_units, num_units) symmetric matrix
+        lags: np.ndarray, (num_units, num_units) int shift of column unit
+            relative to row unit with the highest correlation
+    """
+    waves = np.asarray(mean_waves, dtype=float)
+    if not len(waves):
+        return np.zeros((0, 0)), np.zeros((0, 0), dtype=int)
+    waves = np.atleast_2d(waves)
+    n_units, width = waves.shape
+    if max_lag == 0:
+        z = _zscore_rows(waves)
+        return z @ z.T, np.zeros((n_units, n_units), dtype=int)
+    if 2 * max_lag >= width:
+        raise ValueError(f"max_lag {max_lag} too large for {width} sample waveforms")
+
+    # (n_lags, n_units, segment) windows of every unit at every shift
+    segment = width - 2 * max_lag
+    lag_values = np.arange(-max_lag, max_lag + 1)
+    windows = np.lib.stride_tricks.sliding_window_view(waves, segment, axis=1)
+    shifted = _zscore_rows(np.ascontiguousarray(windows.transpose(1, 0, 2)))
+    center = shifted[max_lag]
+    by_lag = np.matmul(center[None], shifted.transpose(0, 2, 1))
+    best = by_lag.argmax(axis=0)
+    correlation = np.take_along_axis(by_lag, best[None], axis=0)[0]
+    lags = lag_values[best]
+
+    # the center segment differs between (i, j) and (j, i), keep the best of both
+    use_transpose = correlation.T > correlation
+    correlation = np.where(use_transpose, correlation.T, correlation)
+    lags = np.where(use_transpose, -lags.T, lags)
+    np.fill_diagonal(correlation, 1.0)
+    np.fill_diagonal(lags, 0)
+    return correlation, lags
+
+
+def write_waveform_correlation(
+    store_dir, correlation, lags, cluster_ids, metadata=None
+):
+    """
+    Writes the correlation matrix as an npy store: correlation.npy (float32),
+    lags.npy (int16) and cluster_ids.npy, the row and column labels.
+    """
+    store_metadata = {"num_clusters": len(cluster_ids)}
+    store_metadata.update(metadata or {})
+    arrays = {
+        "correlation": np.asarray(correlation, dtype=np.float32),
+        "lags": np.asarray(lags, dtype=np.int16),
+        "cluster_ids": np.asarray(cluster_ids, dtype=np.int64),
+    }
+    write_npy_store(store_dir, arrays, store_metadata)
+    print(f"Waveform correlation matrix written to {store_dir}")
+    return store_dir
+
+
+def read_waveform_correlation(store_dir):
+    """Returns (correlation, lags, cluster_ids) of write_waveform_correlation()"""
+    arrays, _ = read_npy_store(store_dir, mmap_mode=None)
+    return arrays["correlation"], arrays["lags"], arrays["cluster_ids"]
+
+
+def waveform_correlation_path(wave_export_path):
+    """
+    Returns the default store of a `_waves.tsv` file.
+    example: 20211109_15h09m07s_waves.tsv -> 20211109_15h09m07s_waves_corr
+    """
+    base = path.splitext(wave_export_path)[0]
+    if base.endswith("_waves"):
+        base = base[: -len("_waves")]
+    return base + CORRELATION_SUFFIX
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="mean waveform correlation matrix")
+    parser.add_argument(dest="waves_tsv", action="store")
+    parser.add_argument(
+        "--max_lag", action="store", dest="max_lag", type=int, default=0
+    )
+    parser.add_argument("--out", action="store", dest="out", default=None)
+    args = parser.parse_args()
+
+    cluster_ids, mean_waves = read_mean_waveforms_tsv(args.waves_tsv)
+    correlation, lags = waveform_correlation_matrix(mean_waves, args.max_lag)
+    write_waveform_correlation(
+        args.out or waveform_correlation_path(args.waves_tsv),
+        correlation,
+        lags,
+        cluster_ids,
+        metadata={"max_lag": args.max_lag, "source": path.basename(args.waves_tsv)},
+    )
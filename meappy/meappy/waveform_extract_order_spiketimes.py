@@ -7,12 +7,40 @@
 
 from os import path
 import argparse
+import sys
 
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from meappy.curation_diff import (curation_diff, curation_snapshot_path, is_curation_edit,
+                                  patch_unit_dict, patch_unit_rows, read_curation_snapshot,
+                                  write_curation_snapshot)
+from meappy.export_cache import (check_export_cache, phy_inputs, read_export_cache,
+                                 write_export_cache)
+from meappy.med64_recording import open_recording
+from meappy.spike_trains import SpikeTrains
+from meappy.waveform import (PhyData, PhyPaths, extract_spike_waves, extract_spike_waves_sequential,
+                             extract_spike_footprints)
+from meappy.electrode_layout import DEFAULT_NEIGHBOR_RADIUS, electrode_neighbors
+from meappy.npy_store import read_npy_store
+from meappy.waveform_store import (read_waveform_store, waveform_store_path,
+                                   write_waveform_store)
+from meappy.waveform_stats import (WAVEFORM_STATS_SUFFIX, accumulate_times_waves,
+                                   accumulate_unit_waveforms, write_mean_waveforms_tsv,
+                                   write_waveform_stats)
+from meappy.waveform_features import accumulator_feature_table, waveform_feature_tables
+from meappy.spike_alignment import DEFAULT_UPSAMPLE_FACTOR, align_spike_waves
+from meappy.spike_drift import (DRIFT_SUFFIX, drift_traces, spike_amplitudes,
+                                unit_drift_table, write_drift_traces)
+from meappy.preprocessing import filtered_path, open_filtered_recording
+from meappy.waveform_correlation import (waveform_correlation_matrix,
+                                         waveform_correlation_path,
+                                         write_waveform_correlation)
                                                 
 
 Fs=20000  # sample frequency Hz
@@ -25,13 +53,24 @@ GOOD_CLUST_MIN_SPIKES = 10
 SAMPLE_WINDOW_WIDTH = 121  # 401  
 PRE_SAMPLES = 30  # 200 = 10msec
 
+# waveform extraction modes of the command line `--mode` argument
+EXTRACT_MODES = ('batch', 'sequential', 'parallel')
 
-def get_raw_data(med64_bin_path):
+
+def get_raw_data(med64_bin_path, mmap=False):
     """
     Opens modat.bin raw med64 physiology file. Returns a numpy matrix
     64 x N dimensions. Where 64 is the channels 0 to 63 and N is the 
     int16 amplitude of each channel in 20 kHz samples
+    If mmap is True, the matrix is a read-only memory mapped view of the
+    file, so only the samples around each spike are read from disk.
+    The channel major companion file is used instead when it is up to date.
     """
+    if mmap:
+        recording = open_recording(med64_bin_path, n_channels=nCh, fs=Fs)
+        print(f'Data duration {round(recording.duration_sec / 60, 1)} minutes')
+        return recording.data
+
     with open(med64_bin_path, "rb") as file:
         bin_data = np.fromfile(file, dtype=np.int16)  # np.int16  or np.short
         
@@ -82,15 +121,9 @@ def get_phy_spikes_list(phy_spike_data, phy_spk_clust_data):
     iterates through list of channel numbers (int)
     must use spike clusters, as the templates are not updated with 
     slices and merging of clusters.
-    Returns as dict.
+    Returns as SpikeTrains, a mapping of cluster to an array of spike times.
     """
-    unit_spike_times = dict()
-    for time, unit in zip(phy_spike_data, phy_spk_clust_data):
-        if unit in unit_spike_times:
-            unit_spike_times[unit].append(time)
-        else:
-            unit_spike_times[unit] = list([time])
-    return unit_spike_times
+    return SpikeTrains.from_spikes(phy_spike_data, phy_spk_clust_data)
 
     
 def convert_spike_freq(unit_spike_times, Fs):
@@ -98,10 +131,7 @@ def convert_spike_freq(unit_spike_times, Fs):
     Takes spike times from phy in samples and converts to sec
     using Fs -- frequency per sec
     """
-    new_times = dict()
-    for unit in unit_spike_times:
-        new_times[unit] = np.array(unit_spike_times[unit]) / Fs
-    return new_times
+    return SpikeTrains.from_dict(unit_spike_times).scaled(1 / Fs)
 
 
 def get_raw_phy_spike_waves(matrix_data, unit_spike_times, unit_list, \
@@ -110,6 +140,9 @@ def get_raw_phy_spike_waves(matrix_data, unit_spike_times, unit_list, \
     unit_list is list of units
     return dict of channels. value of each item is numpy array with dims 
     (num_spikes, raw_wave_sample_size)
+    All spikes of a unit are gathered at once with extract_spike_waves().
+    Waveforms of spikes near the edges of the recording are padded with
+    the first or last sample.
     """
     # clust_info_data has clust, chan
     # unit_spike_times replaces amp_spikes_map
@@ -117,21 +150,9 @@ def get_raw_phy_spike_waves(matrix_data, unit_spike_times, unit_list, \
     ## todo: change `unit` to `chan`
     raw_waves = dict()
     for unit, ch in unit_list:
-        spike_num = len(unit_spike_times[unit])
-        raw_waves[int(unit)] = np.ndarray((spike_num, sample_window_width))
-        
-    for unit, ch in unit_list:
-        spike_times = unit_spike_times[unit]
-        for i, time in enumerate(spike_times):
-            min_point, max_point = get_window(time, sample_window_width, pre_samples)
-            try:
-                raw_spike_waveform = matrix_data[ch][min_point:(max_point+1)]
-            except IndexError:
-                print(f'matrix_data Index Out of Range for channel: {ch}, range:({min_point}, {max_point})')
-            try:
-                raw_waves[int(unit)][i] = raw_spike_waveform
-            except ValueError:
-                print(f'MyValueError: raw_spike_waveform shape {raw_spike_waveform.shape}')
+        raw_waves[int(unit)], in_bounds = extract_spike_waves(
+            matrix_data[ch], unit_spike_times[unit], sample_window_width, pre_samples)
+        report_edge_spikes(unit, ch, in_bounds)
     return raw_waves
 
 
@@ -155,26 +176,12 @@ def get_ordered_raw_phy_spike_waves(matrix_data, unit_spike_times, unit_list, \
     raw_waves = dict()
     raw_times = dict()
     
-    # allocate arrays
-    for unit, ch in unit_list:
-        spike_num = len(unit_spike_times[unit])
-        raw_waves[int(unit)] = np.ndarray((spike_num, sample_window_width))
-        raw_times[int(unit)] = np.ndarray((spike_num, 1))
-
     for unit, ch in unit_list:
         spike_times = unit_spike_times[unit]
-        for i, time in enumerate(spike_times):
-            min_point, max_point = get_window(time, sample_window_width, pre_samples)
-            try:
-                raw_spike_waveform = matrix_data[ch][min_point:(max_point+1)]
-            except IndexError:
-                print(f'matrix_data Index Out of Range for channel: {ch}, range:({min_point}, {max_point})')
-            try:
-                raw_waves[int(unit)][i] = raw_spike_waveform
-                raw_times[int(unit)][i] = time
-                # raw_waves[int(unit)][WAVES][i] = raw_spike_waveform
-            except ValueError:
-                print(f'MyValueError: raw_spike_waveform shape {raw_spike_waveform.shape}')
+        raw_waves[int(unit)], in_bounds = extract_spike_waves(
+            matrix_data[ch], spike_times, sample_window_width, pre_samples)
+        raw_times[int(unit)] = np.asarray(spike_times, dtype=float).reshape(-1, 1)
+        report_edge_spikes(unit, ch, in_bounds)
                 
     times_waves = dict()
     times_waves['waves'] = raw_waves
@@ -183,6 +190,151 @@ def get_ordered_raw_phy_spike_waves(matrix_data, unit_spike_times, unit_list, \
     return times_waves
 
 
+def get_ordered_raw_phy_spike_waves_sequential(med64_bin_path, unit_spike_times, unit_list, \
+                            sample_window_width, pre_samples, chunk_sec=10):
+    """
+    Same output as get_ordered_raw_phy_spike_waves(), but reads the modat.bin
+    file once from beginning to end in chunks of chunk_sec, so memory use is
+    bounded by the chunk size and the output, for files larger than RAM.
+    All spikes of all units are sorted by sample time and filled in as their
+    chunk is read, see extract_spike_waves_sequential().
+    """
+    units = [int(unit) for unit, ch in unit_list]
+    spike_times = [np.asarray(unit_spike_times[unit]) for unit, ch in unit_list]
+    counts = [len(times) for times in spike_times]
+    spike_channels = np.repeat([ch for unit, ch in unit_list], counts)
+    all_spike_times = np.concatenate(spike_times) if counts else np.empty(0)
+
+    waves, in_bounds = extract_spike_waves_sequential(
+        med64_bin_path, all_spike_times, spike_channels, sample_window_width,
+        pre_samples, chunk_sec)
+
+    raw_waves = dict()
+    raw_times = dict()
+    splits = np.cumsum(counts)[:-1]
+    unit_waves = np.split(waves, splits)
+    unit_in_bounds = np.split(in_bounds, splits)
+    for i, (unit, ch) in enumerate(unit_list):
+        raw_waves[units[i]] = unit_waves[i]
+        raw_times[units[i]] = np.asarray(spike_times[i], dtype=float).reshape(-1, 1)
+        report_edge_spikes(unit, ch, unit_in_bounds[i])
+
+    times_waves = dict()
+    times_waves['waves'] = raw_waves
+    times_waves['times'] = raw_times
+
+    return times_waves
+
+
+def _extract_unit_group(med64_bin_path, unit_spike_times, unit_list, \
+                        sample_window_width, pre_samples):
+    """
+    Worker of get_ordered_raw_phy_spike_waves_parallel(). Opens its own
+    read-only memory map of the recording, so the raw data is never pickled.
+    """
+    matrix_data = open_recording(med64_bin_path, n_channels=nCh, fs=Fs).data
+    return get_ordered_raw_phy_spike_waves(
+        matrix_data, unit_spike_times, unit_list, sample_window_width, pre_samples)
+
+
+def get_ordered_raw_phy_spike_waves_parallel(med64_bin_path, unit_spike_times, unit_list, \
+                            sample_window_width, pre_samples, n_workers=None):
+    """
+    Same output as get_ordered_raw_phy_spike_waves(), with the units split
+    into groups of (cluster_id, ch) pairs extracted in worker processes.
+    Each worker memory maps the same modat.bin file and only the spike times
+    of its units are sent to it. Units are dealt to the groups from the
+    largest spike count down, so the groups have similar amounts of work.
+    """
+    n_workers = n_workers or os.cpu_count() or 1
+    unit_list = [(int(unit), int(ch)) for unit, ch in unit_list]
+    by_size = sorted(unit_list, key=lambda uc: len(unit_spike_times[uc[0]]), reverse=True)
+    n_groups = min(n_workers, len(unit_list))
+    groups = [by_size[i::n_groups] for i in range(n_groups)]
+
+    raw_waves = dict()
+    raw_times = dict()
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [
+            executor.submit(
+                _extract_unit_group, med64_bin_path,
+                {unit: unit_spike_times[unit] for unit, ch in group}, group,
+                sample_window_width, pre_samples)
+            for group in groups]
+        for future in futures:
+            group_times_waves = future.result()
+            raw_waves.update(group_times_waves['waves'])
+            raw_times.update(group_times_waves['times'])
+
+    # keep the order of unit_list
+    times_waves = dict()
+    times_waves['waves'] = {unit: raw_waves[unit] for unit, ch in unit_list}
+    times_waves['times'] = {unit: raw_times[unit] for unit, ch in unit_list}
+
+    return times_waves
+
+
+def get_ordered_raw_phy_spike_footprints(matrix_data, unit_spike_times, unit_list, \
+                            sample_window_width, pre_samples, radius=DEFAULT_NEIGHBOR_RADIUS):
+    """
+    Multi-electrode version of get_ordered_raw_phy_spike_waves(). The waveform
+    of each spike is cut from the unit's channel and its neighbors within
+    radius (in electrode pitch units) on the 8x8 MED64 grid.
+    Returns dict with keys:
+        'footprints': {unit: (num_spikes, num_neighbors, raw_wave_sample_size) array}
+        'channels': {unit: channel of each neighbor, -1 for padding}
+        'times': {unit: (num_spikes, 1) array of spike times}
+    """
+    neighbors = electrode_neighbors(radius)
+    footprints = dict()
+    channels = dict()
+    raw_times = dict()
+    for unit, ch in unit_list:
+        spike_times = unit_spike_times[unit]
+        footprints[int(unit)], channels[int(unit)], in_bounds = extract_spike_footprints(
+            matrix_data, ch, spike_times, sample_window_width, pre_samples, neighbors)
+        raw_times[int(unit)] = np.asarray(spike_times, dtype=float).reshape(-1, 1)
+        report_edge_spikes(unit, ch, in_bounds)
+
+    times_footprints = dict()
+    times_footprints['footprints'] = footprints
+    times_footprints['channels'] = channels
+    times_footprints['times'] = raw_times
+    return times_footprints
+
+
+def align_ordered_raw_phy_spike_waves(times_waves, pre_samples,
+                                      factor=DEFAULT_UPSAMPLE_FACTOR):
+    """
+    Sub-sample alignment of the output of get_ordered_raw_phy_spike_waves().
+    The waveforms of each unit are upsampled by factor and re-centered on
+    their troughs, see align_spike_waves(). Returns the same dict format with
+    the aligned waves, and the refined fractional spike times as 'times'.
+    """
+    aligned_waves = dict()
+    refined_times = dict()
+    for unit in times_waves['waves']:
+        aligned_waves[unit], times, target = align_spike_waves(
+            times_waves['waves'][unit], times_waves['times'][unit],
+            pre_samples, factor)
+        refined_times[unit] = times.reshape(-1, 1)
+
+    times_waves = dict()
+    times_waves['waves'] = aligned_waves
+    times_waves['times'] = refined_times
+    return times_waves
+
+
+def report_edge_spikes(unit, ch, in_bounds):
+    """
+    Prints the number of spikes whose waveform window runs past the
+    beginning or end of the recording, from the mask of extract_spike_waves()
+    """
+    if not in_bounds.all():
+        print(f'{np.sum(~in_bounds)} spikes of unit {unit} on channel {ch} '
+              f'padded at the edge of the recording')
+
+
 def get_wave_source_dict(raw_waves, active_chan):
     """
     Takes the number of samples around spike to be created width_samples, 
@@ -225,10 +377,37 @@ if __name__ == '__main__':
     parser.add_argument(dest='expt_date_dir', action="store")
     parser.add_argument('--plots', '-p', action="store", dest='plots', default=True)
     parser.add_argument('--phy_dir', action="store", dest='phy_dir', default=False)
-    parser.add_argument('--raw', action="store", dest='raw', default=False)
+    parser.add_argument('--raw', action="store", dest='raw', default=False,
+                        help="'True' also exports raw waves as _waves_raw.json")
+    parser.add_argument('--mode', action="store", dest='mode', default='batch',
+                        choices=EXTRACT_MODES,
+                        help="batch: gather each unit from the memory mapped file, "
+                        "sequential: one pass over the file for files larger than RAM, "
+                        "parallel: units split across worker processes")
+    parser.add_argument('--workers', action="store", dest='workers', type=int,
+                        default=None, help="number of processes of parallel mode")
+    parser.add_argument('--summary_only', action="store", dest='summary_only',
+                        default=False, help="'True' streams the waveforms through "
+                        "per unit statistics and only exports the summaries")
+    parser.add_argument('--corr_max_lag', action="store", dest='corr_max_lag', type=int,
+                        default=0, help="largest shift in samples of the lag tolerant "
+                        "mean waveform correlation matrix")
+    parser.add_argument('--align', action="store", dest='align', default=False,
+                        help="'True' aligns waveforms on their troughs at sub-sample "
+                        "resolution and exports refined fractional spike times")
+    parser.add_argument('--align_factor', action="store", dest='align_factor', type=int,
+                        default=DEFAULT_UPSAMPLE_FACTOR, help="upsampling factor of --align")
+    parser.add_argument('--drift', action="store", dest='drift', default=False,
+                        help="'True' exports per unit amplitude and position drift")
+    parser.add_argument('--drift_bin_sec', action="store", dest='drift_bin_sec',
+                        type=float, default=60.0, help="time bin of the drift traces")
+    parser.add_argument('--force', action="store", dest='force', default=False,
+                        help="'True' exports even if the PHY files, raw data and "
+                        "export parameters did not change since the last export")
     args = parser.parse_args()
     print(f"Show plots: {args.plots}")
-    print(f"save raw waveforms: {args.raw}")
+    print(f"save raw waveforms as JSON: {args.raw}")
+    print(f"extraction mode: {args.mode}")
 
 
     modat_path = args.expt_date_dir
@@ -250,104 +429,221 @@ if __name__ == '__main__':
     wave_export_path = path.join(export_path, wave_file)
     raw_wave_file = expt_id + '_waves_raw.json'
     raw_wave_export_path  = path.join(export_path, raw_wave_file)
-    
-    # spike_times is just times, without mention of what unit
-    phy_spike_times_path = path.join(phy_path, 'spike_times.npy')
-
-    # spike template is same shape as spike_times, so probably assigns template to each spike
-    # spike template range is from 0 to 152 (the first dimension of template, so probably unit id)
-    phy_spk_template_path = path.join(phy_path, 'spike_templates.npy')
-    phy_templ_idx_path = path.join(phy_path, 'template_ind.npy')
-
-    # matrix of shape (U,I,J) where U appears to be the unit/cluster number, why are there still 2 more dims for template?
-    # i think that the I (len = 61) is time before and after spike of 3ms (60 samples = 3ms), plotted peak is in center
-    # J is len 36. could that be some version of electrodes?
-    phy_spk_clust_path = path.join(phy_path, 'spike_clusters.npy')
-    phy_spike_data = np.load(phy_spike_times_path)
-    phy_spk_clust__data = np.load(phy_spk_clust_path)
-    phy_clust_info_path = path.join(phy_path, 'cluster_info.tsv')
-    clust_info_data = pd.read_csv(phy_clust_info_path, sep='\t')
-
-    # clust_info_data['clust_info_data', 'ch', 'group']
-    good_clust = (clust_info_data['group']=='good') & \
-                (clust_info_data['n_spikes']>=GOOD_CLUST_MIN_SPIKES)
-    clust_chan = clust_info_data[good_clust][['cluster_id', 'ch']].to_numpy() 
-
-    
-    # This step takes time
-    matrix_data = get_raw_data(med64_bin_path)
-
-    
-    unit_spike_times = get_phy_spikes_list(phy_spike_data, phy_spk_clust__data)
+    wave_store_path = waveform_store_path(export_path, expt_id)
+    wave_stats_path = path.join(export_path, expt_id + WAVEFORM_STATS_SUFFIX)
+    features_export_path = path.join(export_path, expt_id + '_features.tsv')
+    spike_amp_export_path = path.join(export_path, expt_id + '_spike_amplitudes.tsv')
+    drift_export_path = path.join(export_path, expt_id + '_drift.tsv')
+    med64_filtered_path = filtered_path(med64_bin_path)
+
+    # skip the export if the inputs and parameters did not change since the
+    # last one, see export_cache.py
+    cache_path = path.join(export_path, expt_id + '_waves_cache.json')
+    cache_inputs = phy_inputs(PhyPaths(phy_path), med64_bin_path)
+    if args.drift == 'True':
+        cache_inputs['med64_filtered'] = med64_filtered_path
+    cache_params = {'SAMPLE_WINDOW_WIDTH': SAMPLE_WINDOW_WIDTH,
+                    'PRE_SAMPLES': PRE_SAMPLES,
+                    'GOOD_CLUST_MIN_SPIKES': GOOD_CLUST_MIN_SPIKES, 'Fs': Fs,
+                    'raw': args.raw, 'summary_only': args.summary_only,
+                    'corr_max_lag': args.corr_max_lag, 'align': args.align,
+                    'align_factor': args.align_factor, 'drift': args.drift,
+                    'drift_bin_sec': args.drift_bin_sec}
+    cache_outputs = [wave_export_path, wave_stats_path, features_export_path,
+                     waveform_correlation_path(wave_export_path)]
+    if args.summary_only != 'True':
+        cache_outputs += [wave_store_path, spike_amp_export_path]
+    if args.raw == 'True' and args.summary_only != 'True':
+        cache_outputs.append(raw_wave_export_path)
+    if args.drift == 'True':
+        cache_outputs.append(drift_export_path)
+    previous_cache = read_export_cache(cache_path)
+    is_current, cache = check_export_cache(
+        cache_path, cache_inputs, cache_params, cache_outputs)
+    if is_current and args.force != 'True':
+        print(f"{expt_id} is unchanged since the last export, skipped. "
+              "Use --force True to export again")
+        sys.exit(0)
+
+    # PHY files are memory mapped and parsed on first use, see PhyData
+    phy_data = PhyData(phy_path)
+    clust_chan = phy_data.good_clust_chan(GOOD_CLUST_MIN_SPIKES)
+
+    unit_spike_times = phy_data.spike_trains
     unit_spike_fs_times = convert_spike_freq(unit_spike_times, Fs)
+
+    # after a curation edit in PHY only the created and changed units are
+    # extracted, the others are read from the last export, see curation_diff.py
+    diff = None
+    snapshot_path = curation_snapshot_path(export_path, expt_id, 'waves')
+    old_spike_clusters, old_unit_list = read_curation_snapshot(snapshot_path)
+    if (args.force != 'True' and args.summary_only != 'True'
+            and old_unit_list is not None and path.exists(wave_store_path)
+            and is_curation_edit(previous_cache, cache)):
+        diff = curation_diff(old_spike_clusters, phy_data.spk_clust,
+                             old_unit_list, clust_chan)
+        print(f"Curation edit since the last export: {diff}")
+    extract_units = clust_chan
+    if diff is not None:
+        extract_units = clust_chan[np.isin(clust_chan[:, 0], diff.recompute)]
     
     
     
     
     ### CHANGE FOR ORDERED
-    times_waves = get_ordered_raw_phy_spike_waves(
-        matrix_data, unit_spike_times, unit_list=clust_chan, 
-        sample_window_width=SAMPLE_WINDOW_WIDTH, pre_samples=PRE_SAMPLES)
-
-    raw_waves = times_waves['waves'] 
-    raw_times = times_waves['times']
+    if args.summary_only == 'True':
+        # waveforms are streamed through the per unit statistics, in batches,
+        # so no raw waveforms are kept and only the summaries are exported
+        matrix_data = get_raw_data(med64_bin_path, mmap=True)
+        accumulators = accumulate_unit_waveforms(
+            matrix_data, unit_spike_times, unit_list=clust_chan,
+            sample_window_width=SAMPLE_WINDOW_WIDTH, pre_samples=PRE_SAMPLES,
+            align_factor=args.align_factor if args.align == 'True' else None)
+        times_waves = None
+    elif not len(extract_units):
+        times_waves = {'waves': dict(), 'times': dict()}
+    elif args.mode == 'sequential':
+        times_waves = get_ordered_raw_phy_spike_waves_sequential(
+            med64_bin_path, unit_spike_times, unit_list=extract_units,
+            sample_window_width=SAMPLE_WINDOW_WIDTH, pre_samples=PRE_SAMPLES)
+    elif args.mode == 'parallel':
+        times_waves = get_ordered_raw_phy_spike_waves_parallel(
+            med64_bin_path, unit_spike_times, unit_list=extract_units,
+            sample_window_width=SAMPLE_WINDOW_WIDTH, pre_samples=PRE_SAMPLES,
+            n_workers=args.workers)
+    else:
+        # memory map the raw data, only the samples around each spike are read
+        matrix_data = get_raw_data(med64_bin_path, mmap=True)
+        times_waves = get_ordered_raw_phy_spike_waves(
+            matrix_data, unit_spike_times, unit_list=extract_units,
+            sample_window_width=SAMPLE_WINDOW_WIDTH, pre_samples=PRE_SAMPLES)
+
+    if times_waves is not None and args.align == 'True':
+        print(f"aligning waveforms on their troughs, upsampled {args.align_factor}x")
+        times_waves = align_ordered_raw_phy_spike_waves(
+            times_waves, PRE_SAMPLES, args.align_factor)
+        # aligned waves are stored as float32, the waves of recomputed units
+        # have the precision of the units read from the store after an edit
+        times_waves['waves'] = {unit: waves.astype(np.float32)
+                                for unit, waves in times_waves['waves'].items()}
+
+    if diff is not None:
+        # waves of the unchanged units from the last export
+        previous_times_waves = read_waveform_store(wave_store_path).to_times_waves()
+        times_waves = {key: patch_unit_dict(previous_times_waves[key],
+                                            times_waves[key], clust_chan[:, 0])
+                       for key in ('waves', 'times')}
+
+    if times_waves is not None:
+        accumulators = accumulate_times_waves(times_waves)
     
-    print(f"Wave clusters found: {raw_waves.keys()}")
+    print(f"Wave clusters found: {accumulators.keys()}")
 
-    # This needs to be updated to new times_waves format
     if args.plots == 'True':
         print(f"arg.plots is {args.plots}")
-        for clust in range(clust_chan.shape[0]):
-            plt.plot(np.mean(raw_waves[clust_chan[clust][0]][WAVES][:], axis=0))
+        for clust in accumulators:
+            plt.plot(accumulators[clust].mean)
+            plt.fill_between(np.arange(SAMPLE_WINDOW_WIDTH),
+                             *accumulators[clust].percentiles((5, 95)), alpha=0.3)
             plt.show()
         print("plots done")
     else:
         print(f"arg.plots is {args.plots}, not 'True'")
         
 
-    # new ordered times
-    if True: #args.raw == 'True':
-        print(f"exporting all raw waves as {raw_wave_export_path}")
-        raw_waves_json = dict()
-        raw_times_json = dict()
-        for clust in times_waves['waves'].keys():
-            raw_waves_json[int(clust)] = times_waves['waves'][clust].tolist() 
-            raw_times_json[int(clust)] = times_waves['times'][clust].tolist() 
-        print(type(raw_waves_json[int(clust)]))
-
-        times_waves_json = {'waves': raw_waves_json,
-                            'times': raw_times_json}
-
-        raw_header = "Raw waves are in JSON format " \
-            "{'clust_id': [nested list of 121 sample waveforms for clust_id]}. " \
-            "All waveforms are 20kHz with the spike triggered at sample 31."
+    if times_waves is not None:
+        # binary waveform store, memory mappable with np.load(..., mmap_mode='r')
+        print(f"exporting all raw waves as {wave_store_path}")
+        # aligned waves are interpolated, keep them as float32
+        write_waveform_store(
+            wave_store_path, times_waves, unit_list=clust_chan,
+            metadata={'slice_id': expt_id, 'Fs': Fs, 'pre_samples': PRE_SAMPLES,
+                      'phy_dir': phy_path, 'aligned': args.align == 'True'},
+            dtype=np.float32 if args.align == 'True' else np.int16)
+
+        # new ordered times, JSON export is opt-in
+        if args.raw == 'True':
+            print(f"exporting all raw waves as {raw_wave_export_path}")
+            raw_waves_json = dict()
+            raw_times_json = dict()
+            for clust in times_waves['waves'].keys():
+                raw_waves_json[int(clust)] = times_waves['waves'][clust].tolist()
+                raw_times_json[int(clust)] = times_waves['times'][clust].tolist()
+            print(type(raw_waves_json[int(clust)]))
+
+            times_waves_json = {'waves': raw_waves_json,
+                                'times': raw_times_json}
+
+            raw_header = "Raw waves are in JSON format " \
+                "{'clust_id': [nested list of 121 sample waveforms for clust_id]}. " \
+                "All waveforms are 20kHz with the spike triggered at sample 31."
         
-        raw_header = "Raw waves are in JSON format " \
-            "{{'waves': {'clust_id': [nested list of 121 sample waveforms for clust_id]}}," \
-            "{'times': {'clust_id': [list of times of each wave]}}}." \
-            "All waveforms are 20kHz with the spike triggered at sample 31."
+            raw_header = "Raw waves are in JSON format " \
+                "{{'waves': {'clust_id': [nested list of 121 sample waveforms for clust_id]}}," \
+                "{'times': {'clust_id': [list of times of each wave]}}}." \
+                "All waveforms are 20kHz with the spike triggered at sample 31."
             
-        with open(raw_wave_export_path, 'w') as fp:
-            json.dump(times_waves_json, fp)
-
-
-
-    waveforms = None
-    for clust in range(clust_chan.shape[0]):
-        mean_waveform = np.mean(raw_waves[clust_chan[clust][0]][:], axis=0)
-        # Add the cluster number to the beginning of the waveform
-        clust_id = clust_chan[clust][0]
-        mean_waveform = np.concatenate(([clust_id], mean_waveform))
-        if waveforms is None:
-            waveforms = mean_waveform
+            with open(raw_wave_export_path, 'w') as fp:
+                json.dump(times_waves_json, fp)
+
+
+    # mean waveforms and the mean, sd, percentile bands and reservoir sample
+    write_mean_waveforms_tsv(wave_export_path, accumulators, Fs)
+    write_waveform_stats(
+        wave_stats_path, accumulators,
+        metadata={'slice_id': expt_id, 'Fs': Fs, 'pre_samples': PRE_SAMPLES})
+    print(f"waveform statistics saved to: {wave_stats_path}")
+
+    # features of all units, and amplitude of every spike if the waves were kept
+    if times_waves is not None:
+        unit_features, spike_amplitude_table = waveform_feature_tables(
+            times_waves, clust_chan, pre_samples=PRE_SAMPLES, fs=Fs)
+        spike_amplitude_table.to_csv(spike_amp_export_path, sep='\t', index=False)
+        print(f"spike amplitudes saved to: {spike_amp_export_path}")
+    else:
+        unit_features = accumulator_feature_table(
+            accumulators, clust_chan, pre_samples=PRE_SAMPLES, fs=Fs)
+    unit_features.to_csv(features_export_path, sep='\t', index=False)
+    print(f"waveform features saved to: {features_export_path}")
+
+    # correlation matrix of the mean waveforms for meapr
+    correlation, lags = waveform_correlation_matrix(
+        [accumulators[clust].mean for clust in accumulators],
+        max_lag=args.corr_max_lag)
+    write_waveform_correlation(
+        waveform_correlation_path(wave_export_path), correlation, lags,
+        list(accumulators.keys()),
+        metadata={'slice_id': expt_id, 'max_lag': args.corr_max_lag})
+
+    if args.drift == 'True':
+        # amplitudes on the filtered data when it has been written
+        if path.exists(med64_filtered_path):
+            print(f"measuring spike amplitudes on {med64_filtered_path}")
+            drift_data = open_filtered_recording(med64_filtered_path).data
         else:
-            waveforms = np.vstack((waveforms, mean_waveform))
-        if clust_chan.shape[0] == 1:
-            waveforms = np.reshape(waveforms, (-1, SAMPLE_WINDOW_WIDTH))
-        
-        
-    np.savetxt(wave_export_path, waveforms, fmt='%.6f', delimiter="\t", \
-              header= f'Waveforms: rows are units; first column is PHY cluster id; columns are times at 20k Hz; Cluster IDs in order: {list(raw_waves.keys())}', \
-              comments='# ')
-    print(f"waveforms saved to: {wave_export_path}")
-    
\ No newline at end of file
+            drift_data = get_raw_data(med64_bin_path, mmap=True)
+        drift_store_path = path.join(export_path, expt_id + DRIFT_SUFFIX)
+        patch_drift = diff is not None and path.exists(drift_store_path)
+        if patch_drift:
+            previous_traces, _ = read_npy_store(drift_store_path, mmap_mode=None)
+            # a curation edit that only removed units keeps the other traces
+            traces = previous_traces
+        if not patch_drift or len(extract_units):
+            amplitudes = spike_amplitudes(drift_data, unit_spike_times,
+                                          extract_units if patch_drift else clust_chan)
+            traces = drift_traces(amplitudes, bin_sec=args.drift_bin_sec,
+                                  duration_sec=drift_data.shape[1] / Fs, fs=Fs)
+        if patch_drift:
+            traces = patch_unit_rows(previous_traces, traces, clust_chan[:, 0],
+                                     row_keys=('counts', 'amplitude', 'position'))
+        write_drift_traces(
+            drift_store_path, traces,
+            metadata={'slice_id': expt_id, 'bin_sec': args.drift_bin_sec})
+        drift_table = unit_drift_table(traces)
+        drift_table.to_csv(drift_export_path, sep='\t', index=False)
+        print(f"{drift_table['drifting'].sum()} of {len(drift_table)} units drift, "
+              f"saved to: {drift_export_path}")
+
+    write_curation_snapshot(snapshot_path, phy_data.spk_clust, clust_chan,
+                            metadata={'slice_id': expt_id})
+    write_export_cache(cache_path, cache)
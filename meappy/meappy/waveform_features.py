@@ -0,0 +1,213 @@
+# Waveform feature table of all units
+#
+# Features used to separate putative dopamine and GABA neurons are computed
+# for every unit at once from the stacked (num_units, window) mean waveforms,
+# with no per-unit Python loop:
+#   trough_amplitude   minimum of the baseline subtracted mean waveform
+#   peak_amplitude     maximum of the mean waveform after the trough
+#   amplitude          peak_amplitude - trough_amplitude
+#   trough_to_peak_ms  time from the trough to the following peak
+#   half_width_ms      width of the trough at half of trough_amplitude
+#   repolarization_slope  steepest rise between trough and peak, per ms
+#   noise              baseline standard deviation across spikes
+#   snr                amplitude / noise
+# The waveforms of each unit are reduced in place, so no float copy of all
+# the waveforms of a slice is made. Per-spike amplitudes are one gather per unit.
+# Amplitudes are in the units of the raw data (int16 MED64 samples).
+
+import numpy as np
+import pandas as pd
+
+from meappy.waveform import Fs
+
+BASELINE_GUARD_SAMPLES = 5  # samples just before the spike left out of the baseline
+FEATURE_NAMES = [
+    "trough_amplitude",
+    "peak_amplitude",
+    "amplitude",
+    "trough_to_peak_ms",
+    "half_width_ms",
+    "repolarization_slope",
+    "noise",
+    "snr",
+    "trough_index",
+    "peak_index",
+]
+# columns of the unit feature table, the same with or without per-spike waveforms
+UNIT_COLUMNS = ["cluster_id", "n_spikes", "ch"] + FEATURE_NAMES + ["spike_amplitude_sd"]
+SPIKE_COLUMNS = ["cluster_id", "spike_time", "amplitude"]
+
+
+def baseline_slice(pre_samples):
+    """Samples of the pre-spike window used as the baseline"""
+    return slice(0, max(pre_samples - BASELINE_GUARD_SAMPLES, 1))
+
+
+def unit_waveform_features(mean_waves, noise, pre_samples, fs=Fs):
+    """
+    Features of a stack of mean waveforms.
+    Params:
+        mean_waves: np.ndarray, (num_units, window) mean waveform of each unit
+        noise: np.ndarray, (num_units,) baseline noise of each unit
+        pre_samples: int, samples before the spike time in each waveform
+        fs: sample frequency in Hz
+    Returns:
+        dict of (num_units,) arrays, see the module comment, plus the
+        trough_index and peak_index samples used for per-spike amplitudes
+    """
+    mean_waves = np.atleast_2d(np.asarray(mean_waves, dtype=float))
+    n_units, width = mean_waves.shape
+    waves = mean_waves - mean_waves[:, baseline_slice(pre_samples)].mean(
+        axis=1, keepdims=True
+    )
+    rows = np.arange(n_units)
+    samples = np.arange(width)
+    ms_per_sample = 1000 / fs
+
+    trough_index = waves.argmin(axis=1)
+    trough = waves[rows, trough_index]
+    after_trough = samples[None, :] >= trough_index[:, None]
+    peak_index = np.where(after_trough, waves, -np.inf).argmax(axis=1)
+    peak = waves[rows, peak_index]
+
+    # half width: linear interpolation of the crossings of trough / 2 on each
+    # side of the trough, clipped to the window
+    half = trough[:, None] / 2
+    above = waves > half
+    left = np.where(above & (samples < trough_index[:, None]), samples, -1).max(axis=1)
+    right = np.where(above & (samples > trough_index[:, None]), samples, width).min(
+        axis=1
+    )
+    left_next = np.clip(left + 1, 0, width - 1)
+    left_0 = np.clip(left, 0, width - 1)
+    right_prev = np.clip(right - 1, 0, width - 1)
+    right_0 = np.clip(right, 0, width - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        left_frac = (waves[rows, left_0] - half[:, 0]) / (
+            waves[rows, left_0] - waves[rows, left_next]
+        )
+        right_frac = (half[:, 0] - waves[rows, right_prev]) / (
+            waves[rows, right_0] - waves[rows, right_prev]
+        )
+    left_cross = np.where(left >= 0, left + np.nan_to_num(left_frac), 0)
+    right_cross = np.where(
+        right < width, right_prev + np.nan_to_num(right_frac), width - 1
+    )
+    half_width = (right_cross - left_cross) * ms_per_sample
+
+    slope = np.diff(waves, axis=1) / ms_per_sample
+    rising = (samples[None, :-1] >= trough_index[:, None]) & (
+        samples[None, :-1] < peak_index[:, None]
+    )
+    repolarization_slope = np.where(rising, slope, -np.inf).max(axis=1)
+    repolarization_slope[~rising.any(axis=1)] = np.nan
+
+    amplitude = peak - trough
+    noise = np.asarray(noise, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        snr = amplitude / noise
+    return {
+        "trough_amplitude": trough,
+        "peak_amplitude": peak,
+        "amplitude": amplitude,
+        "trough_to_peak_ms": (peak_index - trough_index) * ms_per_sample,
+        "half_width_ms": half_width,
+        "repolarization_slope": repolarization_slope,
+        "noise": noise,
+        "snr": snr,
+        "trough_index": trough_index,
+        "peak_index": peak_index,
+    }
+
+
+def _unit_table(cluster_ids, counts, unit_list, features, spike_amplitude_sd):
+    """Table of unit features with the columns of UNIT_COLUMNS"""
+    units = pd.DataFrame({"cluster_id": cluster_ids, "n_spikes": counts})
+    channel_of = (
+        dict() if unit_list is None else {int(c): int(ch) for c, ch in unit_list}
+    )
+    units["ch"] = [channel_of.get(int(c), -1) for c in cluster_ids]
+    for name in FEATURE_NAMES:
+        units[name] = features[name] if len(cluster_ids) else np.empty(0)
+    units["spike_amplitude_sd"] = spike_amplitude_sd
+    return units
+
+
+def waveform_feature_tables(times_waves, unit_list=None, pre_samples=30, fs=Fs):
+    """
+    Features of all units from the output of get_ordered_raw_phy_spike_waves().
+    Means, baseline noise and per-spike amplitudes are reductions and gathers
+    over the waveform array of each unit, without float copies of all the
+    waveforms of the slice.
+    Params:
+        times_waves: dict, {'waves': {clust: array}, 'times': {clust: array}}
+        unit_list: array of (cluster_id, ch) pairs, optional, fills the ch column
+        pre_samples: int, samples before the spike time in each waveform
+        fs: sample frequency in Hz
+    Returns:
+        units: pd.DataFrame, one row of features per unit, columns UNIT_COLUMNS
+        spikes: pd.DataFrame, columns [cluster_id, spike_time, amplitude],
+            amplitude is the peak minus the trough of each spike at the
+            unit's mean trough and peak samples
+    """
+    # units without spikes have no features
+    waves = {int(c): w for c, w in times_waves["waves"].items() if len(w)}
+    cluster_ids = np.array(list(waves.keys()), dtype=int)
+    counts = np.array([len(w) for w in waves.values()], dtype=int)
+    if not len(cluster_ids):
+        units = _unit_table(cluster_ids, counts, unit_list, None, [])
+        return units, pd.DataFrame(columns=SPIKE_COLUMNS)
+
+    # across-spike variance of each baseline sample, averaged over the baseline
+    baseline = baseline_slice(pre_samples)
+    means, noise = [], []
+    for w in waves.values():
+        mean = w.mean(axis=0, dtype=float)
+        residual = w[:, baseline] - mean[baseline]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            noise.append(np.sqrt(((residual**2).sum(axis=0) / (len(w) - 1)).mean()))
+        means.append(mean)
+    features = unit_waveform_features(np.array(means), np.array(noise), pre_samples, fs)
+
+    spike_amplitudes, spike_amplitude_sd = [], []
+    for i, w in enumerate(waves.values()):
+        peak = w[:, features["peak_index"][i]].astype(float)
+        amplitude = peak - w[:, features["trough_index"][i]]
+        squares = ((amplitude - features["amplitude"][i]) ** 2).sum()
+        spike_amplitudes.append(amplitude)
+        spike_amplitude_sd.append(np.sqrt(squares / max(len(w) - 1, 1)))
+    units = _unit_table(cluster_ids, counts, unit_list, features, spike_amplitude_sd)
+
+    spike_times = [np.asarray(times_waves["times"][c]).reshape(-1) for c in waves]
+    spikes = pd.DataFrame(
+        {
+            "cluster_id": np.repeat(cluster_ids, counts),
+            "spike_time": np.concatenate(spike_times),
+            "amplitude": np.concatenate(spike_amplitudes),
+        }
+    )
+    return units, spikes
+
+
+def accumulator_feature_table(accumulators, unit_list=None, pre_samples=30, fs=Fs):
+    """
+    Unit features from the WaveformAccumulator of each unit (see
+    waveform_stats.py), for exports that do not keep the raw waveforms.
+    The columns are those of waveform_feature_tables(); there are no per-spike
+    amplitudes in this case, so spike_amplitude_sd is NaN.
+    """
+    cluster_ids = np.array(list(accumulators.keys()), dtype=int)
+    counts = np.array([accumulators[c].count for c in accumulators], dtype=int)
+    if not len(cluster_ids):
+        return _unit_table(cluster_ids, counts, unit_list, None, [])
+    means = np.array([accumulators[c].mean for c in accumulators])
+    noise = np.sqrt(
+        np.array(
+            [
+                accumulators[c].variance[baseline_slice(pre_samples)]
+                for c in accumulators
+            ]
+        ).mean(axis=1)
+    )
+    features = unit_waveform_features(means, noise, pre_samples, fs)
+    return _unit_table(cluster_ids, counts, unit_list, features, np.nan)
@@ -0,0 +1,233 @@
+# Streaming per-unit waveform statistics
+#
+# A WaveformAccumulator takes batches of spike waveforms of one unit as they
+# are extracted and keeps the running mean and variance (Welford's algorithm,
+# merged batch by batch) and a fixed size uniform reservoir sample of
+# individual waveforms. Percentile bands are estimated from the reservoir.
+# Memory per unit is O(reservoir_size x window) however many spikes the unit
+# has, so the `_waves.tsv` summary does not need all raw waveforms in memory.
+
+import numpy as np
+
+from meappy.npy_store import write_npy_store
+from meappy.waveform import Fs, extract_spike_waves
+from meappy.spike_alignment import align_spike_waves
+
+DEFAULT_RESERVOIR_SIZE = 200  # waveforms kept per unit for percentiles and display
+DEFAULT_PERCENTILES = (5, 25, 50, 75, 95)
+DEFAULT_BATCH_SPIKES = 4096  # spikes extracted at a time by accumulate_unit_waveforms()
+WAVEFORM_STATS_SUFFIX = "_waves_stats"
+
+
+class WaveformAccumulator:
+    """
+    Running statistics of the waveforms of one unit.
+
+    Params:
+        width: int, number of samples of each waveform
+        reservoir_size: int, number of waveforms kept in the reservoir sample
+        seed: int or np.random.Generator, for a reproducible reservoir
+    """
+
+    def __init__(self, width, reservoir_size=DEFAULT_RESERVOIR_SIZE, seed=None):
+        self.width = width
+        self.reservoir_size = reservoir_size
+        self.count = 0
+        self.mean = np.zeros(width)
+        self._m2 = np.zeros(width)  # sum of squared differences from the mean
+        self._reservoir = np.empty((reservoir_size, width))
+        self._rng = np.random.default_rng(seed)
+
+    def update(self, waves):
+        """
+        Adds a (num_spikes, width) batch of waveforms. The batch mean and sum
+        of squares are merged with the running values (Chan et al. parallel
+        form of Welford's algorithm), which is exact and numerically stable.
+        """
+        waves = np.asarray(waves, dtype=float).reshape(-1, self.width)
+        n_batch = waves.shape[0]
+        if not n_batch:
+            return self
+        batch_mean = waves.mean(axis=0)
+        batch_m2 = ((waves - batch_mean) ** 2).sum(axis=0)
+        total = self.count + n_batch
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta * (n_batch / total)
+        self._m2 = self._m2 + batch_m2 + delta**2 * (self.count * n_batch / total)
+        self._sample(waves)
+        self.count = total
+        return self
+
+    def _sample(self, waves):
+        """
+        Reservoir sampling (algorithm R) of a batch: waveform k of the stream
+        replaces a random slot with probability reservoir_size / (k + 1).
+        """
+        n_fill = min(max(self.reservoir_size - self.count, 0), len(waves))
+        self._reservoir[self.count : self.count + n_fill] = waves[:n_fill]
+        if n_fill == len(waves):
+            return
+        stream_index = self.count + np.arange(n_fill, len(waves))
+        slots = (self._rng.random(stream_index.size) * (stream_index + 1)).astype(int)
+        replace = slots < self.reservoir_size
+        slots, rows = slots[replace], np.nonzero(replace)[0] + n_fill
+        # a slot replaced twice in one batch keeps the later waveform
+        last_slots, last = np.unique(slots[::-1], return_index=True)
+        self._reservoir[last_slots] = waves[rows[::-1][last]]
+
+    @property
+    def variance(self):
+        """unbiased variance of each sample of the waveform, NaN below 2 spikes"""
+        if self.count < 2:
+            return np.full(self.width, np.nan)
+        return self._m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    @property
+    def reservoir(self):
+        """(min(count, reservoir_size), width) uniform sample of the waveforms"""
+        return self._reservoir[: min(self.count, self.reservoir_size)]
+
+    def percentiles(self, q=DEFAULT_PERCENTILES):
+        """
+        Approximate percentile bands from the reservoir sample.
+        Returns (len(q), width) array, exact while count <= reservoir_size.
+        """
+        if not self.count:
+            return np.full((len(q), self.width), np.nan)
+        return np.percentile(self.reservoir, q, axis=0)
+
+
+def accumulate_unit_waveforms(
+    matrix_data,
+    unit_spike_times,
+    unit_list,
+    sample_window_width,
+    pre_samples,
+    reservoir_size=DEFAULT_RESERVOIR_SIZE,
+    batch_spikes=DEFAULT_BATCH_SPIKES,
+    seed=None,
+    align_factor=None,
+):
+    """
+    Streams the waveforms of each unit through a WaveformAccumulator,
+    extracting batch_spikes spikes at a time with extract_spike_waves(), so
+    only one batch of raw waveforms is in memory.
+    Params:
+        matrix_data: (nCh, N) samples, e.g. get_raw_data(path, mmap=True)
+        unit_spike_times: dict, spike sample numbers of each unit
+        unit_list: array of (cluster_id, ch) pairs
+        sample_window_width: int, samples per waveform
+        pre_samples: int, samples before the spike time
+        reservoir_size: int, waveforms kept per unit
+        batch_spikes: int, spikes extracted at a time
+        seed: int, seed of the reservoir sampling
+        align_factor: int, optional upsampling factor of sub-sample alignment,
+            see align_spike_waves(). The trough position of the first batch
+            is the alignment target of the following batches.
+    Returns:
+        dict, keys are cluster ids, values are WaveformAccumulator
+    """
+    rng = np.random.default_rng(seed)
+    accumulators = dict()
+    for unit, ch in unit_list:
+        accumulator = WaveformAccumulator(sample_window_width, reservoir_size, rng)
+        spike_times = np.asarray(unit_spike_times[unit])
+        target = None
+        for start in range(0, len(spike_times), batch_spikes):
+            waves, _ = extract_spike_waves(
+                matrix_data[ch],
+                spike_times[start : start + batch_spikes],
+                sample_window_width,
+                pre_samples,
+            )
+            if align_factor:
+                waves, _, target = align_spike_waves(
+                    waves,
+                    np.zeros(len(waves)),
+                    pre_samples,
+                    align_factor,
+                    target=target,
+                )
+            accumulator.update(waves)
+        accumulators[int(unit)] = accumulator
+    return accumulators
+
+
+def accumulate_times_waves(
+    times_waves, reservoir_size=DEFAULT_RESERVOIR_SIZE, seed=None
+):
+    """
+    WaveformAccumulator of each unit of already extracted waveforms, the
+    output of get_ordered_raw_phy_spike_waves().
+    """
+    rng = np.random.default_rng(seed)
+    accumulators = dict()
+    for unit, waves in times_waves["waves"].items():
+        accumulator = WaveformAccumulator(waves.shape[1], reservoir_size, rng)
+        accumulators[int(unit)] = accumulator.update(waves)
+    return accumulators
+
+
+def write_mean_waveforms_tsv(wave_export_path, accumulators, fs=Fs):
+    """
+    Writes the mean waveform of each unit in the `_waves.tsv` format: rows are
+    units, the first column is the PHY cluster id.
+    """
+    cluster_ids = list(accumulators.keys())
+    means = [accumulators[clust].mean for clust in cluster_ids]
+    waveforms = np.column_stack((cluster_ids, means)) if means else np.empty((0, 1))
+    np.savetxt(
+        wave_export_path,
+        waveforms,
+        fmt="%.6f",
+        delimiter="\t",
+        header=f"Waveforms: rows are units; first column is PHY cluster id; "
+        f"columns are times at {fs // 1000}k Hz; Cluster IDs in order: {cluster_ids}",
+        comments="# ",
+    )
+    print(f"waveforms saved to: {wave_export_path}")
+    return wave_export_path
+
+
+def write_waveform_stats(store_dir, accumulators, q=DEFAULT_PERCENTILES, metadata=None):
+    """
+    Writes the statistics of all units as an npy store (see npy_store.py):
+    cluster_ids, counts, mean, std (num_clusters, width), percentiles
+    (num_clusters, len(q), width) and reservoir (num_clusters,
+    reservoir_size, width), NaN padded for units with fewer spikes.
+    """
+    cluster_ids = list(accumulators.keys())
+    accs = [accumulators[clust] for clust in cluster_ids]
+    width = accs[0].width if accs else 0
+    size = max([acc.reservoir_size for acc in accs], default=0)
+    reservoir = np.full((len(accs), size, width), np.nan)
+    for i, acc in enumerate(accs):
+        reservoir[i, : len(acc.reservoir)] = acc.reservoir
+    arrays = {
+        "cluster_ids": np.array(cluster_ids, dtype=np.int64),
+        "counts": np.array([acc.count for acc in accs], dtype=np.int64),
+        "mean": np.array([acc.mean for acc in accs]).reshape(-1, width),
+        "std": np.array([acc.std for acc in accs]).reshape(-1, width),
+        "percentiles": np.array([acc.percentiles(q) for acc in accs]).reshape(
+            -1, len(q), width
+        ),
+        "reservoir": reservoir,
+    }
+    store_metadata = {"percentiles": list(q), "sample_window_width": width}
+    store_metadata.update(metadata or {})
+    return write_npy_store(store_dir, arrays, store_metadata)
+
+
+def read_mean_waveforms_tsv(wave_export_path):
+    """
+    Reads a `_waves.tsv` file written by write_mean_waveforms_tsv().
+    Returns:
+        cluster_ids: np.ndarray, int PHY cluster id of each row
+        mean_waves: np.ndarray, (num_clusters, window) mean waveforms
+    """
+    data = np.loadtxt(wave_export_path, delimiter="\t", comments="#", ndmin=2)
+    return data[:, 0].astype(int), data[:, 1:]
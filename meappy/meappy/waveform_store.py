@@ -0,0 +1,148 @@
+# Binary, memory mappable export of raw spike waveforms
+#
+# Replaces the nested JSON lists of `_waves_raw.json`. The store is a
+# directory `<expt_id>_waves/` (see npy_store.py) with:
+#   waves.npy        (num_spikes, window) waveforms of all clusters, contiguous
+#   spike_times.npy  (num_spikes,) int64 spike times as sample numbers, float64
+#                    for fractional times of aligned waveforms (spike_alignment.py)
+#   cluster_ids.npy  (num_clusters,) int64 PHY cluster id
+#   channels.npy     (num_clusters,) int64 channel of each cluster
+#   offsets.npy      (num_clusters,) int64 first row of each cluster in waves
+#   counts.npy       (num_clusters,) int64 number of spikes of each cluster
+#   metadata.json    sample rate, window and pre samples, slice id, etc.
+#
+# Load in python with read_waveform_store() or np.load(..., mmap_mode="r"),
+# and in R with meapr::load_waveform_store().
+
+from os import path
+
+import numpy as np
+
+from meappy.npy_store import read_npy_store, write_npy_store
+
+WAVEFORM_STORE_VERSION = 1
+WAVEFORM_STORE_SUFFIX = "_waves"
+
+
+def waveform_store_path(export_path, expt_id):
+    """Returns the path of the waveform store of an experiment"""
+    return path.join(export_path, expt_id + WAVEFORM_STORE_SUFFIX)
+
+
+def write_waveform_store(
+    store_dir, times_waves, unit_list=None, metadata=None, dtype=None
+):
+    """
+    Writes the output of get_ordered_raw_phy_spike_waves() as a waveform store.
+    Params:
+        store_dir: str, directory of the store, see waveform_store_path()
+        times_waves: dict, {'waves': {clust: array}, 'times': {clust: array}}
+        unit_list: array of (cluster_id, ch) pairs, optional, for the channels
+        metadata: dict, extra metadata, e.g. Fs, sample_window_width, pre_samples
+        dtype: numpy dtype of the stored waveforms, default the dtype of the
+            waves. Raw modat.bin samples can be stored as np.int16, a
+            ValueError is raised if the waves are not integers in its range.
+            Use np.float32 for filtered or aligned data.
+    Returns:
+        store_dir: str
+    """
+    cluster_ids = [int(clust) for clust in times_waves["waves"].keys()]
+    waves = [times_waves["waves"][clust] for clust in times_waves["waves"].keys()]
+    times = [
+        np.asarray(times_waves["times"][clust]).reshape(-1) for clust in cluster_ids
+    ]
+    counts = np.array([len(w) for w in waves], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+    width = waves[0].shape[1] if waves else 0
+
+    channel_of = dict()
+    if unit_list is not None:
+        channel_of = {int(clust): int(ch) for clust, ch in unit_list}
+    channels = np.array([channel_of.get(c, -1) for c in cluster_ids], dtype=np.int64)
+
+    all_waves = np.concatenate(waves) if waves else np.empty((0, width))
+    dtype = all_waves.dtype if dtype is None else np.dtype(dtype)
+    if dtype.kind in "iu" and all_waves.dtype.kind not in "iu":
+        info = np.iinfo(dtype)
+        if not np.array_equal(all_waves, np.round(all_waves)):
+            raise ValueError(
+                f"Waves are not integers, they cannot be stored as {dtype}"
+            )
+        if all_waves.size and (
+            all_waves.min() < info.min or all_waves.max() > info.max
+        ):
+            raise ValueError(f"Waves are out of the range of {dtype}")
+    all_times = np.concatenate(times) if times else np.empty(0)
+    if np.array_equal(all_times, np.round(all_times)):
+        all_times = all_times.astype(np.int64)
+    arrays = {
+        "waves": all_waves.astype(dtype),
+        "spike_times": (
+            all_times.astype(np.float64, copy=False)
+            if all_times.dtype.kind == "f"
+            else all_times
+        ),
+        "cluster_ids": np.array(cluster_ids, dtype=np.int64),
+        "channels": channels,
+        "offsets": offsets,
+        "counts": counts,
+    }
+    store_metadata = {
+        "format": "meappy waveform store",
+        "version": WAVEFORM_STORE_VERSION,
+        "num_clusters": len(cluster_ids),
+        "num_spikes": int(counts.sum()),
+        "sample_window_width": int(width),
+        "dtype": dtype.name,
+    }
+    store_metadata.update(metadata or {})
+    write_npy_store(store_dir, arrays, store_metadata)
+    print(f"Waveform store written to {store_dir}")
+    return store_dir
+
+
+class WaveformStore:
+    """
+    Reader of a waveform store. Arrays are memory mapped, and the waveforms
+    and spike times of a cluster are zero-copy slices of them.
+    """
+
+    def __init__(self, store_dir, mmap_mode="r"):
+        self.store_dir = store_dir
+        self.arrays, self.metadata = read_npy_store(store_dir, mmap_mode)
+        self.cluster_ids = self.arrays["cluster_ids"]
+        self._rows = {
+            int(clust): slice(int(offset), int(offset + count))
+            for clust, offset, count in zip(
+                self.cluster_ids, self.arrays["offsets"], self.arrays["counts"]
+            )
+        }
+
+    def __len__(self):
+        return len(self.cluster_ids)
+
+    def __contains__(self, clust):
+        return int(clust) in self._rows
+
+    def waves(self, clust):
+        """(num_spikes, window) waveforms of a cluster"""
+        return self.arrays["waves"][self._rows[int(clust)]]
+
+    def times(self, clust):
+        """spike times of a cluster as sample numbers"""
+        return self.arrays["spike_times"][self._rows[int(clust)]]
+
+    def to_times_waves(self):
+        """Returns the times_waves dict of get_ordered_raw_phy_spike_waves()"""
+        times_waves = {"waves": dict(), "times": dict()}
+        for clust in self._rows:
+            times_waves["waves"][clust] = np.asarray(self.waves(clust), dtype=float)
+            times_waves["times"][clust] = np.asarray(
+                self.times(clust), dtype=float
+            ).reshape(-1, 1)
+        return times_waves
+
+
+def read_waveform_store(store_dir, mmap_mode="r"):
+    """Opens a waveform store written by write_waveform_store()"""
+    return WaveformStore(store_dir, mmap_mode)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from meappy.waveform import nCh
+
+
+@pytest.fixture
+def med64_bin_path(tmp_path):
+    """
+    Writes a short synthetic modat.bin file of sample-interleaved int16
+    data, 64 channels by 2000 samples. Channel ch of sample t has the
+    value (ch * 100 + t % 100) so data can be checked by position.
+    """
+    num_samples = 2000
+    matrix_data = (
+        np.arange(nCh)[:, None] * 100 + np.arange(num_samples)[None, :] % 100
+    ).astype(np.int16)
+    bin_path = tmp_path / "20211109_15h09m07s.modat.bin"
+    matrix_data.T.tofile(bin_path)
+    return str(bin_path)
+
+
+@pytest.fixture
+def phy_dir(tmp_path):
+    """
+    Writes a small PHY export: 3 clusters with 20, 12 and 5 spikes, where
+    clusters 0 and 2 are 'good' and cluster 1 is 'noise'.
+    """
+    phy_path = tmp_path / "20211109_15h09m07s.modat.GUI"
+    phy_path.mkdir()
+    rng = np.random.default_rng(0)
+    spike_clusters = np.repeat(np.array([0, 1, 2], dtype=np.int32), [20, 12, 5])
+    spike_times = np.sort(rng.choice(np.arange(100, 1900), size=37, replace=False))
+    rng.shuffle(spike_clusters)
+    np.save(phy_path / "spike_times.npy", spike_times.astype(np.uint64))
+    np.save(phy_path / "spike_clusters.npy", spike_clusters)
+    np.save(phy_path / "amplitudes.npy", rng.random(37).astype(np.float32))
+    (phy_path / "cluster_info.tsv").write_text(
+        "cluster_id\tch\tgroup\tn_spikes\n"
+        "0\t4\tgood\t20\n"
+        "1\t9\tnoise\t12\n"
+        "2\t17\tgood\t5\n"
+    )
+    return str(phy_path)
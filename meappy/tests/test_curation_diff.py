@@ -0,0 +1,183 @@
+import runpy
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from meappy.curation_diff import curation_diff, patch_unit_dict, patch_unit_rows
+from meappy.nwb_writer import read_nwb_mean_waves, read_nwb_unit
+from meappy.phy_2_nwb import main as phy_2_nwb_main
+from meappy.spike_store import read_spike_store, write_spike_store, patch_spike_store
+from meappy.waveform_features import UNIT_COLUMNS
+
+
+def test_curation_diff():
+    old = np.array([0, 1, 2, 2, 3, 1, 0])
+    new = np.array([0, 5, 2, 2, 3, 5, 0])  # 1 is merged into the new unit 5
+    old_units = np.array([[0, 4], [1, 9], [2, 17], [3, 20]])
+    new_units = np.array([[0, 4], [2, 18], [3, 20], [5, 9]])
+    diff = curation_diff(old, new, old_units, new_units)
+    np.testing.assert_array_equal(diff.created, [5])
+    np.testing.assert_array_equal(diff.removed, [1])
+    np.testing.assert_array_equal(diff.changed, [2])  # channel changed
+    np.testing.assert_array_equal(diff.recompute, [2, 5])
+    np.testing.assert_array_equal(diff.stale, [1, 2])
+    assert curation_diff(old, old, old_units, old_units).is_empty
+    with pytest.raises(ValueError):
+        curation_diff(old, new[:-1], old_units, new_units)
+
+
+def test_patch_units():
+    assert patch_unit_dict({1: "a", 2: "b"}, {2: "c", 3: "d"}, [3, 1, 2]) == {
+        3: "d",
+        1: "a",
+        2: "c",
+    }
+    previous = {"cluster_ids": np.array([1, 2]), "counts": np.array([[1, 1], [2, 2]])}
+    recomputed = {
+        "cluster_ids": np.array([3]),
+        "counts": np.array([[3, 3]]),
+        "bin_starts_sec": np.array([0.0, 60.0]),
+    }
+    patched = patch_unit_rows(previous, recomputed, [3, 1], row_keys=("counts",))
+    np.testing.assert_array_equal(patched["counts"], [[3, 3], [1, 1]])
+    np.testing.assert_array_equal(patched["cluster_ids"], [3, 1])
+    np.testing.assert_array_equal(patched["bin_starts_sec"], [0.0, 60.0])
+    with pytest.raises(ValueError):
+        patch_unit_rows(previous, recomputed, [4], row_keys=("counts",))
+
+
+def test_patch_spike_store(tmp_path):
+    samples = np.array([10, 20, 30, 40, 50])
+    old = np.array([1, 2, 1, 3, 2])
+    new = np.array([4, 2, 4, 3, 2])  # 1 renamed to 4
+    store_dir = str(tmp_path / "units_ts.spikes")
+    write_spike_store(store_dir, samples, old, metadata={"slice_id": "slice"})
+    diff = curation_diff(old, new, [[1, 0], [2, 0], [3, 0]], [[2, 0], [3, 0], [4, 0]])
+    patch_spike_store(store_dir, samples, new, diff)
+    trains, metadata = read_spike_store(store_dir)
+    assert list(trains) == [2, 3, 4]
+    np.testing.assert_array_equal(trains[4], [10, 30])
+    np.testing.assert_array_equal(trains[2], [20, 50])
+    assert metadata["num_spikes"] == 5 and metadata["slice_id"] == "slice"
+
+
+def test_phy_2_nwb_curation_edit(tmp_path, phy_dir, med64_bin_path):
+    export_path = tmp_path / "export"
+    export_path.mkdir()
+    phy_2_nwb_main(phy_dir, med64_bin_path, str(export_path), volts_per_count=1e-7)
+
+    # merge units 0 and 2 into the new unit 3
+    clusters_path = f"{phy_dir}/spike_clusters.npy"
+    clusters = np.load(clusters_path)
+    clusters[np.isin(clusters, [0, 2])] = 3
+    np.save(clusters_path, clusters)
+    with open(f"{phy_dir}/cluster_info.tsv", "w") as file:
+        file.write("cluster_id\tch\tgroup\tn_spikes\n1\t9\tgood\t12\n3\t4\tgood\t25\n")
+    summary = phy_2_nwb_main(
+        phy_dir, med64_bin_path, str(export_path), volts_per_count=1e-7
+    )
+    assert summary["n_good_clusters"] == 2 and not summary["cached"]
+
+    patched_trains, _ = read_spike_store(str(export_path / "units_ts.spikes"))
+    patched_waves = read_nwb_mean_waves(summary["nwb_path"])
+    phy_2_nwb_main(
+        phy_dir, med64_bin_path, str(export_path), volts_per_count=1e-7, force=True
+    )
+    full_trains, _ = read_spike_store(str(export_path / "units_ts.spikes"))
+    full_waves = read_nwb_mean_waves(summary["nwb_path"])
+    assert list(patched_trains) == list(full_trains) == [1, 3]
+    np.testing.assert_array_equal(patched_trains.times, full_trains.times)
+    for unit in (1, 3):
+        np.testing.assert_allclose(patched_waves[unit], full_waves[unit])
+    assert read_nwb_unit(summary["nwb_path"], 3)["electrode"] == 4
+
+
+def test_phy_2_nwb_curation_edit_unchanged_waves(tmp_path, phy_dir, med64_bin_path):
+    export_path = str(tmp_path / "export")
+    (tmp_path / "export").mkdir()
+    first = phy_2_nwb_main(phy_dir, med64_bin_path, export_path, volts_per_count=1e-7)
+    first_waves = read_nwb_mean_waves(first["nwb_path"])
+
+    # unit 1 is marked good, units 0 and 2 are unchanged
+    with open(f"{phy_dir}/cluster_info.tsv", "w") as file:
+        file.write(
+            "cluster_id\tch\tgroup\tn_spikes\n"
+            "0\t4\tgood\t20\n1\t9\tgood\t12\n2\t17\tgood\t5\n"
+        )
+    summary = phy_2_nwb_main(phy_dir, med64_bin_path, export_path, volts_per_count=1e-7)
+    patched_waves = read_nwb_mean_waves(summary["nwb_path"])
+    phy_2_nwb_main(
+        phy_dir, med64_bin_path, export_path, volts_per_count=1e-7, force=True
+    )
+    full_waves = read_nwb_mean_waves(summary["nwb_path"])
+    assert list(patched_waves) == list(full_waves) == [0, 1, 2]
+    for unit in (0, 2):
+        np.testing.assert_array_equal(patched_waves[unit], first_waves[unit])
+    for unit in (0, 1, 2):
+        np.testing.assert_allclose(patched_waves[unit], full_waves[unit], rtol=1e-6)
+
+
+def _run_waveform_export(monkeypatch, expt_dir, *options):
+    argv = ["waveform_extract_order_spiketimes.py", "--plots", "False", *options]
+    monkeypatch.setattr(sys, "argv", argv + [str(expt_dir)])
+    runpy.run_module("meappy.waveform_extract_order_spiketimes", run_name="__main__")
+
+
+@pytest.mark.parametrize(
+    "options", [("--drift", "True"), ("--align", "True"), ("--summary_only", "True")]
+)
+def test_waveform_export_removal_only_edit(
+    tmp_path, monkeypatch, phy_dir, med64_bin_path, options
+):
+    expt_dir = tmp_path / "20211109_15h09m07s"
+    expt_dir.mkdir()
+    shutil.move(phy_dir, expt_dir)
+    shutil.move(med64_bin_path, expt_dir)
+    info_path = expt_dir / "20211109_15h09m07s.modat.GUI" / "cluster_info.tsv"
+    info = "cluster_id\tch\tgroup\tn_spikes\n0\t4\tgood\t20\n1\t9\t{}\t12\n"
+    info_path.write_text(info.format("good"))
+    _run_waveform_export(monkeypatch, expt_dir, *options)
+
+    # unit 1 is marked noise, no unit is extracted again
+    info_path.write_text(info.format("noise"))
+    _run_waveform_export(monkeypatch, expt_dir, *options)
+    outputs = ["_waves.tsv", "_features.tsv"]
+    if "--drift" in options:
+        outputs.append("_drift.tsv")
+    patched = [(expt_dir / f"20211109_15h09m07s{name}").read_text() for name in outputs]
+    features = pd.read_csv(expt_dir / "20211109_15h09m07s_features.tsv", sep="\t")
+    assert list(features.columns) == UNIT_COLUMNS and list(features["ch"]) == [4]
+
+    _run_waveform_export(monkeypatch, expt_dir, *options, "--force", "True")
+    full = [(expt_dir / f"20211109_15h09m07s{name}").read_text() for name in outputs]
+    assert patched == full
+
+
+def test_exporters_sharing_a_directory(tmp_path, monkeypatch, phy_dir, med64_bin_path):
+    expt_dir = tmp_path / "20211109_15h09m07s"
+    expt_dir.mkdir()
+    shutil.move(phy_dir, expt_dir)
+    shutil.move(med64_bin_path, expt_dir)
+    phy_path = str(expt_dir / "20211109_15h09m07s.modat.GUI")
+    info_path = expt_dir / "20211109_15h09m07s.modat.GUI" / "cluster_info.tsv"
+    info_path.write_text(
+        "cluster_id\tch\tgroup\tn_spikes\n0\t4\tgood\t20\n1\t9\tgood\t12\n"
+    )
+    _run_waveform_export(monkeypatch, expt_dir)
+    phy_2_nwb_main(phy_path, export_path=str(expt_dir))
+
+    # spikes of unit 1 move to unit 0, the NWB export runs first
+    clusters_path = expt_dir / "20211109_15h09m07s.modat.GUI" / "spike_clusters.npy"
+    clusters = np.load(clusters_path)
+    clusters[np.flatnonzero(clusters == 1)[:4]] = 0
+    np.save(clusters_path, clusters)
+    phy_2_nwb_main(phy_path, export_path=str(expt_dir))
+    _run_waveform_export(monkeypatch, expt_dir)
+    features_path = expt_dir / "20211109_15h09m07s_features.tsv"
+    patched = features_path.read_text()
+
+    _run_waveform_export(monkeypatch, expt_dir, "--force", "True")
+    assert patched == features_path.read_text()
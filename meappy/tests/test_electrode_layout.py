@@ -0,0 +1,26 @@
+import numpy as np
+
+from meappy import waveform
+from meappy.electrode_layout import electrode_neighbors
+
+
+def test_electrode_neighbors():
+    neighbors = electrode_neighbors(radius=1)
+    assert neighbors.shape == (64, 5)
+    np.testing.assert_array_equal(neighbors[9], [9, 1, 8, 10, 17])
+    np.testing.assert_array_equal(neighbors[0], [0, 1, 8, -1, -1])
+    assert electrode_neighbors().shape == (64, 9)
+
+
+def test_extract_spike_footprints(med64_bin_path):
+    matrix_data = waveform.get_raw_data(med64_bin_path, mmap=True)
+    neighbors = electrode_neighbors(radius=1)
+    footprints, channels, in_bounds = waveform.extract_spike_footprints(
+        matrix_data, 0, [100, 500], 121, 30, neighbors
+    )
+    assert footprints.shape == (2, 5, 121) and in_bounds.all()
+    np.testing.assert_array_equal(channels, [0, 1, 8, -1, -1])
+    for i, ch in enumerate([0, 1, 8]):
+        waves, _ = waveform.extract_spike_waves(matrix_data[ch], [100, 500], 121, 30)
+        np.testing.assert_array_equal(footprints[:, i], waves)
+    assert np.isnan(footprints[:, 3:]).all()
@@ -0,0 +1,47 @@
+import os
+
+from meappy import export_cache
+from meappy.export_cache import check_export_cache, file_signature, write_export_cache
+
+
+def _touch(file_path, seconds=10):
+    stat = os.stat(file_path)
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + seconds * 10**9))
+
+
+def test_export_cache(tmp_path, monkeypatch):
+    data_path = tmp_path / "spike_times.npy"
+    data_path.write_bytes(b"spikes")
+    output_path = tmp_path / "units_ts.tsv"
+    output_path.write_text("")
+    cache_path = str(tmp_path / "cache.json")
+    inputs = {"spike_times": str(data_path), "med64_bin": None}
+    params = {"PRE_SAMPLES": 30}
+
+    current, cache = check_export_cache(cache_path, inputs, params, [output_path])
+    assert not current
+    write_export_cache(cache_path, cache, summary={"n_spikes": 3})
+
+    # unchanged size and mtime, the file is not read again
+    hashed = []
+    monkeypatch.setattr(
+        export_cache, "file_hash", lambda file_path: hashed.append(file_path)
+    )
+    current, cache = check_export_cache(cache_path, inputs, params, [output_path])
+    assert current and not hashed and cache["summary"] == {"n_spikes": 3}
+    monkeypatch.undo()
+
+    # touched but same content is still current, changed content is not
+    _touch(data_path)
+    assert check_export_cache(cache_path, inputs, params, [output_path])[0]
+    data_path.write_bytes(b"spikez")
+    assert not check_export_cache(cache_path, inputs, params, [output_path])[0]
+    data_path.write_bytes(b"spikes")
+    assert not check_export_cache(cache_path, inputs, {"PRE_SAMPLES": 200})[0]
+    output_path.unlink()
+    assert not check_export_cache(cache_path, inputs, params, [output_path])[0]
+
+
+def test_file_signature_missing(tmp_path):
+    assert file_signature(str(tmp_path / "missing.bin")) is None
+    assert file_signature(None) is None
@@ -0,0 +1,58 @@
+import pickle
+
+import numpy as np
+
+from meappy import waveform
+from meappy.med64_recording import Med64Recording
+
+
+def test_recording_matches_get_raw_data(med64_bin_path):
+    recording = Med64Recording(med64_bin_path)
+    matrix_data = waveform.get_raw_data(med64_bin_path)
+    assert recording.shape == matrix_data.shape
+    assert recording.n_samples == 2000
+    assert recording.duration_sec == 2000 / waveform.Fs
+    np.testing.assert_array_equal(recording.data, matrix_data)
+    np.testing.assert_array_equal(recording.channel(7, 10, 20), matrix_data[7, 10:20])
+    np.testing.assert_array_equal(
+        recording.get_samples(100, 150, channels=[2, 9]), matrix_data[[2, 9], 100:150]
+    )
+
+
+def test_recording_pickles_by_path(med64_bin_path):
+    recording = pickle.loads(pickle.dumps(Med64Recording(med64_bin_path)))
+    assert recording.bin_path == med64_bin_path
+    assert recording[5, 1999] == 599
+
+
+def test_iter_chunks_covers_recording(med64_bin_path):
+    recording = Med64Recording(med64_bin_path)
+    chunks = list(recording.iter_chunks(chunk_samples=300, overlap_samples=10))
+    assert [c.start for c in chunks] == list(range(0, 2000, 300))
+    assert chunks[0].offset == 0 and chunks[1].offset == 290
+    assert chunks[-1].stop == 2000 and chunks[-1].data.shape[1] == 210
+    for chunk in chunks:
+        np.testing.assert_array_equal(
+            chunk.data,
+            recording.data[:, chunk.offset : chunk.offset + chunk.data.shape[1]],
+        )
+    np.testing.assert_array_equal(
+        np.hstack([c.core for c in chunks]), waveform.get_raw_data(med64_bin_path)
+    )
+
+
+def test_channel_major_sidecar(med64_bin_path):
+    from meappy import med64_recording
+
+    assert not med64_recording.is_channel_major_current(med64_bin_path)
+    sidecar_path = med64_recording.write_channel_major(med64_bin_path, chunk_sec=0.01)
+    assert sidecar_path.endswith(".modat.chmajor.bin")
+    assert med64_recording.is_channel_major_current(med64_bin_path)
+
+    recording = med64_recording.open_recording(med64_bin_path)
+    assert recording.channel_major and recording.data.flags["C_CONTIGUOUS"]
+    np.testing.assert_array_equal(recording.data, Med64Recording(med64_bin_path).data)
+    assert recording.source_path == med64_bin_path
+    unpickled = pickle.loads(pickle.dumps(recording))
+    np.testing.assert_array_equal(unpickled.channel(3), recording.channel(3))
+    assert unpickled.source_path == med64_bin_path
@@ -0,0 +1,217 @@
+import h5py
+import numpy as np
+import pytest
+
+from meappy import nwb_writer
+from meappy.nwb_writer import (
+    nwb_path_of,
+    patch_nwb_units,
+    read_nwb_unit,
+    slice_start_time,
+    write_nwb,
+)
+from meappy.spike_trains import SpikeTrains
+from meappy.waveform import get_raw_data
+
+VOLTS_PER_COUNT = 1e-7
+
+
+@pytest.fixture
+def spike_trains():
+    times = np.array([100, 400, 250, 900, 1200, 300], dtype=np.int64)
+    clusters = np.array([0, 0, 2, 2, 2, 1])
+    return SpikeTrains.from_spikes(times, clusters)
+
+
+def test_write_nwb_units(tmp_path, spike_trains):
+    nwb_path = nwb_path_of(str(tmp_path), "20211109_15h09m07s")
+    unit_list = np.array([[0, 4], [2, 17]])
+    mean_waves = {0: np.ones(11), 2: np.arange(11.0)}
+    write_nwb(
+        nwb_path,
+        spike_trains,
+        unit_list,
+        "20211109_15h09m07s",
+        mean_waves,
+        volts_per_count=VOLTS_PER_COUNT,
+    )
+
+    with h5py.File(nwb_path, "r") as nwb:
+        assert nwb.attrs["neurodata_type"] == "NWBFile"
+        assert nwb["identifier"][()].decode() == "20211109_15h09m07s"
+        units = nwb["units"]
+        np.testing.assert_array_equal(units["id"][:], [0, 2])
+        np.testing.assert_array_equal(units["spike_times_index"][:], [2, 5])
+        assert units["spike_times"].compression == "gzip"
+        assert units["waveform_mean"].chunks == (1, 11)
+        electrodes = nwb["general/extracellular_ephys/electrodes"]
+        assert len(electrodes["id"]) == 64
+        assert nwb[units["electrodes"].attrs["table"]] == electrodes
+        assert units["waveform_mean"].attrs["unit"] == "volts"
+
+    unit = read_nwb_unit(nwb_path, 2)
+    np.testing.assert_allclose(unit["spike_times"], [250 / 20000, 900 / 20000, 0.06])
+    assert unit["electrode"] == 17
+    np.testing.assert_allclose(
+        unit["waveform_mean"], np.arange(11.0) * VOLTS_PER_COUNT, rtol=1e-6
+    )
+    with pytest.raises(ValueError):
+        read_nwb_unit(nwb_path, 1)
+
+
+@pytest.mark.parametrize("raw_mode", ["link", "copy"])
+def test_write_nwb_raw(tmp_path, spike_trains, med64_bin_path, raw_mode):
+    nwb_path = str(tmp_path / "slice.nwb")
+    write_nwb(
+        nwb_path,
+        spike_trains,
+        [[0, 4]],
+        "slice",
+        med64_bin_path=med64_bin_path,
+        raw_mode=raw_mode,
+        chunk_sec=0.03,
+        volts_per_count=VOLTS_PER_COUNT,
+    )
+    with h5py.File(nwb_path, "r") as nwb:
+        data = nwb["acquisition/ElectricalSeries/data"]
+        assert data.shape == (2000, 64)
+        np.testing.assert_array_equal(data[:], get_raw_data(med64_bin_path).T)
+        assert data.attrs["unit"] == "volts"
+        assert data.attrs["conversion"] == VOLTS_PER_COUNT
+        if raw_mode == "copy":
+            assert data.chunks == (2000, 8)
+        else:
+            assert data.external is not None
+
+
+def test_patch_nwb_units(tmp_path, spike_trains, med64_bin_path):
+    nwb_path = str(tmp_path / "slice.nwb")
+    write_nwb(
+        nwb_path,
+        spike_trains,
+        [[0, 4], [2, 17]],
+        "slice",
+        mean_waves={0: np.ones(11), 2: np.arange(11.0)},
+        med64_bin_path=med64_bin_path,
+        raw_mode="copy",
+        volts_per_count=VOLTS_PER_COUNT,
+    )
+    with h5py.File(nwb_path, "r") as nwb:
+        raw_id = nwb["acquisition/ElectricalSeries"].attrs["object_id"]
+
+    patch_nwb_units(
+        nwb_path,
+        spike_trains,
+        [[1, 9], [2, 17]],
+        {1: np.zeros(11), 2: np.ones(11)},
+        volts_per_count=VOLTS_PER_COUNT,
+    )
+    with h5py.File(nwb_path, "r") as nwb:
+        series = nwb["acquisition/ElectricalSeries"]
+        assert series.attrs["object_id"] == raw_id
+        np.testing.assert_array_equal(series["data"][:], get_raw_data(med64_bin_path).T)
+        electrodes = nwb["general/extracellular_ephys/electrodes"]
+        assert nwb[series["electrodes"].attrs["table"]] == electrodes
+        assert nwb[electrodes["group"][0]].name == "/general/extracellular_ephys/MED64"
+        np.testing.assert_array_equal(nwb["units/id"][:], [1, 2])
+    assert not list(tmp_path.glob("slice.nwb.tmp"))
+    unit = read_nwb_unit(nwb_path, 1)
+    np.testing.assert_allclose(unit["spike_times"], [300 / 20000])
+    assert unit["electrode"] == 9
+    np.testing.assert_allclose(
+        read_nwb_unit(nwb_path, 2)["waveform_mean"], VOLTS_PER_COUNT, rtol=1e-6
+    )
+
+
+def test_patch_nwb_units_replaces_file(tmp_path, spike_trains, monkeypatch):
+    nwb_path = str(tmp_path / "slice.nwb")
+    write_nwb(nwb_path, spike_trains, [[0, 4], [2, 17]], "slice")
+    patch_nwb_units(nwb_path, spike_trains, [[1, 9]])
+    size = (tmp_path / "slice.nwb").stat().st_size
+    for _ in range(3):
+        patch_nwb_units(nwb_path, spike_trains, [[1, 9]])
+    assert (tmp_path / "slice.nwb").stat().st_size == size
+
+    def fail(*args):
+        raise RuntimeError("interrupted")
+
+    monkeypatch.setattr(nwb_writer, "_write_units", fail)
+    with pytest.raises(RuntimeError):
+        patch_nwb_units(nwb_path, spike_trains, [[0, 4]])
+    assert not list(tmp_path.glob("slice.nwb.tmp"))
+    np.testing.assert_array_equal(read_nwb_unit(nwb_path, 1)["spike_times"], 0.015)
+
+
+def test_write_nwb_requires_gain(tmp_path, spike_trains, med64_bin_path):
+    nwb_path = str(tmp_path / "slice.nwb")
+    with pytest.raises(ValueError):
+        write_nwb(nwb_path, spike_trains, [[0, 4]], "slice", {0: np.ones(11)})
+    with pytest.raises(ValueError):
+        write_nwb(
+            nwb_path, spike_trains, [[0, 4]], "slice", med64_bin_path=med64_bin_path
+        )
+    assert not list(tmp_path.glob("slice.nwb*"))
+    write_nwb(nwb_path, spike_trains, [[0, 4]], "slice")
+    with pytest.raises(ValueError):
+        patch_nwb_units(nwb_path, spike_trains, [[0, 4]], {0: np.ones(11)})
+
+
+def test_nwb_schema(tmp_path, spike_trains, med64_bin_path):
+    pynwb = pytest.importorskip("pynwb")
+    nwbinspector = pytest.importorskip("nwbinspector")
+    nwb_path = str(tmp_path / "slice.nwb")
+    write_nwb(
+        nwb_path,
+        spike_trains,
+        [[0, 4], [2, 17]],
+        "20211109_15h09m07s",
+        mean_waves={0: np.ones(11), 2: np.arange(11.0)},
+        med64_bin_path=med64_bin_path,
+        raw_mode="copy",
+        volts_per_count=VOLTS_PER_COUNT,
+    )
+    with pynwb.NWBHDF5IO(nwb_path, "r") as io:
+        assert not pynwb.validate(io=io)
+        nwbfile = io.read()
+        np.testing.assert_array_equal(nwbfile.units.id[:], [0, 2])
+        np.testing.assert_allclose(
+            nwbfile.units["spike_times"][1], [250 / 20000, 900 / 20000, 0.06]
+        )
+        series = nwbfile.acquisition["ElectricalSeries"]
+        assert series.unit == "volts" and series.conversion == VOLTS_PER_COUNT
+    messages = nwbinspector.inspect_nwbfile(nwbfile_path=nwb_path)
+    critical = nwbinspector.Importance.CRITICAL
+    assert not [message for message in messages if message.importance == critical]
+
+
+def test_write_nwb_bad_raw_mode(tmp_path, spike_trains, med64_bin_path):
+    with pytest.raises(ValueError):
+        write_nwb(
+            str(tmp_path / "slice.nwb"),
+            spike_trains,
+            [[0, 4]],
+            "slice",
+            med64_bin_path=med64_bin_path,
+            raw_mode="move",
+            volts_per_count=VOLTS_PER_COUNT,
+        )
+    assert not list(tmp_path.glob("slice.nwb*"))
+
+
+def test_write_nwb_failure_removes_temp_file(tmp_path, spike_trains):
+    nwb_path = str(tmp_path / "slice.nwb")
+    with pytest.raises(OSError):
+        write_nwb(
+            nwb_path,
+            spike_trains,
+            [[0, 4]],
+            "slice",
+            med64_bin_path=str(tmp_path / "missing.modat.bin"),
+            volts_per_count=VOLTS_PER_COUNT,
+        )
+    assert not list(tmp_path.glob("slice.nwb*"))
+
+
+def test_slice_start_time():
+    assert slice_start_time("20211109_15h09m07s").startswith("2021-11-09")
+    assert slice_start_time("not a slice id")
@@ -0,0 +1,93 @@
+import runpy
+import shutil
+import sys
+
+import pandas as pd
+import pytest
+
+from meappy.phy_batch import MANIFEST_FILE, find_protocol_slices, run_protocol
+
+
+def _make_slice(protocol_dir, slice_id, phy_dir=None, phy_subdir=""):
+    slice_dir = protocol_dir / slice_id
+    slice_dir.mkdir(parents=True)
+    (slice_dir / "slice_parameters.yaml").write_text(
+        f"paths:\n    slice: {slice_id}/\n    unit: {slice_id}_units_ts.mat\n"
+    )
+    if phy_dir is not None:
+        shutil.copytree(phy_dir, slice_dir / phy_subdir / f"{slice_id}.modat.GUI")
+    return slice_dir
+
+
+def _make_protocol(tmp_path, phy_dir):
+    protocol_dir = tmp_path / "VTA_NMDA"
+    _make_slice(protocol_dir, "20211109_15h09m07s", phy_dir)
+    _make_slice(protocol_dir, "20211110_10h00m00s", phy_dir, phy_subdir="PHY")
+    broken_dir = _make_slice(protocol_dir, "20211111_10h00m00s", phy_dir)
+    (broken_dir / "20211111_10h00m00s.modat.GUI" / "spike_clusters.npy").unlink()
+    _make_slice(protocol_dir, "20211112_10h00m00s")
+    return protocol_dir
+
+
+def test_find_protocol_slices(tmp_path, phy_dir):
+    protocol_dir = _make_protocol(tmp_path, phy_dir)
+    jobs = find_protocol_slices(str(protocol_dir))
+    assert [job.slice_id for job in jobs] == [
+        "20211109_15h09m07s",
+        "20211110_10h00m00s",
+        "20211111_10h00m00s",
+        "20211112_10h00m00s",
+    ]
+    assert jobs[0].phy_dir.endswith("20211109_15h09m07s.modat.GUI")
+    assert jobs[0].med64_bin_path is None
+    assert jobs[1].phy_dir.endswith("PHY/20211110_10h00m00s.modat.GUI")
+    assert jobs[3].phy_dir is None
+
+
+def test_run_protocol(tmp_path, phy_dir):
+    protocol_dir = _make_protocol(tmp_path, phy_dir)
+    export_root = tmp_path / "export"
+    manifest = run_protocol(str(protocol_dir), workers=2, export_root=str(export_root))
+
+    assert list(manifest["status"]) == ["ok", "ok", "error", "unsorted"]
+    assert list(manifest["n_spikes"][:2]) == [25, 25]
+    assert list(manifest["n_good_clusters"][:2]) == [2, 2]
+    assert "spike_clusters" in manifest["error"][2]
+    assert (export_root / "20211110_10h00m00s" / "20211110_10h00m00s.nwb").exists()
+    written = pd.read_csv(protocol_dir / MANIFEST_FILE, sep="\t")
+    assert list(written["slice_id"]) == list(manifest["slice_id"])
+    assert (written["elapsed_sec"][:3] >= 0).all()
+
+
+def test_run_protocol_skips_unchanged(tmp_path, phy_dir):
+    protocol_dir = tmp_path / "VTA_NMDA"
+    slice_dir = _make_slice(protocol_dir, "20211109_15h09m07s", phy_dir)
+    assert list(run_protocol(str(protocol_dir), workers=1)["status"]) == ["ok"]
+    manifest = run_protocol(str(protocol_dir), workers=1)
+    assert list(manifest["status"]) == ["cached"]
+    assert list(manifest["n_spikes"]) == [25]
+    forced = run_protocol(str(protocol_dir), workers=1, force=True)
+    assert list(forced["status"]) == ["ok"]
+
+    cluster_info = slice_dir / "20211109_15h09m07s.modat.GUI" / "cluster_info.tsv"
+    cluster_info.write_text(cluster_info.read_text().replace("noise", "good"))
+    manifest = run_protocol(str(protocol_dir), workers=1)
+    assert list(manifest["status"]) == ["ok"]
+    assert list(manifest["n_good_clusters"]) == [3]
+
+
+@pytest.mark.filterwarnings("ignore:'meappy.phy_2_nwb' found in sys.modules")
+def test_phy_2_nwb_command_line(tmp_path, monkeypatch, phy_dir, med64_bin_path):
+    gain = ["--volts_per_count", "1e-7"]
+    argv = ["phy_2_nwb.py", phy_dir, med64_bin_path, *gain]
+    monkeypatch.setattr(sys, "argv", argv)
+    # exports once to the PHY directory, the user's phy_export path is not used
+    runpy.run_module("meappy.phy_2_nwb", run_name="__main__")
+    assert (tmp_path / "20211109_15h09m07s.modat.GUI" / "units_ts.tsv").exists()
+
+    export_path = tmp_path / "export"
+    export_path.mkdir()
+    argv = ["phy_2_nwb.py", phy_dir, med64_bin_path, str(export_path), "--force"]
+    monkeypatch.setattr(sys, "argv", argv + gain)
+    runpy.run_module("meappy.phy_2_nwb", run_name="__main__")
+    assert (export_path / "20211109_15h09m07s.nwb").exists()
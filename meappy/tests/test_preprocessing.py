@@ -0,0 +1,65 @@
+import numpy as np
+from scipy import signal
+
+from meappy import preprocessing
+from meappy.med64_recording import Med64Recording, open_recording, write_channel_major
+
+
+def _noise_recording(tmp_path, num_samples=5000):
+    rng = np.random.default_rng(1)
+    matrix_data = rng.normal(0, 200, size=(64, num_samples)).astype(np.int16) + 1000
+    bin_path = str(tmp_path / "20211109_15h09m07s.modat.bin")
+    matrix_data.T.tofile(bin_path)
+    return bin_path, matrix_data.astype(float)
+
+
+def test_chunked_filter_matches_whole_recording(tmp_path):
+    bin_path, matrix_data = _noise_recording(tmp_path)
+    filtered = preprocessing.bandpass_filter_recording(
+        bin_path, chunk_sec=0.03, n_threads=3
+    )
+    assert filtered.bin_path.endswith(".modat.filtered.bin")
+    assert filtered.dtype == np.float32 and filtered.shape == matrix_data.shape
+
+    sos = preprocessing.design_bandpass()
+    zi = signal.sosfilt_zi(sos)[:, None, :] * matrix_data[None, :, :1]
+    expected, _ = signal.sosfilt(sos, matrix_data, axis=-1, zi=zi)
+    np.testing.assert_allclose(filtered.data, expected, rtol=1e-5, atol=1e-2)
+
+
+def test_channel_major_sidecar_output_paths(tmp_path):
+    bin_path, matrix_data = _noise_recording(tmp_path, num_samples=1000)
+    write_channel_major(bin_path, chunk_sec=0.01)
+    recording = open_recording(bin_path)
+    assert recording.channel_major and recording.source_path == bin_path
+    filtered = preprocessing.bandpass_filter_recording(recording, chunk_sec=0.02)
+    assert filtered.bin_path == preprocessing.filtered_path(bin_path)
+    assert filtered.bin_path.endswith("20211109_15h09m07s.modat.filtered.bin")
+    referenced = preprocessing.rereference_recording(recording, chunk_sec=0.02)
+    assert referenced.bin_path.endswith("20211109_15h09m07s.modat.cmr.bin")
+
+
+def test_zero_phase_filter(tmp_path):
+    bin_path, matrix_data = _noise_recording(tmp_path)
+    filtered = preprocessing.bandpass_filter_recording(
+        Med64Recording(bin_path), zero_phase=True, chunk_sec=0.05, pad_sec=0.02
+    )
+    expected = signal.sosfiltfilt(preprocessing.design_bandpass(), matrix_data)
+    core = slice(500, 4500)
+    np.testing.assert_allclose(filtered.data[:, core], expected[:, core], atol=0.5)
+
+
+def test_rereference_recording(tmp_path):
+    bin_path, matrix_data = _noise_recording(tmp_path, num_samples=3000)
+    referenced = preprocessing.rereference_recording(
+        bin_path, method="median", bad_channels=[0, 1], chunk_sec=0.02
+    )
+    assert referenced.bin_path.endswith(".modat.cmr.bin")
+    expected = matrix_data - np.median(matrix_data[2:], axis=0)
+    np.testing.assert_allclose(referenced.data, expected, atol=1e-3)
+    averaged = preprocessing.rereference_recording(bin_path, method="mean")
+    assert averaged.bin_path.endswith(".modat.car.bin")
+    np.testing.assert_allclose(averaged.data.mean(axis=0), 0, atol=1e-3)
+
+    block = preprocessing.common_reference(matrix_data[:, :10], method="mean")
+    np.testing.assert_allclose(block.mean(axis=0), 0, atol=1e-9)
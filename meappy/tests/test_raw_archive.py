@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from meappy import raw_archive
+from meappy.med64_recording import Med64Recording
+
+
+@pytest.mark.parametrize("codec", raw_archive.CODECS)
+def test_archive_round_trip_is_bit_exact(tmp_path, codec):
+    rng = np.random.default_rng(0)
+    matrix_data = rng.integers(-32768, 32768, size=(64, 1234), dtype=np.int16)
+    matrix_data[:, 100:200] = 32767  # wrap around of the delta encoding
+    bin_path = str(tmp_path / "20211109_15h09m07s.modat.bin")
+    matrix_data.T.tofile(bin_path)
+
+    archive_path = raw_archive.write_raw_archive(bin_path, block_sec=0.01, codec=codec)
+    archive = raw_archive.Med64Archive(archive_path)
+    assert archive.shape == matrix_data.shape
+    np.testing.assert_array_equal(archive.get_samples(), matrix_data)
+    np.testing.assert_array_equal(archive[5, 190:611], matrix_data[5, 190:611])
+    np.testing.assert_array_equal(archive[:, 1233], matrix_data[:, 1233])
+    np.testing.assert_array_equal(
+        archive.get_samples(150, 450, channels=[0, 63]), matrix_data[[0, 63], 150:450]
+    )
+
+    restored_path = str(tmp_path / "restored.modat.bin")
+    raw_archive.extract_raw_archive(archive_path, restored_path)
+    with open(bin_path, "rb") as raw, open(restored_path, "rb") as restored:
+        assert raw.read() == restored.read()
+
+
+def test_benchmark_archive(med64_bin_path):
+    results = raw_archive.benchmark_archive(med64_bin_path, block_sec=0.05)
+    assert results["archive_bytes"] < results["raw_bytes"]
+    assert results["decompress_mb_per_sec"] > 0
@@ -0,0 +1,31 @@
+import numpy as np
+
+from meappy.spike_alignment import align_spike_waves, upsample_waves
+
+
+def _waves(shifts, width=61, pre_samples=20):
+    """gaussian troughs at pre_samples + shift"""
+    t = np.arange(width)
+    return -100 * np.exp(
+        -((t[None, :] - pre_samples - np.asarray(shifts)[:, None]) ** 2) / 4
+    )
+
+
+def test_upsample_waves():
+    waves = _waves([0.0, 0.5]) + np.linspace(0, 30, 61)
+    upsampled = upsample_waves(waves, 4)
+    assert upsampled.shape == (2, 244)
+    np.testing.assert_allclose(upsampled[:, ::4], waves, atol=1e-6)
+
+
+def test_align_spike_waves():
+    shifts = np.array([-0.4, 0.0, 0.3, 0.1, 0.25])
+    spike_times = np.array([100, 200, 300, 400, 500])
+    aligned, refined_times, target = align_spike_waves(
+        _waves(shifts), spike_times, pre_samples=20, factor=8
+    )
+    # the median trough is the target, each time moves by its trough offset
+    np.testing.assert_allclose(target, 20.1, atol=0.02)
+    np.testing.assert_allclose(refined_times, spike_times + shifts - 0.1, atol=0.02)
+    np.testing.assert_allclose(aligned, _waves(np.full(5, 0.1)), atol=1.0)
+    assert np.ptp(aligned.argmin(axis=1)) == 0
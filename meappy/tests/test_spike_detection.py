@@ -0,0 +1,78 @@
+import numpy as np
+
+from meappy import spike_detection
+from meappy.med64_recording import Med64Recording
+
+
+def test_detect_spikes(tmp_path):
+    rng = np.random.default_rng(2)
+    matrix_data = rng.normal(0, 10, size=(64, 20000)).astype(np.int16) + 500
+    spike_samples = np.array([300, 305, 5000, 9999, 10003, 19000])
+    matrix_data[7, spike_samples] -= 200
+    matrix_data[40, 12345] -= 200
+    bin_path = str(tmp_path / "20211109_15h09m07s.modat.bin")
+    matrix_data.T.tofile(bin_path)
+    recording = Med64Recording(bin_path)
+
+    noise = spike_detection.estimate_noise_mad(recording, chunk_sec=0.1)
+    np.testing.assert_allclose(noise, 10, rtol=0.15)
+
+    # 305 and 10003 are within the 1 ms dead time, 9999 and 10003 span chunks
+    samples, channels = spike_detection.detect_spikes(
+        recording, threshold=8, chunk_sec=0.5, n_workers=2
+    )
+    np.testing.assert_array_equal(samples, [300, 5000, 9999, 12345, 19000])
+    np.testing.assert_array_equal(channels, [7, 7, 7, 40, 7])
+
+    unit_spike_times, unit_list = spike_detection.detected_unit_spike_times(
+        samples, channels
+    )
+    np.testing.assert_array_equal(unit_list, [[7, 7], [40, 40]])
+    np.testing.assert_array_equal(unit_spike_times[40], [12345])
+    rates = spike_detection.channel_firing_rates(channels, recording.duration_sec, 64)
+    assert rates[7] == 4.0
+
+
+def test_dead_time_after_kept_spike(tmp_path):
+    # a chain of crossings 15 samples apart, with a 20 sample dead time
+    chain = np.arange(10, 100, 15)
+    block = np.zeros((2, 120), dtype=np.float32)
+    block[1, chain] = -100
+    samples, channels = spike_detection.threshold_crossings(block, [50, 50], 20)
+    np.testing.assert_array_equal(samples, [10, 40, 70])
+    np.testing.assert_array_equal(channels, [1, 1, 1])
+
+    # the same spikes, whatever the chunk boundaries
+    matrix_data = np.full((64, 2000), 500, dtype=np.int16)
+    matrix_data[3, 1000 + chain] -= 300
+    bin_path = str(tmp_path / "20211109_15h09m07s.modat.bin")
+    matrix_data.T.tofile(bin_path)
+    for chunk_sec in (0.001, 0.0023, 0.1):
+        samples, _ = spike_detection.detect_spikes(
+            Med64Recording(bin_path),
+            threshold=5,
+            dead_time_ms=1,
+            chunk_sec=chunk_sec,
+            noise=np.full(64, 10),
+            n_workers=1,
+        )
+        np.testing.assert_array_equal(samples, [1010, 1040, 1070])
+
+
+def test_apply_dead_time_matches_greedy_pass():
+    rng = np.random.default_rng(1)
+    channels = np.sort(rng.integers(0, 4, 3000))
+    samples = np.concatenate(
+        [np.sort(rng.choice(20000, np.sum(channels == ch), False)) for ch in range(4)]
+    )
+    last_spikes = {0: 3, 2: 10}
+
+    expected, last = [], dict(last_spikes)
+    for sample, channel in zip(samples.tolist(), channels.tolist()):
+        if channel not in last or sample - last[channel] > 20:
+            expected.append((sample, channel))
+            last[channel] = sample
+
+    kept = spike_detection.apply_dead_time(samples, channels, 20, last_spikes)
+    assert list(zip(*(k.tolist() for k in kept))) == expected
+    assert last_spikes == last
@@ -0,0 +1,41 @@
+import numpy as np
+
+from meappy.spike_drift import drift_traces, spike_amplitudes, unit_drift_table
+
+
+def test_spike_amplitudes_and_drift():
+    n_samples = 20000
+    matrix_data = np.zeros((64, n_samples))
+    spike_times = np.arange(100, 19900, 100)
+    # unit 1 on channel 9 keeps its amplitude, unit 2 on channel 27 halves
+    # its amplitude and moves to channel 28 half way through the recording
+    matrix_data[9, spike_times] = -100
+    matrix_data[10, spike_times] = -50
+    early, late = spike_times[spike_times < 10000], spike_times[spike_times >= 10000]
+    matrix_data[27, early] = -100
+    matrix_data[27, late] = -50
+    matrix_data[28, late] = -100
+    unit_spike_times = {1: spike_times, 2: spike_times}
+
+    amplitudes = spike_amplitudes(matrix_data, unit_spike_times, [(1, 9), (2, 27)])
+    assert amplitudes["footprint_amplitudes"].shape == (2 * len(spike_times), 9)
+    np.testing.assert_allclose(amplitudes["amplitudes"][: len(spike_times)], 100)
+    assert amplitudes["footprint_channels"].shape == (2, 9)
+    np.testing.assert_array_equal(amplitudes["unit_ids"], [1, 2])
+    assert amplitudes["footprint_channels"][0, 0] == 9
+    assert amplitudes["footprint_channels"][1, 0] == 27
+    np.testing.assert_array_equal(
+        amplitudes["unit_ids"][amplitudes["unit_index"]], amplitudes["cluster_ids"]
+    )
+    # channel 9 is grid row 1, column 1, channel 10 is column 2
+    np.testing.assert_allclose(amplitudes["positions"][0], [1, 1 + 1 / 3])
+
+    traces = drift_traces(amplitudes, bin_sec=0.1, duration_sec=1.0, fs=20000)
+    assert traces["amplitude"].shape == (2, 10)
+    table = unit_drift_table(traces, min_spikes_per_bin=5)
+    assert list(table["cluster_id"]) == [1, 2]
+    assert list(table["drifting"]) == [False, True]
+    assert table["amplitude_change"][0] == 0
+    # amplitude steps from 100 to 50, relative to a median between the two
+    assert table["amplitude_change"][1] > 0.6
+    assert table["position_shift"][1] > 0.3
@@ -0,0 +1,29 @@
+import numpy as np
+
+from meappy.spike_store import (
+    is_spike_store_current,
+    read_spike_store,
+    spike_store_path,
+    write_spike_store,
+)
+
+
+def test_spike_store_round_trip(tmp_path):
+    units_ts_path = str(tmp_path / "units_ts.tsv")
+    (tmp_path / "units_ts.tsv").write_text("timestamp\tunit\n")
+    samples = np.array([2**40 + 1, 30, 40, 50, 60], dtype=np.uint64)
+    clusters = np.array([5, 2, 5, 2, 9])
+    store_dir = spike_store_path(units_ts_path)
+    assert store_dir.endswith("units_ts.spikes")
+    assert not is_spike_store_current(units_ts_path)
+
+    write_spike_store(store_dir, samples, clusters, metadata={"slice_id": "slice"})
+    assert is_spike_store_current(units_ts_path)
+    trains, metadata = read_spike_store(store_dir)
+    assert metadata["Fs"] == 20000 and metadata["slice_id"] == "slice"
+    assert trains.times.dtype == np.int64 and isinstance(trains.times, np.memmap)
+    assert list(trains) == [2, 5, 9]
+    # sample numbers are exact, and sorted by time within a cluster
+    np.testing.assert_array_equal(trains[5], [40, 2**40 + 1])
+    seconds, _ = read_spike_store(store_dir, return_seconds=True)
+    np.testing.assert_allclose(seconds[2], [30 / 20000, 50 / 20000])
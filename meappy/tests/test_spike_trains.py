@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from meappy import waveform
+from meappy.spike_trains import SpikeTrains
+
+
+def test_spike_trains_from_spikes():
+    times = np.array([5, 10, 15, 20, 25, 30, 35])
+    clusters = np.array([3, 1, 3, 7, 1, 3, 7])
+    trains = SpikeTrains.from_spikes(times, clusters)
+    assert list(trains) == [1, 3, 7]
+    assert len(trains) == 3 and 3 in trains and 2 not in trains
+    np.testing.assert_array_equal(trains[3], [5, 15, 30])
+    np.testing.assert_array_equal(trains.counts, [2, 3, 2])
+    np.testing.assert_array_equal(trains.spike_units, [1, 1, 3, 3, 3, 7, 7])
+    # unit trains are views of one array
+    assert np.shares_memory(trains[1], trains.times)
+
+    selected = trains.select([7, 1])
+    assert list(selected) == [1, 7]
+    np.testing.assert_array_equal(selected[7], [20, 35])
+    np.testing.assert_array_equal(trains.count_in_range(10, 30), [1, 1, 1])
+    np.testing.assert_allclose(trains.scaled(0.5)[3], [2.5, 7.5, 15])
+
+    as_dict = {unit: list(train) for unit, train in trains.items()}
+    np.testing.assert_array_equal(SpikeTrains.from_dict(as_dict).times, trains.times)
+    mat_format = {unit: {"timestamps": train} for unit, train in trains.items()}
+    assert SpikeTrains.from_dict(mat_format).counts.tolist() == [2, 3, 2]
+
+
+def test_get_phy_spikes_list():
+    samples = np.array([20000, 40000, 60000])
+    trains = waveform.get_phy_spikes_list(samples, np.array([2, 0, 2]))
+    np.testing.assert_allclose(trains[2], [1, 3])
+    trains = waveform.get_phy_spikes_list(samples, np.array([2, 0, 2]), False)
+    np.testing.assert_array_equal(trains[0], [40000])
+
+
+def test_spike_trains_wide_unit_ids():
+    trains = SpikeTrains.from_spikes([1.0, 2.0, 3.0], np.array([10**6, -5, 10**6]))
+    assert list(trains) == [-5, 10**6]
+    np.testing.assert_array_equal(trains[10**6], [1, 3])
+    assert len(SpikeTrains.from_spikes([], np.array([], dtype=int))) == 0
+
+
+def test_correlograms_of_spike_trains():
+    pytest.importorskip("seaborn")
+    from meappy import med64_data
+
+    trains = SpikeTrains.from_spikes(
+        np.array([0.0101, 0.5, 0.0123, 0.5021, 0.9]), np.array([1, 1, 2, 2, 1])
+    )
+    units_data = {1: {"timestamps": trains[1]}, 2: {"timestamps": trains[2]}}
+    for data in (trains, units_data):
+        train_1 = SpikeTrains.from_dict(data)[1]
+        np.testing.assert_array_equal(
+            np.flatnonzero(med64_data.get_array_from_ts(train_1)), [10, 500, 900]
+        )
+    lags, crosscorr = med64_data.crosscorr(trains[1], trains[2])
+    # unit 2 fires 2 ms after unit 1, the correlation peaks at a lag of -2 ms
+    assert lags[np.argmax(crosscorr)] == -2
@@ -0,0 +1,39 @@
+import numpy as np
+
+from meappy import trace_pyramid
+from meappy.med64_recording import Med64Recording, write_channel_major
+
+
+def test_pyramid_windows(med64_bin_path):
+    recording = Med64Recording(med64_bin_path)
+    pyramid = trace_pyramid.build_minmax_pyramid(
+        recording, base_bin=4, factor=2, min_bins=100, chunk_sec=0.01
+    )
+    assert pyramid.bin_sizes == [4, 8, 16, 32]
+
+    time, mins, maxs = pyramid.window(0, 0.1, width_px=60, channels=[1, 2])
+    assert mins.shape == (2, 63) and time[1] == 32 / recording.fs
+    data = recording.data[[1, 2]].astype(int)
+    np.testing.assert_array_equal(mins[:, 0], data[:, :32].min(axis=1))
+    np.testing.assert_array_equal(maxs[:, 62], data[:, 1984:].max(axis=1))
+
+    # zoomed in further than level 0 returns the raw samples
+    time, mins, maxs = pyramid.window(0.001, 0.002, width_px=500)
+    np.testing.assert_array_equal(mins, recording.data[:, 20:40])
+
+
+def test_pyramid_of_channel_major_sidecar(med64_bin_path):
+    write_channel_major(med64_bin_path, chunk_sec=0.01)
+    pyramid = trace_pyramid.build_minmax_pyramid(med64_bin_path, min_bins=100)
+    assert pyramid.pyramid_dir == trace_pyramid.pyramid_path(med64_bin_path)
+    assert pyramid.meta["source"] == "20211109_15h09m07s.modat.bin"
+
+
+def test_source_dict_window_times(med64_bin_path):
+    from meappy import waveform
+
+    matrix_data = waveform.get_raw_data(med64_bin_path)
+    source_dict = waveform.get_source_dict(matrix_data, 20, 1000, active_chan=3)
+    times = np.linspace(0, 2000 / waveform.Fs, num=2000)
+    np.testing.assert_allclose(source_dict["time"], times[990:1010])
+    np.testing.assert_array_equal(source_dict["amp_3"], matrix_data[3, 990:1010])
@@ -1,7 +1,103 @@
 from meappy import waveform
 
 
-def test_get_raw_data():
-    med64_bin_path = ...  # TODO make test version of raw data
+def test_get_raw_data(med64_bin_path):
     data = waveform.get_raw_data(med64_bin_path)
-    assert data.shape == (XXX, YYY)
+    assert data.shape == (64, 2000)
+    assert data[3, 5] == 305
+
+
+def test_extract_spike_waves_matches_get_window(med64_bin_path):
+    import numpy as np
+
+    matrix_data = waveform.get_raw_data(med64_bin_path)
+    spike_times = np.array([100, 555, 1900])
+    waves, in_bounds = waveform.extract_spike_waves(matrix_data[4], spike_times, 121)
+    assert waves.shape == (3, 121) and in_bounds.all()
+    for wave, time in zip(waves, spike_times):
+        min_point, max_point = waveform.get_window(time, 121)
+        np.testing.assert_array_equal(wave, matrix_data[4][min_point : max_point + 1])
+
+    waves, in_bounds = waveform.extract_spike_waves(
+        matrix_data[4], [10, 1000, 1995], 121, pre_samples=30, fill_value=np.nan
+    )
+    np.testing.assert_array_equal(in_bounds, [False, True, False])
+    assert np.isnan(waves[0, :20]).all() and not np.isnan(waves[0, 20:]).any()
+    assert np.isnan(waves[2, 35:]).all() and not np.isnan(waves[2, :35]).any()
+
+    sequential, sequential_in_bounds = waveform.extract_spike_waves_sequential(
+        med64_bin_path,
+        [10, 1000, 1995],
+        [4, 4, 4],
+        121,
+        pre_samples=30,
+        chunk_sec=0.01,
+        fill_value=np.nan,
+    )
+    np.testing.assert_array_equal(sequential, waves)
+    np.testing.assert_array_equal(sequential_in_bounds, in_bounds)
+
+
+def test_get_ordered_raw_phy_spike_waves(med64_bin_path):
+    import numpy as np
+    from meappy import waveform_extract_order_spiketimes as extract
+
+    matrix_data = waveform.get_raw_data(med64_bin_path, mmap=True)
+    unit_spike_times = {3: [100, 200], 8: [1500]}
+    times_waves = extract.get_ordered_raw_phy_spike_waves(
+        matrix_data, unit_spike_times, [(3, 5), (8, 6)], 121, 30
+    )
+    assert times_waves["waves"][3].shape == (2, 121)
+    np.testing.assert_array_equal(times_waves["times"][8], [[1500]])
+    np.testing.assert_array_equal(times_waves["waves"][8][0], matrix_data[6, 1470:1591])
+
+
+def test_sequential_extraction_matches_batch(med64_bin_path):
+    import numpy as np
+    from meappy import waveform_extract_order_spiketimes as extract
+
+    matrix_data = waveform.get_raw_data(med64_bin_path)
+    unit_spike_times = {3: [1990, 5, 700, 701], 8: [1500, 299, 301]}
+    unit_list = [(3, 5), (8, 6)]
+    batch = extract.get_ordered_raw_phy_spike_waves(
+        matrix_data, unit_spike_times, unit_list, 121, 30
+    )
+    sequential = extract.get_ordered_raw_phy_spike_waves_sequential(
+        med64_bin_path, unit_spike_times, unit_list, 121, 30, chunk_sec=0.015
+    )
+    for unit in (3, 8):
+        np.testing.assert_array_equal(sequential["waves"][unit], batch["waves"][unit])
+        np.testing.assert_array_equal(sequential["times"][unit], batch["times"][unit])
+
+
+def test_parallel_extraction_matches_batch(med64_bin_path):
+    import numpy as np
+    from meappy import waveform_extract_order_spiketimes as extract
+
+    matrix_data = waveform.get_raw_data(med64_bin_path)
+    unit_spike_times = {3: [1990, 5, 700], 8: [1500], 12: [40, 50]}
+    unit_list = np.array([(3, 5), (8, 6), (12, 63)])
+    batch = extract.get_ordered_raw_phy_spike_waves(
+        matrix_data, unit_spike_times, unit_list, 121, 30
+    )
+    parallel = extract.get_ordered_raw_phy_spike_waves_parallel(
+        med64_bin_path, unit_spike_times, unit_list, 121, 30, n_workers=2
+    )
+    assert list(parallel["waves"]) == [3, 8, 12]
+    for unit in (3, 8, 12):
+        np.testing.assert_array_equal(parallel["waves"][unit], batch["waves"][unit])
+        np.testing.assert_array_equal(parallel["times"][unit], batch["times"][unit])
+
+
+def test_phy_data(phy_dir):
+    import numpy as np
+
+    phy_data = waveform.PhyData(phy_dir)
+    assert isinstance(phy_data.spike_times, np.memmap)
+    assert phy_data.templates is None and phy_data.amplitudes.shape == (37,)
+    np.testing.assert_array_equal(phy_data.good_clust_chan(), [[0, 4], [2, 17]])
+    np.testing.assert_array_equal(phy_data.good_clust_chan(10), [[0, 4]])
+    assert phy_data.good_clusters(10) is phy_data.good_clusters(10)
+    trains = phy_data.spike_trains
+    assert list(trains) == [0, 1, 2] and len(trains[0]) == 20
+    assert np.all(np.diff(trains[0].astype(np.int64)) > 0)
@@ -0,0 +1,43 @@
+import numpy as np
+
+from meappy.waveform_correlation import (
+    read_waveform_correlation,
+    waveform_correlation_matrix,
+    waveform_correlation_path,
+    write_waveform_correlation,
+)
+
+
+def test_waveform_correlation_matrix(tmp_path):
+    rng = np.random.default_rng(0)
+    waves = rng.normal(size=(5, 41))
+    correlation, lags = waveform_correlation_matrix(waves)
+    np.testing.assert_allclose(correlation, np.corrcoef(waves), atol=1e-12)
+    assert not lags.any()
+
+    # a copy of unit 0 shifted by 2 samples is found with a lag of 2
+    t = np.arange(41)
+    shape = np.exp(-((t - 20) ** 2) / 8.0)
+    shifted = np.vstack((shape, np.roll(shape, 2), waves[0]))
+    correlation, lags = waveform_correlation_matrix(shifted, max_lag=3)
+    np.testing.assert_allclose(correlation, correlation.T)
+    assert correlation[0, 1] > 0.999
+    assert lags[0, 1] == 2 and lags[1, 0] == -2
+    assert correlation[0, 1] > waveform_correlation_matrix(shifted)[0][0, 1]
+
+    store = waveform_correlation_path(str(tmp_path / "slice_waves.tsv"))
+    assert store.endswith("slice_waves_corr")
+    write_waveform_correlation(store, correlation, lags, [3, 8, 11])
+    loaded, loaded_lags, cluster_ids = read_waveform_correlation(store)
+    np.testing.assert_allclose(loaded, correlation, rtol=1e-6)
+    np.testing.assert_array_equal(cluster_ids, [3, 8, 11])
+
+
+def test_waveform_correlation_without_units(tmp_path):
+    for max_lag in (0, 3):
+        correlation, lags = waveform_correlation_matrix([], max_lag=max_lag)
+        assert correlation.shape == lags.shape == (0, 0)
+    store = str(tmp_path / "slice_waves_corr")
+    write_waveform_correlation(store, correlation, lags, [])
+    loaded, loaded_lags, cluster_ids = read_waveform_correlation(store)
+    assert loaded.shape == loaded_lags.shape == (0, 0) and not len(cluster_ids)
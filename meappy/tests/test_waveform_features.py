@@ -0,0 +1,71 @@
+import numpy as np
+
+from meappy.waveform_features import (
+    UNIT_COLUMNS,
+    accumulator_feature_table,
+    unit_waveform_features,
+    waveform_feature_tables,
+)
+from meappy.waveform_stats import WaveformAccumulator
+
+
+def _spike(width=61, pre_samples=20, depth=-100.0, after=30.0):
+    """triangle trough at pre_samples followed by a slower positive peak"""
+    wave = np.zeros(width)
+    wave[pre_samples - 2 : pre_samples + 3] = depth * np.array(
+        [0.25, 0.75, 1, 0.75, 0.25]
+    )
+    wave[pre_samples + 3 : pre_samples + 13] = after * np.sin(np.linspace(0, np.pi, 10))
+    return wave
+
+
+def test_unit_waveform_features():
+    waves = np.vstack((_spike(), 2 * _spike()))
+    features = unit_waveform_features(waves, noise=[10, 10], pre_samples=20, fs=20000)
+    np.testing.assert_array_equal(features["trough_index"], [20, 20])
+    np.testing.assert_allclose(features["trough_amplitude"], [-100, -200])
+    np.testing.assert_allclose(
+        features["amplitude"], features["peak_amplitude"] + [100, 200]
+    )
+    np.testing.assert_allclose(features["snr"], features["amplitude"] / 10)
+    # trough of -100 crosses -50 halfway between samples 18, 19 and 21, 22
+    np.testing.assert_allclose(features["half_width_ms"], 3 / 20)
+    assert (features["trough_to_peak_ms"] > 0).all()
+    assert (features["repolarization_slope"] > 0).all()
+
+
+def test_waveform_feature_tables():
+    rng = np.random.default_rng(0)
+    times_waves = {"waves": dict(), "times": dict()}
+    for clust, scale in ((4, 1.0), (9, 3.0)):
+        times_waves["waves"][clust] = scale * _spike() + rng.normal(0, 1, (50, 61))
+        times_waves["times"][clust] = np.arange(50.0).reshape(-1, 1)
+    units, spikes = waveform_feature_tables(
+        times_waves, [(4, 1), (9, 2)], pre_samples=20
+    )
+    assert list(units["cluster_id"]) == [4, 9]
+    assert list(units["ch"]) == [1, 2]
+    np.testing.assert_allclose(units["noise"], 1, atol=0.2)
+    assert units["amplitude"][1] > 2.5 * units["amplitude"][0]
+    assert len(spikes) == 100
+    np.testing.assert_allclose(
+        spikes.groupby("cluster_id")["amplitude"].mean(), units["amplitude"], rtol=1e-6
+    )
+
+
+def test_feature_tables_share_columns():
+    rng = np.random.default_rng(1)
+    waves = (_spike() + rng.normal(0, 1, (30, 61))).astype(np.int16)
+    times_waves = {"waves": {4: waves}, "times": {4: np.arange(30)}}
+    units, spikes = waveform_feature_tables(times_waves, [(4, 7)], pre_samples=20)
+    accumulators = {4: WaveformAccumulator(61).update(waves)}
+    summary = accumulator_feature_table(accumulators, [(4, 7)], pre_samples=20)
+    assert list(units.columns) == list(summary.columns) == UNIT_COLUMNS
+    assert summary["ch"][0] == 7 and np.isnan(summary["spike_amplitude_sd"][0])
+    for name in ("amplitude", "noise", "half_width_ms"):
+        np.testing.assert_allclose(summary[name], units[name])
+
+    empty_units, empty_spikes = waveform_feature_tables({"waves": {}, "times": {}})
+    assert list(empty_units.columns) == UNIT_COLUMNS and not len(empty_units)
+    assert list(empty_spikes.columns) == ["cluster_id", "spike_time", "amplitude"]
+    assert list(accumulator_feature_table(dict()).columns) == UNIT_COLUMNS
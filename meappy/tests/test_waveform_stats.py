@@ -0,0 +1,32 @@
+import numpy as np
+
+from meappy import waveform
+from meappy.waveform_stats import WaveformAccumulator, accumulate_unit_waveforms
+
+
+def test_waveform_accumulator_matches_batch_statistics():
+    rng = np.random.default_rng(0)
+    waves = rng.normal(100, 5, size=(1000, 11))
+    accumulator = WaveformAccumulator(11, reservoir_size=50, seed=1)
+    for start in range(0, 1000, 137):
+        accumulator.update(waves[start : start + 137])
+
+    assert accumulator.count == 1000
+    np.testing.assert_allclose(accumulator.mean, waves.mean(axis=0))
+    np.testing.assert_allclose(accumulator.variance, waves.var(axis=0, ddof=1))
+    assert accumulator.reservoir.shape == (50, 11)
+    # every reservoir row is one of the input waveforms
+    assert all((waves == row).all(axis=1).any() for row in accumulator.reservoir)
+    assert accumulator.percentiles((5, 50, 95)).shape == (3, 11)
+
+
+def test_accumulate_unit_waveforms(med64_bin_path):
+    matrix_data = waveform.get_raw_data(med64_bin_path, mmap=True)
+    spike_times = {3: np.arange(100, 1900, 7)}
+    accumulators = accumulate_unit_waveforms(
+        matrix_data, spike_times, [(3, 5)], 21, 5, reservoir_size=10, batch_spikes=16
+    )
+    waves, _ = waveform.extract_spike_waves(matrix_data[5], spike_times[3], 21, 5)
+    np.testing.assert_allclose(accumulators[3].mean, waves.mean(axis=0))
+    np.testing.assert_allclose(accumulators[3].std, waves.std(axis=0, ddof=1))
+    assert accumulators[3].reservoir.shape == (10, 21)
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from meappy.waveform_store import read_waveform_store, write_waveform_store
+
+
+def test_waveform_store_round_trip(tmp_path):
+    times_waves = {
+        "waves": {
+            7: np.arange(12, dtype=float).reshape(3, 4),
+            2: -np.arange(8, dtype=float).reshape(2, 4),
+        },
+        "times": {
+            7: np.array([10.0, 20.0, 30.0]).reshape(-1, 1),
+            2: np.array([5.0, 50.0]).reshape(-1, 1),
+        },
+    }
+    unit_list = np.array([[7, 13], [2, 40]])
+    store_dir = str(tmp_path / "slice_waves")
+    write_waveform_store(
+        store_dir, times_waves, unit_list, metadata={"Fs": 20000}, dtype=np.int16
+    )
+
+    store = read_waveform_store(store_dir)
+    assert len(store) == 2
+    assert store.metadata["Fs"] == 20000
+    assert store.metadata["sample_window_width"] == 4
+    assert isinstance(store.arrays["waves"], np.memmap)
+    assert store.arrays["waves"].dtype == np.int16
+    np.testing.assert_array_equal(store.arrays["channels"], [13, 40])
+    np.testing.assert_array_equal(store.waves(2), times_waves["waves"][2])
+    np.testing.assert_array_equal(store.times(7), [10, 20, 30])
+
+    loaded = store.to_times_waves()
+    for clust in (7, 2):
+        np.testing.assert_array_equal(
+            loaded["waves"][clust], times_waves["waves"][clust]
+        )
+        np.testing.assert_array_equal(
+            loaded["times"][clust], times_waves["times"][clust]
+        )
+
+
+def test_waveform_store_dtype(tmp_path):
+    waves = {0: np.array([[0.5, 1.0]]), 1: np.array([[40000.0, 0.0]])}
+    times_waves = {"waves": waves, "times": {0: [[1.0]], 1: [[2.0]]}}
+    store_dir = str(tmp_path / "slice_waves")
+    write_waveform_store(store_dir, times_waves)
+    store = read_waveform_store(store_dir)
+    assert store.arrays["waves"].dtype == np.float64
+    np.testing.assert_array_equal(store.waves(0), [[0.5, 1.0]])
+
+    with pytest.raises(ValueError):
+        write_waveform_store(store_dir, times_waves, dtype=np.int16)
+    times_waves["waves"] = {0: np.array([[1.0, 2.0]]), 1: waves[1]}
+    with pytest.raises(ValueError):
+        write_waveform_store(store_dir, times_waves, dtype=np.int16)